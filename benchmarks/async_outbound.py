@@ -0,0 +1,238 @@
+"""
+Concurrent borrow throughput under ASGI, with the payment outbox worker in
+sync and in async (ASYNC_OUTBOUND) mode. Clients create borrowings against
+gunicorn with the uvicorn worker serving library_project_final/asgi.py,
+while worker threads drain the payment and notification outboxes. Stripe
+and Telegram are stood in for by a local server that answers after a fixed
+latency. A borrowing is complete once its checkout session exists.
+
+    python -m benchmarks.async_outbound --clients 16 --seconds 5 --latency-ms 100
+
+Needs gunicorn and uvicorn-worker from requirements.txt.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from benchmarks.server_load import wait_until_up
+from benchmarks.utils import report, setup_django
+
+
+class SlowApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.count += 1
+            count = self.server.count
+        if self.path.startswith("/v1/"):
+            body = {"id": f"cs_bench_{count}", "object": "checkout.session"}
+        else:
+            body = {"ok": True}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(latency):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowApiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def seed(clients):
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from books.models import Book
+
+    call_command("migrate", verbosity=0)
+    users = get_user_model().objects.bulk_create(
+        get_user_model()(email=f"user{number}@mail.com") for number in range(clients)
+    )
+    books = Book.objects.bulk_create(
+        Book(
+            title=f"Book {number}",
+            author="Author",
+            cover="Soft",
+            inventory=10**6,
+            daily_fee=1,
+        )
+        for number in range(clients)
+    )
+    return [
+        (str(AccessToken.for_user(user)), book.id) for user, book in zip(users, books)
+    ]
+
+
+def drain(task, stop, async_outbound):
+    """
+    Runs `task` in a loop, the way a busy Celery worker would, until `stop`
+    is set and nothing is left to do.
+    """
+    from django.db import connection
+    from django.test import override_settings
+
+    with override_settings(ASYNC_OUTBOUND=async_outbound):
+        while True:
+            if not task() and stop.is_set():
+                break
+            time.sleep(0.01)
+    connection.close()
+
+
+def borrow(base_url, token, book_id, stop, latencies, errors):
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {token}"
+    payload = {
+        "book": book_id,
+        "borrow_date": "2024-01-01",
+        "expected_return": "2024-01-10",
+    }
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                f"{base_url}/api/borrows/", json=payload, timeout=30
+            )
+        except requests.RequestException:
+            errors.append(None)
+            continue
+        if response.status_code == 201:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(response.status_code)
+
+
+def run(base_url, clients, seconds, async_outbound):
+    from notifications.tasks import flush_notifications
+    from payments.models import Payment
+    from payments.tasks import process_payment_outbox
+
+    stop_clients = threading.Event()
+    stop_workers = threading.Event()
+    latencies = []
+    errors = []
+    workers = [
+        threading.Thread(target=drain, args=(task, stop_workers, async_outbound))
+        for task in (process_payment_outbox, flush_notifications)
+    ]
+    borrowers = [
+        threading.Thread(
+            target=borrow,
+            args=(base_url, token, book_id, stop_clients, latencies, errors),
+        )
+        for token, book_id in clients
+    ]
+    sessions_before = Payment.objects.exclude(session_id="").count()
+
+    started = time.perf_counter()
+    for thread in workers + borrowers:
+        thread.start()
+    time.sleep(seconds)
+    stop_clients.set()
+    for thread in borrowers:
+        thread.join()
+    stop_workers.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    created = len(latencies)
+    sessions = Payment.objects.exclude(session_id="").count() - sessions_before
+    assert sessions == created, (sessions, created)
+    latencies.sort()
+    return {
+        "created_per_s": round(created / seconds, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(latencies[int(created * 0.99)] * 1000, 1),
+        "completed_per_s": round(created / elapsed, 1),
+        "backlog_s": round(elapsed - seconds, 1),
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    stub = start_server(args.latency_ms / 1000)
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(
+            SECRET_KEY="benchmark",
+            SQLITE_PATH=os.path.join(directory, "db.sqlite3"),
+            ALLOWED_HOSTS="127.0.0.1",
+            STRIPE_API_BASE=stub_url,
+            STRIPE_SECRET_KEY="sk_test_benchmark",
+            TELEGRAM_API_BASE=stub_url,
+            # Tasks are run by the worker threads here, not through a broker.
+            CELERY_BROKER_URL="memory://",
+            CELERY_RESULT_BACKEND="cache+memory://",
+            THROTTLE_BORROW_CREATE_RATE="1000000/s",
+            GUNICORN_BIND=f"127.0.0.1:{args.port}",
+            GUNICORN_WORKER_CLASS="uvicorn_worker.UvicornWorker",
+        )
+        setup_django()
+        clients = seed(args.clients)
+
+        results = {}
+        for name, async_outbound in (("sync", False), ("async", True)):
+            server = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "-c",
+                    "gunicorn.conf.py",
+                    "library_project_final.asgi:application",
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_until_up(f"{base_url}/api/books/", server)
+                results[name] = run(base_url, clients, args.seconds, async_outbound)
+            finally:
+                server.terminate()
+                server.wait()
+
+    report(
+        f"{args.clients} clients creating borrowings under ASGI for "
+        f"{args.seconds:g}s ({args.latency_ms:g} ms per Stripe/Telegram call)",
+        results,
+    )
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Times the bulk book import against creating books one serializer at a
+time, the way `BookListViewSet.create` does.
+
+    python -m benchmarks.book_import --rows 1000000
+"""
+
+import argparse
+import time
+
+from benchmarks.utils import report, setup_django, test_database
+
+
+def csv_lines(rows):
+    yield "title,author,cover,inventory,daily_fee\n"
+    for number in range(rows):
+        yield f"Book {number},Author {number % 5000},Soft,{number % 20},1.50\n"
+
+
+def run_import(rows, batch_size):
+    from books.importers import CSV, import_books, read_rows
+
+    started = time.perf_counter()
+    summary = import_books(read_rows(csv_lines(rows), CSV), batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+    assert summary["written"] == rows, summary
+    return {"seconds": round(elapsed, 2), "rows_per_s": round(rows / elapsed)}
+
+
+def run_one_by_one(rows):
+    import csv
+
+    from books.serializers import BookListSerializer
+
+    started = time.perf_counter()
+    for row in csv.DictReader(csv_lines(rows)):
+        serializer = BookListSerializer(data=row)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+    elapsed = time.perf_counter() - started
+    return {"seconds": round(elapsed, 2), "rows_per_s": round(rows / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--baseline-rows", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from books.models import Book
+
+    with test_database():
+        results = {"one by one": run_one_by_one(args.baseline_rows)}
+        Book.objects.all().delete()
+        results[f"import_books, batch {args.batch_size}"] = run_import(
+            args.rows, args.batch_size
+        )
+        report(
+            f"Importing books ({args.baseline_rows} one by one, "
+            f"{args.rows} in bulk)",
+            results,
+        )
+
+
+if __name__ == "__main__":
+    main()
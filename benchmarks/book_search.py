@@ -0,0 +1,78 @@
+"""
+Compares the full-text `?search=` query with a naive LIKE scan on a large
+catalog.
+
+    python -m benchmarks.book_search --rows 1000000
+"""
+
+import argparse
+import random
+
+from benchmarks.utils import measure, report, setup_django, test_database
+
+SYLLABLES = "ka lo mi ren tor sil van dre mo thu ash el ori bek zan".split()
+SURNAMES = "Smith Tolkien Austen Orwell Rowling Pratchett Herbert Asimov".split()
+QUERIES = ["kalomi", "tolkien", "sil", "vandre ashel"]
+
+
+def vocabulary(rng, size=20000):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 5))))
+    return sorted(words)
+
+
+def populate(rows, batch_size=10000):
+    from books.models import Book
+
+    rng = random.Random(42)
+    words = vocabulary(rng)
+    for start in range(0, rows, batch_size):
+        Book.objects.bulk_create(
+            Book(
+                title=" ".join(rng.sample(words, 3)).title(),
+                author=f"{rng.choice('ABCDEFGH')}. {rng.choice(SURNAMES)}",
+                cover="Hard",
+                inventory=rng.randint(0, 20),
+                daily_fee="1.50",
+            )
+            for _ in range(min(batch_size, rows - start))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db.models import Q
+
+    from books.models import Book
+    from books.search import search_books
+
+    with test_database():
+        populate(args.rows)
+
+        def first_page(queryset):
+            # The list endpoint counts the matches and reads one page.
+            return queryset.count(), list(queryset[:20])
+
+        results = {}
+        for text in QUERIES:
+            like = Q()
+            for word in text.split():
+                like &= Q(title__icontains=word) | Q(author__icontains=word)
+            fts = search_books(Book.objects.all(), text)
+            scan = Book.objects.filter(like).order_by("id")
+            matches = fts.count()
+            results[f"fts {text!r} ({matches} hits)"] = measure(
+                lambda: first_page(fts), args.repeat
+            )
+            results[f"like {text!r}"] = measure(lambda: first_page(scan), args.repeat)
+        report(f"Book search on {args.rows} rows, count + first page", results)
+
+
+if __name__ == "__main__":
+    main()
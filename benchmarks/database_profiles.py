@@ -0,0 +1,151 @@
+"""
+Runs the same concurrent borrow workload on each database profile: SQLite
+with Django's stock settings, the tuned SQLite profile and, when
+POSTGRES_HOST is set, the PostgreSQL profile.
+
+    python -m benchmarks.database_profiles --threads 16 --borrows 25
+
+Each profile runs in its own process, since the database settings are
+read at startup.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+from benchmarks.utils import report
+
+PROFILES = {
+    "sqlite, stock": "sqlite",
+    "sqlite, tuned": "sqlite",
+    "postgres": "postgres",
+}
+
+
+def borrow_and_list(user, book, borrows, outcomes):
+    from django.db import connection
+    from rest_framework.reverse import reverse
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    client.force_authenticate(user)
+    url = reverse("borrows:borrow-list")
+    payload = {
+        "book": book.id,
+        "borrow_date": "2024-01-01",
+        "expected_return": "2024-01-10",
+    }
+    try:
+        for _ in range(borrows):
+            try:
+                created = client.post(url, payload).status_code == 201
+                listed = client.get(url).status_code == 200
+            except Exception as error:
+                outcomes.append(type(error).__name__)
+            else:
+                outcomes.append("ok" if created and listed else "failed")
+    finally:
+        connection.close()
+
+
+def run_profile(name, threads, borrows):
+    os.environ["DJANGO_SETTINGS_MODULE"] = "library_project_final.settings"
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["DATABASE_PROFILE"] = PROFILES[name]
+    from django.conf import settings
+
+    if name == "sqlite, stock":
+        settings.DATABASES["default"].update(
+            ENGINE="django.db.backends.sqlite3", OPTIONS={}
+        )
+
+    from benchmarks.utils import setup_django, test_database
+
+    setup_django()
+    from django.contrib.auth import get_user_model
+
+    from books.models import Book
+    from borrows.views import BorrowViewSet
+
+    with (
+        test_database(),
+        patch("payments.helper.schedule_payment_outbox"),
+        patch.object(BorrowViewSet, "get_throttles", return_value=[]),
+    ):
+        users = [
+            get_user_model().objects.create(email=f"user{number}@mail.com")
+            for number in range(threads)
+        ]
+        book = Book.objects.create(
+            title="Book", author="Author", cover="Soft", inventory=10**6, daily_fee=1
+        )
+        outcomes = []
+        workers = [
+            threading.Thread(
+                target=borrow_and_list, args=(user, book, borrows, outcomes)
+            )
+            for user in users
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+    succeeded = outcomes.count("ok")
+    return {
+        "borrows_per_s": round(succeeded / elapsed, 1),
+        "succeeded": succeeded,
+        "errors": {
+            outcome: outcomes.count(outcome)
+            for outcome in sorted(set(outcomes) - {"ok"})
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--borrows", type=int, default=25)
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        print(json.dumps(run_profile(args.profile, args.threads, args.borrows)))
+        return
+
+    results = {}
+    for name in PROFILES:
+        if PROFILES[name] == "postgres" and not os.getenv("POSTGRES_HOST"):
+            continue
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.database_profiles",
+                "--profile",
+                name,
+                "--threads",
+                str(args.threads),
+                "--borrows",
+                str(args.borrows),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[name] = json.loads(output.splitlines()[-1])
+    report(
+        f"{args.threads} threads, each creating and listing {args.borrows} borrowings",
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Encode throughput of the stock JSONRenderer against FastJSONRenderer for
+large payment lists: serializer output (decimals as strings) and raw
+rows with Decimal values.
+
+    python -m benchmarks.json_renderers --rows 100000
+"""
+
+import argparse
+import random
+from decimal import Decimal
+
+from benchmarks.utils import measure, report, setup_django
+
+
+def payment_rows(rows):
+    rng = random.Random(42)
+    return [
+        {
+            "id": number,
+            "status": rng.choice(["Pending", "Paid"]),
+            "type": rng.choice(["Payment", "Fine"]),
+            "borrowing": number // 2,
+            "session_url": f"https://checkout.stripe.com/pay/cs_test_{number:024d}",
+            "session_id": f"cs_test_{number:024d}",
+            "money_to_pay": Decimal(rng.randint(1, 10_000_000)) / 100,
+        }
+        for number in range(rows)
+    ]
+
+
+def throughput(result, size, rows):
+    seconds = result["median_ms"] / 1000
+    return {
+        **result,
+        "MB_per_s": round(size / seconds / 1e6, 1),
+        "rows_per_s": round(rows / seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework.renderers import JSONRenderer
+
+    from library_project_final.renderers import FastJSONRenderer
+
+    raw = payment_rows(args.rows)
+    payloads = {
+        "serialized": [
+            {**row, "money_to_pay": f"{row['money_to_pay']:f}"} for row in raw
+        ],
+        "Decimal": raw,
+    }
+
+    results = {}
+    for name, payload in payloads.items():
+        for renderer in (JSONRenderer(), FastJSONRenderer()):
+            size = len(renderer.render(payload))
+            result = measure(lambda: renderer.render(payload), args.repeat)
+            results[f"{type(renderer).__name__}, {name}"] = throughput(
+                result, size, args.rows
+            )
+    report(f"Encoding {args.rows} payments", results)
+
+
+if __name__ == "__main__":
+    main()
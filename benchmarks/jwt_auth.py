@@ -0,0 +1,94 @@
+"""
+Compares requests per second on the borrow list between simplejwt's
+JWTAuthentication, which loads the user with a SELECT per request, and
+CachedJWTAuthentication.
+
+    python -m benchmarks.jwt_auth --requests 2000
+
+Uses the configured cache: Redis when REDIS_URL is set, the local memory
+cache otherwise.
+"""
+
+import argparse
+import time
+from unittest.mock import patch
+
+from benchmarks.utils import report, setup_django, test_database
+
+
+def run(client, url, headers, requests):
+    from django.db import connection
+
+    def record(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    client.get(url, **headers)
+    # The test client resets connection.queries on every request, so the
+    # queries are counted by a wrapper instead.
+    queries = []
+    with connection.execute_wrapper(record):
+        client.get(url, **headers)
+    started = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(url, **headers)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.content
+    return {
+        "requests_per_s": round(requests / elapsed),
+        "ms_per_request": round(elapsed / requests * 1000, 3),
+        "queries_per_request": len(queries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth import get_user_model
+    from django.test import Client
+    from rest_framework.reverse import reverse
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from books.models import Book
+    from borrows.models import Borrow
+    from borrows.views import BorrowViewSet
+    from user.authentication import CachedJWTAuthentication
+
+    with test_database():
+        user = get_user_model().objects.create_user(
+            email="bench@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Book", author="Author", cover="Soft", inventory=10, daily_fee=1
+        )
+        Borrow.objects.bulk_create(
+            Borrow(
+                borrow_date="2024-01-01",
+                expected_return="2024-01-10",
+                book=book,
+                user=user,
+            )
+            for _ in range(5)
+        )
+        client = Client()
+        url = reverse("borrows:borrow-list") + "?fields=id&count=false"
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {AccessToken.for_user(user)}"}
+
+        results = {}
+        for name, authentication in (
+            ("JWTAuthentication", JWTAuthentication),
+            ("CachedJWTAuthentication", CachedJWTAuthentication),
+        ):
+            with patch.object(
+                BorrowViewSet, "authentication_classes", [authentication]
+            ):
+                results[name] = run(client, url, headers, args.requests)
+        report(f"GET {url} ({args.requests} requests)", results)
+
+
+if __name__ == "__main__":
+    main()
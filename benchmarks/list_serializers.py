@@ -0,0 +1,93 @@
+"""
+Compares rendering list pages with BookListSerializer/BorrowListSerializer
+against the values() fast path, per 1,000 rows, including the queries.
+
+    python -m benchmarks.list_serializers --rows 1000
+"""
+
+import argparse
+import datetime
+
+from benchmarks.utils import measure, report, setup_django, test_database
+
+
+def populate(rows):
+    from django.contrib.auth import get_user_model
+
+    from books.models import Book
+    from borrows.models import Borrow
+    from payments.models import Payment
+
+    user = get_user_model().objects.create(email="bench@mail.com")
+    books = Book.objects.bulk_create(
+        Book(
+            title=f"Book {number}",
+            author=f"Author {number % 50}",
+            cover="Hard",
+            inventory=number % 20,
+            daily_fee="1.50",
+        )
+        for number in range(rows)
+    )
+    today = datetime.date.today()
+    borrows = Borrow.objects.bulk_create(
+        Borrow(
+            borrow_date=today,
+            expected_return=today + datetime.timedelta(days=7),
+            book=book,
+            user=user,
+        )
+        for book in books
+    )
+    Payment.objects.bulk_create(
+        Payment(
+            status=Payment.StatusChoices.PENDING,
+            type=Payment.TypeChoices.PAYMENT,
+            borrowing=borrow,
+            money_to_pay="10.50",
+        )
+        for borrow in borrows
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from books.models import Book
+    from books.serializers import BookListSerializer
+    from borrows.models import Borrow
+    from borrows.serializers import BorrowListSerializer
+    from library_project_final.fastpath import compile_mapper
+    from library_project_final.fieldsets import queryset_for_serializer
+
+    with test_database():
+        populate(args.rows)
+
+        results = {}
+        for name, model, serializer_class in (
+            ("books", Book, BookListSerializer),
+            ("borrows", Borrow, BorrowListSerializer),
+        ):
+            queryset = model.objects.order_by("id")
+            serializer = serializer_class()
+            optimized = queryset_for_serializer(queryset, serializer)
+            mapper = compile_mapper(serializer)
+
+            drf = measure(
+                lambda: serializer_class(optimized, many=True).data, args.repeat
+            )
+            fast = measure(lambda: mapper.render(mapper.values(queryset)), args.repeat)
+            results[f"{name} serializer"] = drf
+            results[f"{name} values() fast path"] = {
+                **fast,
+                "speedup": round(drf["median_ms"] / fast["median_ms"], 1),
+            }
+        report(f"List rendering, {args.rows} rows", results)
+
+
+if __name__ == "__main__":
+    main()
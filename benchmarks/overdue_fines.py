@@ -0,0 +1,127 @@
+"""
+Times the nightly fine run over many overdue borrowings against
+computing and saving each fine in Python, one borrowing at a time.
+
+    python -m benchmarks.overdue_fines --borrows 100000
+"""
+
+import argparse
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from benchmarks.utils import report, setup_django, test_database
+
+
+def create_borrowings(count, today):
+    from django.contrib.auth import get_user_model
+
+    from books.models import Book
+    from borrows.models import Borrow
+
+    user = get_user_model().objects.create_user(
+        email="bench@mail.com", password="password"
+    )
+    books = Book.objects.bulk_create(
+        Book(
+            title=f"Book {number}",
+            author="Author",
+            cover="Soft",
+            inventory=10,
+            daily_fee=Decimal("1.25") + number,
+        )
+        for number in range(100)
+    )
+    Borrow.objects.bulk_create(
+        (
+            Borrow(
+                borrow_date=today - timedelta(days=40),
+                expected_return=today - timedelta(days=1 + number % 30),
+                book=books[number % len(books)],
+                user=user,
+            )
+            for number in range(count)
+        ),
+        batch_size=5000,
+    )
+
+
+def timed(func):
+    started = time.perf_counter()
+    created, updated = func()
+    return {
+        "seconds": round(time.perf_counter() - started, 2),
+        "created": created,
+        "updated": updated,
+    }
+
+
+def run_one_by_one(limit, today):
+    from borrows.models import Borrow
+    from payments.helper import FINE_MULTIPLIER
+    from payments.models import Payment, PaymentOutbox
+
+    def fine_each():
+        overdue = Borrow.objects.filter(
+            actual_return__isnull=True, expected_return__lt=today
+        ).select_related("book")[:limit]
+        for borrow in overdue:
+            days = (today - borrow.expected_return).days
+            payment = Payment.objects.create(
+                status=Payment.StatusChoices.PENDING,
+                type=Payment.TypeChoices.FINE,
+                borrowing=borrow,
+                money_to_pay=days * borrow.book.daily_fee * FINE_MULTIPLIER,
+            )
+            PaymentOutbox.objects.create(payment=payment)
+        return limit, 0
+
+    return timed(fine_each)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--borrows", type=int, default=100000)
+    parser.add_argument("--baseline-borrows", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.utils import timezone
+
+    from borrows.models import Borrow
+    from payments.helper import sync_overdue_fines
+    from payments.models import Payment
+
+    today = timezone.now().date()
+
+    def overdue(day):
+        return Borrow.objects.filter(
+            actual_return__isnull=True, expected_return__lt=day
+        )
+
+    # Handing the new fines to a worker is not part of the run being timed.
+    with test_database(), patch("payments.helper.schedule_payment_outbox"):
+        create_borrowings(args.borrows, today)
+        results = {"one by one": run_one_by_one(args.baseline_borrows, today)}
+        Payment.objects.all().delete()
+
+        tomorrow = today + timedelta(days=1)
+        results["first night"] = timed(
+            lambda: sync_overdue_fines(overdue(today), today)
+        )
+        results["next night"] = timed(
+            lambda: sync_overdue_fines(overdue(tomorrow), tomorrow)
+        )
+        results["rerun"] = timed(
+            lambda: sync_overdue_fines(overdue(tomorrow), tomorrow)
+        )
+        report(
+            f"Overdue fines ({args.baseline_borrows} one by one, "
+            f"{args.borrows} in bulk)",
+            results,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Measures login throughput and book catalog latency while many clients
+log in at once, with different numbers of hashing slots. Logins that find
+no free slot are turned away with a 503 and counted as rejected.
+
+    python -m benchmarks.password_hashing --clients 16 --slots 1 2 16
+
+Pass --iterations to compare work factors as well.
+"""
+
+import argparse
+import os
+import threading
+import time
+from unittest.mock import patch
+
+from benchmarks.utils import measure, report, setup_django, test_database
+
+
+def log_in(url, stop, counts, rejected):
+    from django.db import connection
+    from django.test import Client
+
+    client = Client()
+    payload = {"email": "bench@mail.com", "password": "password"}
+    try:
+        while not stop.is_set():
+            response = client.post(url, payload)
+            if response.status_code == 503:
+                rejected.append(1)
+                time.sleep(float(response["Retry-After"]) / 10)
+                continue
+            assert response.status_code == 200, response.content
+            counts.append(1)
+    finally:
+        connection.close()
+
+
+def run(slots, clients, catalog, repeat):
+    from rest_framework.reverse import reverse
+
+    from user.hashers import HashingSlots
+
+    stop = threading.Event()
+    counts = []
+    rejected = []
+    url = reverse("user:token_obtain_pair")
+    threads = [
+        threading.Thread(target=log_in, args=(url, stop, counts, rejected))
+        for _ in range(clients)
+    ]
+    with patch("user.hashers.hashing_slots", HashingSlots(slots)):
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            result = measure(catalog, repeat)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - started
+    result["logins_per_s"] = round(len(counts) / elapsed, 1)
+    result["rejected_per_s"] = round(len(rejected) / elapsed, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--slots", type=int, nargs="+", default=[1, 2, 16])
+    parser.add_argument("--iterations", type=int, nargs="+")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.test import Client, override_settings
+    from rest_framework.reverse import reverse
+
+    from books.models import Book
+    from user.views import TokenObtainPairView
+
+    iterations = args.iterations or [settings.PASSWORD_HASH_ITERATIONS]
+    with test_database(), patch.object(TokenObtainPairView, "throttle_classes", ()):
+        Book.objects.bulk_create(
+            Book(
+                title=f"Book {number}",
+                author="Author",
+                cover="Soft",
+                inventory=10,
+                daily_fee=1,
+            )
+            for number in range(20)
+        )
+        client = Client()
+        url = reverse("books:book-list")
+
+        def catalog():
+            assert client.get(url).status_code == 200
+
+        results = {"catalog, no logins": measure(catalog, args.repeat)}
+        for count in iterations:
+            with override_settings(PASSWORD_HASH_ITERATIONS=count):
+                get_user_model().objects.filter(email="bench@mail.com").delete()
+                get_user_model().objects.create_user(
+                    email="bench@mail.com", password="password"
+                )
+                for slots in args.slots:
+                    results[f"{count} iterations, {slots} slots"] = run(
+                        slots, args.clients, catalog, args.repeat
+                    )
+        report(
+            f"GET {url} while {args.clients} clients log in "
+            f"({os.cpu_count()} CPUs)",
+            results,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Load test of the development server against the production profile.
+Starts each server on a throwaway SQLite database, then has concurrent
+clients fetch the book list and a static file for a fixed time.
+
+    python -m benchmarks.server_load --clients 16 --seconds 10
+
+Needs gunicorn, whitenoise and uvicorn-worker from requirements.txt.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks.utils import report
+
+SEED = """
+from books.models import Book
+Book.objects.bulk_create(
+    Book(title=f"Book {n}", author="Author", cover="Soft", inventory=5, daily_fee=1)
+    for n in range(50)
+)
+"""
+
+PATHS = ["/api/books/", "/static/rest_framework/css/bootstrap.min.css"]
+
+
+def manage(env, *args):
+    subprocess.run(
+        [sys.executable, "manage.py", *args],
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait_until_up(url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            requests.get(url, timeout=5)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start within {timeout}s")
+
+
+def load(base_url, clients, seconds):
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    sent = []
+
+    def client():
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "br, gzip"
+        count = 0
+        while not stop.is_set():
+            path = PATHS[count % len(PATHS)]
+            count += 1
+            started = time.perf_counter()
+            try:
+                response = session.get(base_url + path, timeout=30)
+            except requests.RequestException:
+                errors.append(path)
+                continue
+            latencies.append(time.perf_counter() - started)
+            # Bytes on the wire, before requests decompresses the body.
+            sent.append(
+                int(response.headers.get("Content-Length", len(response.content)))
+            )
+            if response.status_code != 200:
+                errors.append(path)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "requests_per_s": round(len(latencies) / seconds),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        "kb_per_response": round(statistics.mean(sent) / 1024, 1),
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "SECRET_KEY": "benchmark",
+            "SQLITE_PATH": os.path.join(directory, "db.sqlite3"),
+            "STATIC_ROOT": os.path.join(directory, "static"),
+            "ALLOWED_HOSTS": "127.0.0.1",
+        }
+        production = {
+            **env,
+            "DJANGO_SETTINGS_MODULE": "library_project_final.settings_production",
+            "GUNICORN_BIND": f"127.0.0.1:{args.port}",
+        }
+        manage(env, "migrate")
+        manage(env, "shell", "-c", SEED)
+        manage(production, "collectstatic", "--noinput")
+
+        servers = {
+            "runserver, DEBUG": (
+                [
+                    sys.executable,
+                    "manage.py",
+                    "runserver",
+                    "--noreload",
+                    f"127.0.0.1:{args.port}",
+                ],
+                {
+                    **env,
+                    "DJANGO_SETTINGS_MODULE": "library_project_final.settings",
+                    "DEBUG": "true",
+                },
+            ),
+            "gunicorn, WSGI": (
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "-c",
+                    "gunicorn.conf.py",
+                    "library_project_final.wsgi",
+                ],
+                production,
+            ),
+            "gunicorn + uvicorn, ASGI": (
+                [
+                    sys.executable,
+                    "-m",
+                    "gunicorn",
+                    "-c",
+                    "gunicorn.conf.py",
+                    "library_project_final.asgi:application",
+                ],
+                {**production, "GUNICORN_WORKER_CLASS": "uvicorn_worker.UvicornWorker"},
+            ),
+        }
+
+        results = {}
+        base_url = f"http://127.0.0.1:{args.port}"
+        for name, (command, server_env) in servers.items():
+            server = subprocess.Popen(
+                command,
+                env=server_env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_until_up(base_url + PATHS[0], server)
+                results[name] = load(base_url, args.clients, args.seconds)
+            finally:
+                server.terminate()
+                server.wait()
+
+    report(
+        f"GET {', '.join(PATHS)} from {args.clients} clients for "
+        f"{args.seconds:g}s ({os.cpu_count()} CPUs)",
+        results,
+    )
+
+
+if __name__ == "__main__":
+    main()
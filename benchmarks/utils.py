@@ -0,0 +1,56 @@
+"""
+Shared helpers for the benchmark scripts. Each script is run as a module
+from the project root, e.g. `python -m benchmarks.book_search`, and works
+on a throwaway test database.
+"""
+
+import os
+import statistics
+import time
+from contextlib import contextmanager
+
+import django
+
+
+def setup_django():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "library_project_final.settings")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from django.test.runner import DiscoverRunner
+
+    runner = DiscoverRunner(verbosity=0)
+    setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+
+def measure(func, repeat=20):
+    """
+    Calls `func` `repeat` times and returns timings in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "max_ms": round(max(timings), 3),
+    }
+
+
+def report(title, results):
+    print(title)
+    for name, result in results.items():
+        details = ", ".join(f"{key}={value}" for key, value in result.items())
+        print(f"  {name:<32} {details}")
@@ -0,0 +1,125 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = "books:catalog:version"
+CATALOG_MODIFIED_KEY = "books:catalog:modified"
+RESPONSE_TIMEOUT = 60 * 15
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2.0
+LOCK_POLL_INTERVAL = 0.05
+
+
+def _new_version():
+    # Time based, so a version lost from the cache is never reused for
+    # entries that were cached under it before.
+    return time.time_ns() // 1000
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _new_version(), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def get_catalog_modified():
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        modified = int(time.time())
+        cache.add(CATALOG_MODIFIED_KEY, modified, None)
+    return modified
+
+
+def _bump():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_VERSION_KEY, _new_version(), None)
+    cache.set(CATALOG_MODIFIED_KEY, int(time.time()), None)
+
+
+def bump_catalog_version():
+    """
+    Invalidates every cached catalog response. Bumps right away and again
+    on commit, so nothing cached while the transaction is open survives it.
+    """
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def _is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [
+            tag.strip() for tag in if_none_match.split(",")
+        ]
+    if_modified_since = parse_http_date_safe(
+        request.META.get("HTTP_IF_MODIFIED_SINCE", "")
+    )
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def _set_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Cache-Control"] = "public, no-cache"
+    return response
+
+
+def _render_once(key, render):
+    """
+    Renders a missing entry in one request only. Concurrent requests for
+    the same key wait for that result instead of querying the database.
+    """
+    lock_key = f"{key}:lock"
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            response = render()
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, RESPONSE_TIMEOUT)
+            return response
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+    return render()
+
+
+def cached_catalog_response(request, render):
+    """
+    Serves a catalog response from the cache, keyed by catalog version and
+    URL, and answers conditional requests with 304 Not Modified.
+    """
+    version = get_catalog_version()
+    last_modified = get_catalog_modified()
+    url = request.build_absolute_uri()
+    digest = hashlib.md5(url.encode(), usedforsecurity=False).hexdigest()
+    etag = f'W/"{version}-{digest}"'
+
+    if _is_not_modified(request, etag, last_modified):
+        return _set_validators(
+            Response(status=status.HTTP_304_NOT_MODIFIED), etag, last_modified
+        )
+
+    key = f"books:catalog:{version}:{digest}"
+    data = cache.get(key)
+    if data is not None:
+        response = Response(data)
+    else:
+        response = _render_once(key, render)
+
+    if response.status_code != status.HTTP_200_OK:
+        return response
+    return _set_validators(response, etag, last_modified)
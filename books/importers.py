@@ -0,0 +1,157 @@
+import codecs
+import csv
+import json
+from itertools import count, islice
+
+from django.core.management.color import no_style
+from django.db import DatabaseError, connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from books.cache import bump_catalog_version
+from books.models import Book
+from books.serializers import BookImportSerializer
+
+CSV = "csv"
+JSONL = "jsonl"
+FORMATS = (CSV, JSONL)
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+MAX_ERRORS_PER_BATCH = 50
+UPDATE_FIELDS = ("title", "author", "cover", "inventory", "daily_fee")
+
+
+def decode_lines(stream, encoding="utf-8"):
+    """
+    Decodes an iterable of byte lines (a file, an upload or the request
+    body) lazily, one line at a time.
+    """
+    return codecs.iterdecode(stream, encoding)
+
+
+def read_rows(lines, file_format):
+    """
+    Yields (row, error) pairs from CSV or JSON Lines input. `row` is None
+    when the line itself could not be parsed.
+    """
+    if file_format == CSV:
+        for row in csv.DictReader(lines):
+            yield row, None
+        return
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield None, f"Invalid JSON: {error}"
+            continue
+        if isinstance(row, dict):
+            yield row, None
+        else:
+            yield None, "Each line must be a JSON object."
+
+
+def _write_batch(books):
+    with transaction.atomic():
+        Book.objects.bulk_create(
+            books,
+            batch_size=len(books),
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=UPDATE_FIELDS,
+        )
+
+
+def _reset_id_sequence():
+    # Explicit ids do not advance PostgreSQL sequences.
+    statements = connection.ops.sequence_reset_sql(no_style(), [Book])
+    if statements:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+def _read_batch(numbered, batch_size):
+    """
+    Returns the next `batch_size` numbered rows and the error that stopped
+    the input early, if its bytes could not be decoded or parsed.
+    """
+    batch = []
+    try:
+        for item in islice(numbered, batch_size):
+            batch.append(item)
+    except (UnicodeDecodeError, csv.Error) as error:
+        return batch, f"Input could not be read: {error}"
+    return batch, None
+
+
+def import_books(rows, batch_size=DEFAULT_BATCH_SIZE, on_batch=None):
+    """
+    Validates and upserts books from (row, error) pairs in batches of
+    `batch_size`, each batch in its own transaction. Memory use does not
+    depend on the input size. A batch the database rejects is rolled back
+    and reported as failed with its `error`; the others are still written.
+    Input that cannot be decoded ends the import with a failed row after
+    the rows read so far. Returns a summary with per-batch reports; `on_batch` is called with
+    every batch report as soon as it is written.
+    """
+    serializer = BookImportSerializer()
+    numbered = enumerate(rows, start=1)
+    summary = {"rows": 0, "written": 0, "failed": 0, "batches": []}
+    explicit_ids = False
+
+    for number in count(1):
+        batch, read_error = _read_batch(numbered, batch_size)
+        if not batch and read_error is None:
+            break
+
+        # Keyed by id, so that of several rows for one book the last one
+        # wins, as if they were written in order; an upsert cannot touch
+        # a row twice.
+        books = {}
+        errors = []
+        for row_number, (row, error) in batch:
+            if error is None:
+                try:
+                    book = Book(**serializer.run_validation(row))
+                except ValidationError as validation_error:
+                    error = validation_error.detail
+                else:
+                    books[("id", book.id) if book.id else row_number] = book
+                    continue
+            errors.append({"row": row_number, "errors": error})
+        rows = len(batch)
+        if read_error is not None:
+            rows += 1
+            errors.append({"row": summary["rows"] + rows, "errors": read_error})
+
+        report = {
+            "batch": number,
+            "rows": rows,
+            "written": rows - len(errors),
+            "failed": len(errors),
+            "errors": errors[:MAX_ERRORS_PER_BATCH],
+        }
+        if books:
+            try:
+                _write_batch(list(books.values()))
+            except DatabaseError as error:
+                report.update(written=0, failed=rows, error=str(error))
+            else:
+                explicit_ids = explicit_ids or any(book.id for book in books.values())
+
+        summary["rows"] += report["rows"]
+        summary["written"] += report["written"]
+        summary["failed"] += report["failed"]
+        summary["batches"].append(report)
+        if on_batch is not None:
+            on_batch(report)
+        if read_error is not None:
+            break
+
+    if explicit_ids:
+        _reset_id_sequence()
+    if summary["written"]:
+        bump_catalog_version()
+    return summary
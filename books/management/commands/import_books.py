@@ -0,0 +1,65 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books.importers import (
+    CSV,
+    DEFAULT_BATCH_SIZE,
+    FORMATS,
+    JSONL,
+    decode_lines,
+    import_books,
+    read_rows,
+)
+
+
+class Command(BaseCommand):
+    help = "Imports books from a CSV or JSON Lines file in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to import, or - for stdin.")
+        parser.add_argument(
+            "--format",
+            dest="file_format",
+            choices=FORMATS,
+            help="Input format. Guessed from the file extension by default.",
+        )
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument("--encoding", default="utf-8")
+
+    def _guess_format(self, path):
+        if path.endswith(".csv"):
+            return CSV
+        if path.endswith((".jsonl", ".ndjson")):
+            return JSONL
+        raise CommandError("Cannot guess the input format, pass --format.")
+
+    def _print_batch(self, report):
+        self.stdout.write(
+            f"Batch {report['batch']}: {report['written']} written, "
+            f"{report['failed']} failed"
+        )
+        if "error" in report:
+            self.stderr.write(f"  Batch not written: {report['error']}")
+        for error in report["errors"]:
+            self.stderr.write(f"  Row {error['row']}: {error['errors']}")
+
+    def handle(self, *args, path, file_format, batch_size, encoding, **options):
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive.")
+        file_format = file_format or self._guess_format(path)
+
+        stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+        with stream:
+            summary = import_books(
+                read_rows(decode_lines(stream, encoding), file_format),
+                batch_size=batch_size,
+                on_batch=self._print_batch,
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {summary['written']} of {summary['rows']} rows, "
+                f"{summary['failed']} failed."
+            )
+        )
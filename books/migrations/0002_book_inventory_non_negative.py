@@ -0,0 +1,20 @@
+# Generated by Django 5.0.4 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="book",
+            constraint=models.CheckConstraint(
+                check=models.Q(("inventory__gte", 0)),
+                name="book_inventory_non_negative",
+            ),
+        ),
+    ]
@@ -0,0 +1,108 @@
+# Generated by Django 5.0.4 on 2026-10-18 09:34
+
+import books.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE books_book_fts USING fts5(
+        title,
+        author,
+        content='books_book',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER books_book_fts_insert AFTER INSERT ON books_book BEGIN
+        INSERT INTO books_book_fts(rowid, title, author)
+        VALUES (new.id, new.title, new.author);
+    END
+    """,
+    """
+    CREATE TRIGGER books_book_fts_delete AFTER DELETE ON books_book BEGIN
+        INSERT INTO books_book_fts(books_book_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+    END
+    """,
+    """
+    CREATE TRIGGER books_book_fts_update AFTER UPDATE OF title, author ON books_book
+    BEGIN
+        INSERT INTO books_book_fts(books_book_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO books_book_fts(rowid, title, author)
+        VALUES (new.id, new.title, new.author);
+    END
+    """,
+    "INSERT INTO books_book_fts(books_book_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS books_book_fts_insert",
+    "DROP TRIGGER IF EXISTS books_book_fts_delete",
+    "DROP TRIGGER IF EXISTS books_book_fts_update",
+    "DROP TABLE IF EXISTS books_book_fts",
+]
+
+POSTGRESQL_FORWARD = [
+    """
+    CREATE INDEX books_book_search_idx ON books_book
+    USING GIN (to_tsvector('simple', "title" || ' ' || "author"))
+    """,
+]
+
+POSTGRESQL_BACKWARD = [
+    "DROP INDEX IF EXISTS books_book_search_idx",
+]
+
+
+def run_statements(statements):
+    def run(apps, schema_editor):
+        vendor_statements = statements.get(schema_editor.connection.vendor, [])
+        for statement in vendor_statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0002_book_inventory_non_negative"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookSearch",
+            fields=[
+                (
+                    "book",
+                    models.OneToOneField(
+                        db_column="rowid",
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="search",
+                        serialize=False,
+                        to="books.book",
+                    ),
+                ),
+                ("document", books.models.FullTextField(db_column="books_book_fts")),
+                ("title", models.TextField()),
+                ("author", models.TextField()),
+                ("rank", models.FloatField()),
+            ],
+            options={
+                "db_table": "books_book_fts",
+                "managed": False,
+            },
+        ),
+        migrations.RunPython(
+            run_statements(
+                {"sqlite": SQLITE_FORWARD, "postgresql": POSTGRESQL_FORWARD}
+            ),
+            run_statements(
+                {"sqlite": SQLITE_BACKWARD, "postgresql": POSTGRESQL_BACKWARD}
+            ),
+        ),
+    ]
@@ -1,4 +1,37 @@
 from django.db import models
+from django.db.models import F, Lookup, Q
+
+from books.cache import bump_catalog_version
+
+
+class BookQuerySet(models.QuerySet):
+    """
+    Inventory writes go through single UPDATE statements, which send no
+    signals, so these methods invalidate the catalog cache themselves.
+    """
+
+    def take_copy(self, book_id) -> bool:
+        """
+        Decrements the inventory in a single conditional UPDATE.
+        Returns False when no copy is left.
+        """
+        taken = bool(
+            self.filter(pk=book_id, inventory__gt=0).update(
+                inventory=F("inventory") - 1
+            )
+        )
+        if taken:
+            bump_catalog_version()
+        return taken
+
+    def return_copy(self, book_id) -> bool:
+        """
+        Increments the inventory in a single UPDATE.
+        """
+        returned = bool(self.filter(pk=book_id).update(inventory=F("inventory") + 1))
+        if returned:
+            bump_catalog_version()
+        return returned
 
 
 class Book(models.Model):
@@ -12,5 +45,55 @@ class Book(models.Model):
     inventory = models.IntegerField()
     daily_fee = models.DecimalField(max_digits=8, decimal_places=2)
 
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=Q(inventory__gte=0), name="book_inventory_non_negative"
+            ),
+        ]
+
     def __str__(self) -> str:
         return self.title
+
+
+class FullTextField(models.TextField):
+    """
+    The hidden FTS5 column that carries the table name; it only supports
+    the `match` lookup.
+    """
+
+
+@FullTextField.register_lookup
+class FullTextMatch(Lookup):
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", [*lhs_params, *rhs_params]
+
+
+class BookSearch(models.Model):
+    """
+    SQLite FTS5 index over Book.title and Book.author. The table and the
+    triggers keeping it in sync are created by migration; PostgreSQL uses
+    a GIN index on books_book instead.
+    """
+
+    book = models.OneToOneField(
+        Book,
+        primary_key=True,
+        db_column="rowid",
+        on_delete=models.DO_NOTHING,
+        related_name="search",
+    )
+    document = FullTextField(db_column="books_book_fts")
+    title = models.TextField()
+    author = models.TextField()
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = "books_book_fts"
@@ -0,0 +1,65 @@
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+PG_SEARCH_CONFIG = "simple"
+# Must stay identical to the expression of the books_book_search_idx index.
+PG_SEARCH_VECTOR = (
+    f"to_tsvector('{PG_SEARCH_CONFIG}', "
+    '"books_book"."title" || \' \' || "books_book"."author")'
+)
+PG_SEARCH_QUERY = f"to_tsquery('{PG_SEARCH_CONFIG}', %s)"
+
+
+def _fts5_query(text):
+    """
+    Turns free text into an FTS5 query matching every word as a prefix,
+    so user input can never produce an FTS5 syntax error.
+    """
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def _pg_query(text):
+    """
+    The PostgreSQL counterpart of `_fts5_query`: every word as a prefix.
+    """
+    words = re.findall(r"\w+", text)
+    return " & ".join(f"{word}:*" for word in words)
+
+
+def search_books(queryset, text):
+    """
+    Filters books by title and author through the full-text index and
+    orders them by relevance.
+    """
+    if connection.vendor == "postgresql":
+        query = _pg_query(text)
+        if not query:
+            return queryset.none()
+        return (
+            queryset.filter(
+                RawSQL(
+                    f"{PG_SEARCH_VECTOR} @@ {PG_SEARCH_QUERY}",
+                    [query],
+                    output_field=BooleanField(),
+                )
+            )
+            .annotate(
+                # As double precision, so that the value a cursor carries
+                # compares equal to it again.
+                rank=RawSQL(
+                    f"ts_rank({PG_SEARCH_VECTOR}, {PG_SEARCH_QUERY})::float8",
+                    [query],
+                    output_field=FloatField(),
+                )
+            )
+            .order_by("-rank", "id")
+        )
+
+    query = _fts5_query(text)
+    if not query:
+        return queryset.none()
+    return queryset.filter(search__document__match=query).order_by("search__rank", "id")
@@ -1,9 +1,20 @@
 from rest_framework import serializers
 
 from books.models import Book
+from library_project_final.fieldsets import SparseFieldsetMixin
 
 
-class BookListSerializer(serializers.ModelSerializer):
+class BookListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Book
         fields = ("id", "title", "author", "cover", "inventory", "daily_fee")
+        extra_kwargs = {"inventory": {"min_value": 0}}
+
+
+class BookImportSerializer(BookListSerializer):
+    """
+    Validates one row of a bulk import. Rows that carry an id update the
+    existing book with that id instead of creating a new one.
+    """
+
+    id = serializers.IntegerField(required=False, min_value=1)
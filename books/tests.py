@@ -1,13 +1,28 @@
+import json
+import tempfile
+import threading
+from io import StringIO
+from unittest.mock import Mock, patch
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.reverse import reverse
 from rest_framework.test import APIClient
 
+from books import importers
+from books.cache import _render_once
 from books.models import Book
 from books.serializers import BookListSerializer
 
 BOOKS_URL = reverse("books:book-list")
+BULK_IMPORT_URL = reverse("books:book-bulk-import")
+EXPORT_URL = reverse("books:book-export")
 
 
 def sample_book(**params):
@@ -90,3 +105,522 @@ class AdminUserBookTests(TestCase):
         book = Book.objects.get(id=res.data["id"])
         for key in payload.keys():
             self.assertEqual(payload[key], getattr(book, key))
+
+
+class BookPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.books = [sample_book(title=f"Book {i}") for i in range(12)]
+
+    def _walk(self, url, params):
+        ids = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [book["id"] for book in response.data["results"]]
+            if not response.data["next"]:
+                return ids, response
+            response = self.client.get(response.data["next"])
+
+    def test_offset_pagination_is_the_default(self):
+        response = self.client.get(BOOKS_URL)
+
+        self.assertEqual(response.data["count"], 12)
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertIn("offset=5", response.data["next"])
+
+    def test_cursor_pagination_walks_all_books_in_id_order(self):
+        ids, response = self._walk(BOOKS_URL, {"pagination": "cursor", "page_size": 5})
+
+        self.assertEqual(ids, [book.id for book in self.books])
+        self.assertNotIn("count", response.data)
+
+    def test_cursor_page_size_is_capped(self):
+        response = self.client.get(
+            BOOKS_URL, {"pagination": "cursor", "page_size": 1000}
+        )
+
+        self.assertEqual(len(response.data["results"]), 12)
+        self.assertIsNone(response.data["next"])
+
+    def test_offset_limit_is_not_capped(self):
+        Book.objects.bulk_create(
+            Book(title="Book", author="Author", cover="Soft", inventory=1, daily_fee=1)
+            for _ in range(100)
+        )
+
+        response = self.client.get(BOOKS_URL, {"limit": 200})
+
+        self.assertEqual(len(response.data["results"]), 112)
+
+    def test_cursor_pagination_keeps_search_order(self):
+        for count in range(1, 4):
+            sample_book(title=" ".join(["Book"] * count), author="Book")
+        expected = self.client.get(BOOKS_URL, {"search": "book", "limit": 100})
+
+        ids, response = self._walk(
+            BOOKS_URL, {"pagination": "cursor", "page_size": 2, "search": "book"}
+        )
+
+        self.assertEqual(ids, [book["id"] for book in expected.data["results"]])
+        self.assertEqual(len(ids), 15)
+
+    def test_cursor_previous_link(self):
+        first = self.client.get(BOOKS_URL, {"pagination": "cursor", "page_size": 5})
+        second = self.client.get(first.data["next"])
+
+        previous = self.client.get(second.data["previous"])
+
+        self.assertEqual(previous.data["results"], first.data["results"])
+        self.assertIsNone(previous.data["previous"])
+        self.assertEqual(previous.data["next"], first.data["next"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(
+            BOOKS_URL, {"pagination": "cursor", "cursor": "not-a-cursor"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_offset_pagination_without_count(self):
+        with self.assertNumQueries(3):  # One query per page, no COUNT.
+            ids, response = self._walk(BOOKS_URL, {"count": "false", "limit": 5})
+
+        self.assertEqual(ids, [book.id for book in self.books])
+        self.assertIsNone(response.data["count"])
+
+
+class BookSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.potter = sample_book(title="Harry Potter", author="J. K. Rowling")
+        self.hobbit = sample_book(title="The Hobbit", author="J. R. R. Tolkien")
+        self.pots = sample_book(title="Pottery for Potters", author="Ann Potter")
+
+    def _search(self, text, **params):
+        response = self.client.get(BOOKS_URL, {"search": text, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book["id"] for book in response.data["results"]]
+
+    def test_search_matches_title_and_author(self):
+        self.assertEqual(self._search("tolkien"), [self.hobbit.id])
+        self.assertEqual(self._search("hobbit"), [self.hobbit.id])
+
+    def test_search_matches_word_prefixes(self):
+        self.assertCountEqual(self._search("pott"), [self.potter.id, self.pots.id])
+
+    def test_search_results_are_ranked(self):
+        self.assertEqual(self._search("potter")[0], self.pots.id)
+
+    def test_search_results_are_paginated(self):
+        response = self.client.get(BOOKS_URL, {"search": "potter", "limit": 1})
+
+        self.assertEqual(response.data["count"], 2)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertIsNotNone(response.data["next"])
+
+    def test_search_syntax_is_not_exposed(self):
+        self.assertEqual(self._search('" OR * NEAR('), [])
+        self.assertEqual(self._search("hobbit AND"), [])
+
+    def test_index_follows_create_update_and_delete(self):
+        book = sample_book(title="Dune", author="Frank Herbert")
+        self.assertEqual(self._search("dune"), [book.id])
+
+        book.title = "Children of Dune"
+        book.save()
+        self.assertEqual(self._search("children"), [book.id])
+
+        Book.objects.filter(pk=book.pk).update(author="F. Herbert")
+        self.assertEqual(self._search("herbert children"), [book.id])
+
+        book.delete()
+        self.assertEqual(self._search("dune"), [])
+
+    def test_inventory_changes_keep_the_index_intact(self):
+        Book.objects.take_copy(self.hobbit.id)
+
+        self.assertEqual(self._search("hobbit"), [self.hobbit.id])
+
+
+class BookCatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.book = sample_book()
+
+    def test_repeated_list_is_served_from_cache(self):
+        first = self.client.get(BOOKS_URL)
+        with self.assertNumQueries(0):
+            second = self.client.get(BOOKS_URL)
+
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second["ETag"], first["ETag"])
+
+    def test_matching_etag_returns_not_modified(self):
+        etag = self.client.get(BOOKS_URL)["ETag"]
+
+        with self.assertNumQueries(0):
+            response = self.client.get(BOOKS_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_if_modified_since_returns_not_modified(self):
+        last_modified = self.client.get(BOOKS_URL)["Last-Modified"]
+
+        response = self.client.get(BOOKS_URL, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_book_write_invalidates_the_cache(self):
+        etag = self.client.get(BOOKS_URL)["ETag"]
+
+        sample_book(title="New")
+        response = self.client.get(BOOKS_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 2)
+
+    def test_inventory_change_invalidates_the_cache(self):
+        url = reverse("books:book-detail", kwargs={"pk": self.book.pk})
+        self.client.get(url)
+
+        Book.objects.take_copy(self.book.id)
+
+        self.assertEqual(self.client.get(url).data["inventory"], 22)
+
+    def test_missing_book_is_not_cached(self):
+        url = reverse("books:book-detail", kwargs={"pk": self.book.pk + 1})
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn("ETag", response)
+
+    def test_concurrent_miss_waits_for_the_first_render(self):
+        key = "books:catalog:test"
+        cache.add(f"{key}:lock", 1)
+        render = Mock()
+        threading.Timer(0.1, cache.set, (key, {"results": []})).start()
+
+        response = _render_once(key, render)
+
+        render.assert_not_called()
+        self.assertEqual(response.data, {"results": []})
+
+
+class BookImportTests(TestCase):
+    CSV_HEADER = "title,author,cover,inventory,daily_fee\n"
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.admin_user)
+
+    def _csv(self, count):
+        return self.CSV_HEADER + "".join(
+            f"Book {i},Author {i},Soft,{i},1.50\n" for i in range(count)
+        )
+
+    def test_import_csv_body(self):
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL, self._csv(25), content_type="text/csv"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["written"], 25)
+        self.assertEqual(Book.objects.count(), 25)
+
+    def test_import_jsonl_upload_upserts_by_id(self):
+        book = sample_book(title="Old title")
+        lines = [
+            {
+                "id": book.id,
+                "title": "New title",
+                "author": "Name",
+                "cover": "Hard",
+                "inventory": 3,
+                "daily_fee": "2.00",
+            },
+            {
+                "title": "Fresh",
+                "author": "Name",
+                "cover": "Soft",
+                "inventory": 1,
+                "daily_fee": "1.00",
+            },
+        ]
+        upload = SimpleUploadedFile(
+            "books.jsonl", "\n".join(json.dumps(line) for line in lines).encode()
+        )
+
+        response = self.client.post(BULK_IMPORT_URL, {"file": upload})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Book.objects.count(), 2)
+        book.refresh_from_db()
+        self.assertEqual(book.title, "New title")
+        self.assertEqual(book.inventory, 3)
+        self.assertGreater(
+            Book.objects.create(
+                title="Next", author="Name", cover="Hard", inventory=1, daily_fee=1
+            ).id,
+            book.id,
+        )
+
+    def test_invalid_rows_are_reported_per_batch(self):
+        body = self.CSV_HEADER + (
+            "Good,Author,Hard,1,1.00\n"
+            "Bad cover,Author,Paper,1,1.00\n"
+            "Negative,Author,Hard,-1,1.00\n"
+        )
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL, body, content_type="text/csv"
+        )
+
+        self.assertEqual(response.data["written"], 1)
+        self.assertEqual(response.data["failed"], 2)
+        errors = response.data["batches"][0]["errors"]
+        self.assertEqual([error["row"] for error in errors], [2, 3])
+        self.assertIn("cover", errors[0]["errors"])
+        self.assertIn("inventory", errors[1]["errors"])
+        self.assertEqual(Book.objects.count(), 1)
+
+    def test_last_row_wins_for_an_id_repeated_in_a_batch(self):
+        book = sample_book(title="Old title")
+        body = self.CSV_HEADER.replace("title", "id,title", 1) + (
+            f"{book.id},First,Author,Hard,1,1.00\n"
+            f"{book.id},Second,Author,Hard,2,1.00\n"
+        )
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL, body, content_type="text/csv"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["written"], 2)
+        book.refresh_from_db()
+        self.assertEqual((book.title, book.inventory), ("Second", 2))
+        self.assertEqual(Book.objects.count(), 1)
+
+    def test_batch_rejected_by_the_database_is_reported(self):
+        write_batch = importers._write_batch
+        calls = []
+
+        def fail_second_batch(books):
+            calls.append(books)
+            if len(calls) == 2:
+                raise DatabaseError("boom")
+            write_batch(books)
+
+        with patch("books.importers._write_batch", fail_second_batch):
+            response = self.client.generic(
+                "POST",
+                BULK_IMPORT_URL + "?batch_size=2",
+                self._csv(5),
+                content_type="text/csv",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["written"], response.data["failed"]), (3, 2))
+        self.assertEqual(response.data["batches"][1]["error"], "boom")
+        self.assertEqual(Book.objects.count(), 3)
+
+    def test_batch_size_parameter(self):
+        response = self.client.generic(
+            "POST",
+            BULK_IMPORT_URL + "?batch_size=2",
+            self._csv(5),
+            content_type="text/csv",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [batch["rows"] for batch in response.data["batches"]], [2, 2, 1]
+        )
+
+        for value in ("0", "x", str(importers.MAX_BATCH_SIZE + 1)):
+            response = self.client.generic(
+                "POST",
+                f"{BULK_IMPORT_URL}?batch_size={value}",
+                self._csv(1),
+                content_type="text/csv",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("batch_size", response.data)
+        self.assertEqual(Book.objects.count(), 5)
+
+    def test_malformed_json_line_is_reported(self):
+        response = self.client.generic(
+            "POST",
+            BULK_IMPORT_URL,
+            "{not json}\n[]\n",
+            content_type="application/x-ndjson",
+        )
+
+        self.assertEqual(response.data["failed"], 2)
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_undecodable_input_is_reported(self):
+        body = self._csv(3).encode() + b"\xff\xfe,Author,Soft,1,1.00\n"
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL + "?batch_size=2", body, content_type="text/csv"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["written"], response.data["failed"]), (3, 1))
+        self.assertEqual(response.data["batches"][1]["errors"][0]["row"], 4)
+        self.assertEqual(Book.objects.count(), 3)
+
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL, b"\xff\xfe", content_type="text/csv"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["failed"], 1)
+
+    def test_unsupported_media_type(self):
+        response = self.client.post(BULK_IMPORT_URL, {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_import_requires_admin(self):
+        user = get_user_model().objects.create_user(
+            email="user@mail.com", password="password"
+        )
+        self.client.force_authenticate(user)
+        response = self.client.generic(
+            "POST", BULK_IMPORT_URL, self._csv(1), content_type="text/csv"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_import_invalidates_catalog_cache(self):
+        etag = self.client.get(BOOKS_URL)["ETag"]
+        self.client.generic(
+            "POST", BULK_IMPORT_URL, self._csv(1), content_type="text/csv"
+        )
+
+        response = self.client.get(BOOKS_URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 1)
+
+    def test_import_books_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as file:
+            file.write(self._csv(7) + "Broken,Author,Hard,x,1.00\n")
+            file.flush()
+            out, err = StringIO(), StringIO()
+            call_command(
+                "import_books", file.name, batch_size=3, stdout=out, stderr=err
+            )
+
+        self.assertEqual(Book.objects.count(), 7)
+        self.assertIn("Batch 3: 1 written, 1 failed", out.getvalue())
+        self.assertIn("Imported 7 of 8 rows, 1 failed.", out.getvalue())
+        self.assertIn("Row 8", err.getvalue())
+
+
+class BookExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.admin_user)
+        self.books = [
+            sample_book(title=f"Book {i}", daily_fee="1.25") for i in range(3)
+        ]
+
+    def _content(self, response):
+        return b"".join(response.streaming_content).decode()
+
+    def test_export_csv(self):
+        response = self.client.get(EXPORT_URL)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        self.assertIn('filename="books.csv"', response["Content-Disposition"])
+        lines = self._content(response).splitlines()
+        self.assertEqual(lines[0], "id,title,author,cover,inventory,daily_fee")
+        self.assertEqual(lines[1], f"{self.books[0].id},Book 0,Name,Hard,23,1.25")
+        self.assertEqual(len(lines), 4)
+
+    def test_export_jsonl(self):
+        response = self.client.get(EXPORT_URL, {"output": "jsonl"})
+
+        rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [b.id for b in self.books])
+        self.assertEqual(rows[0]["daily_fee"], "1.25")
+
+    def test_export_reads_in_one_query(self):
+        response = self.client.get(EXPORT_URL)
+        with self.assertNumQueries(1):
+            self._content(response)
+
+    def test_invalid_output(self):
+        response = self.client.get(EXPORT_URL, {"output": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_requires_admin(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(
+            self.client.get(EXPORT_URL).status_code, status.HTTP_401_UNAUTHORIZED
+        )
+
+
+class BookSparseFieldsetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.book = sample_book()
+
+    def test_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(BOOKS_URL, {"fields": "id,title"})
+
+        self.assertEqual(
+            response.data["results"], [{"id": self.book.id, "title": "Sample"}]
+        )
+        self.assertNotIn("daily_fee", queries[-1]["sql"])
+
+    def test_fields_on_detail(self):
+        response = self.client.get(
+            reverse("books:book-detail", kwargs={"pk": self.book.pk}),
+            {"fields": "author"},
+        )
+        self.assertEqual(response.data, {"author": "Name"})
+
+
+class BookFastReadPathTests(TestCase):
+    """
+    The values() based list must render byte for byte what
+    BookListSerializer renders.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        sample_book(title='Potter, "the" boy', daily_fee="0.05")
+        sample_book(author="Ünïcode", cover="Soft", inventory=0, daily_fee=100)
+        sample_book(title="Hobbit", daily_fee="123456.78")
+
+    def _assert_same_content(self, **params):
+        with self.settings(FAST_READ_PATH=False):
+            cache.clear()
+            expected = self.client.get(BOOKS_URL, params)
+        with self.settings(FAST_READ_PATH=True):
+            cache.clear()
+            actual = self.client.get(BOOKS_URL, params)
+
+        self.assertEqual(expected.status_code, status.HTTP_200_OK)
+        self.assertEqual(actual.content, expected.content)
+
+    def test_list(self):
+        self._assert_same_content()
+        self._assert_same_content(limit=2, offset=1, count="false")
+        self._assert_same_content(pagination="cursor", page_size=2)
+
+    def test_fields_and_search(self):
+        self._assert_same_content(fields="daily_fee,title")
+        self._assert_same_content(search="potter hobbit")
+        self._assert_same_content(search="hobbit")
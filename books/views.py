@@ -1,11 +1,52 @@
+from functools import partial
+
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import UnsupportedMediaType, ValidationError
+from rest_framework.parsers import MultiPartParser
 from rest_framework.permissions import AllowAny, IsAdminUser
+from rest_framework.response import Response
 
+from books.cache import cached_catalog_response
+from books.importers import (
+    CSV,
+    DEFAULT_BATCH_SIZE,
+    JSONL,
+    MAX_BATCH_SIZE,
+    decode_lines,
+    import_books,
+    read_rows,
+)
 from books.models import Book
+from books.search import search_books
 from books.serializers import BookListSerializer
+from library_project_final.export import OUTPUT_PARAMETER, stream_export
+from library_project_final.fastpath import FastListMixin
+from library_project_final.fieldsets import FIELDSET_PARAMETERS, SparseQuerysetMixin
+
+IMPORT_MEDIA_TYPES = {
+    "text/csv": CSV,
+    "application/x-ndjson": JSONL,
+    "application/jsonl": JSONL,
+}
+IMPORT_EXTENSIONS = {".csv": CSV, ".jsonl": JSONL, ".ndjson": JSONL}
+EXPORT_COLUMNS = {
+    "id": "id",
+    "title": "title",
+    "author": "author",
+    "cover": "cover",
+    "inventory": "inventory",
+    "daily_fee": "daily_fee",
+}
 
 
-class BookListViewSet(viewsets.ModelViewSet):
+@extend_schema_view(
+    list=extend_schema(parameters=FIELDSET_PARAMETERS),
+    retrieve=extend_schema(parameters=FIELDSET_PARAMETERS),
+)
+class BookListViewSet(FastListMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows books to be viewed or edited.
     """
@@ -13,17 +54,128 @@ class BookListViewSet(viewsets.ModelViewSet):
     serializer_class = BookListSerializer
     queryset = Book.objects.all()
 
+    def get_queryset(self):
+        queryset = self.queryset
+
+        search = self.request.query_params.get("search")
+        if self.action == "list" and search:
+            queryset = search_books(queryset, search)
+
+        return queryset
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name="search",
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description="Full-text search over title and author, ranked by relevance",
+                required=False,
+            ),
+        ]
+    )
     def list(self, request, *args, **kwargs):
         """
         Returns a list of all the books.
         """
-        return super().list(request, *args, **kwargs)
+        return cached_catalog_response(
+            request, partial(super().list, request, *args, **kwargs)
+        )
 
     def retrieve(self, request, *args, **kwargs):
         """
         Retrieves a book by its ID.
         """
-        return super().retrieve(request, *args, **kwargs)
+        return cached_catalog_response(
+            request, partial(super().retrieve, request, *args, **kwargs)
+        )
+
+    def _import_source(self, request):
+        """
+        Returns the byte stream and format of an import: either an uploaded
+        `file` or a raw CSV/JSON Lines request body, which is read lazily.
+        """
+        if request.content_type.startswith("multipart/form-data"):
+            upload = request.FILES.get("file")
+            if upload is None:
+                raise ValidationError({"file": ["No file was submitted."]})
+            extension = upload.name[upload.name.rfind(".") :].lower()
+            file_format = IMPORT_MEDIA_TYPES.get(
+                upload.content_type, IMPORT_EXTENSIONS.get(extension)
+            )
+            if file_format is None:
+                raise ValidationError({"file": ["Upload a .csv or .jsonl file."]})
+            return upload, file_format
+
+        media_type = request.content_type.split(";")[0].strip()
+        if media_type not in IMPORT_MEDIA_TYPES:
+            raise UnsupportedMediaType(media_type)
+        return request.stream or [], IMPORT_MEDIA_TYPES[media_type]
+
+    @staticmethod
+    def _import_batch_size(request):
+        value = request.query_params.get("batch_size")
+        if value is None:
+            return DEFAULT_BATCH_SIZE
+        try:
+            batch_size = int(value)
+        except ValueError:
+            batch_size = 0
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValidationError(
+                {"batch_size": [f"Enter a whole number from 1 to {MAX_BATCH_SIZE}."]}
+            )
+        return batch_size
+
+    @extend_schema(
+        request={
+            "multipart/form-data": {
+                "type": "object",
+                "properties": {"file": {"type": "string", "format": "binary"}},
+            },
+            "text/csv": OpenApiTypes.STR,
+            "application/x-ndjson": OpenApiTypes.STR,
+        },
+        parameters=[
+            OpenApiParameter(
+                name="batch_size",
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description=(
+                    f"Rows written per transaction, {DEFAULT_BATCH_SIZE} by "
+                    f"default and at most {MAX_BATCH_SIZE}"
+                ),
+                required=False,
+            ),
+        ],
+        responses=OpenApiTypes.OBJECT,
+    )
+    @action(
+        detail=False,
+        methods=["POST"],
+        url_path="bulk-import",
+        parser_classes=[MultiPartParser],
+    )
+    def bulk_import(self, request):
+        """
+        Imports books from CSV or JSON Lines in batches. Rows with an id
+        update the existing book, the rest are created; of several rows
+        with one id in a batch, the last one wins.
+        """
+        batch_size = self._import_batch_size(request)
+        stream, file_format = self._import_source(request)
+        summary = import_books(
+            read_rows(decode_lines(stream), file_format), batch_size=batch_size
+        )
+        return Response(summary)
+
+    @extend_schema(parameters=[OUTPUT_PARAMETER], responses=OpenApiTypes.BINARY)
+    @action(detail=False, methods=["GET"], url_path="export")
+    def export(self, request):
+        """
+        Streams the whole catalog as CSV or JSON Lines.
+        """
+        return stream_export(request, Book.objects.all(), EXPORT_COLUMNS, "books")
 
     def get_permissions(self):
         """
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.4 on 2026-10-18 09:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("books", "0002_book_inventory_non_negative"),
+        ("borrows", "0003_alter_borrow_actual_return"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="borrow",
+            index=models.Index(
+                condition=models.Q(("actual_return__isnull", True)),
+                fields=["user"],
+                name="borrow_active_user_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="borrow",
+            index=models.Index(
+                condition=models.Q(("actual_return__isnull", True)),
+                fields=["expected_return"],
+                name="borrow_active_due_idx",
+            ),
+        ),
+    ]
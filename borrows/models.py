@@ -1,8 +1,75 @@
+from datetime import datetime
+
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest, Round
 
 from books.models import Book
 from library_project_final import settings
 
+FINE_MULTIPLIER = 2
+# Wide enough for the largest daily fee over decades of borrowing.
+MONEY = models.DecimalField(max_digits=16, decimal_places=2)
+
+
+class DaysBetween(models.Func):
+    """
+    Whole days from the second date expression to the first one.
+    """
+
+    arity = 2
+    arg_joiner = " - "
+    template = "(%(expressions)s)"
+    output_field = models.IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler,
+            connection,
+            template="CAST(julianday(%(expressions)s) AS INTEGER)",
+            arg_joiner=") - julianday(",
+            **extra_context,
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler,
+            connection,
+            function="DATEDIFF",
+            template="%(function)s(%(expressions)s)",
+            arg_joiner=", ",
+            **extra_context,
+        )
+
+
+class BorrowQuerySet(models.QuerySet):
+    def with_fees(self, today=None):
+        """
+        Annotates `overdue_days` and `accrued_fee` in SQL, computed like
+        `payments.helper.calculate_total_price`: every day from
+        `borrow_date` until the book came back, or until `today` while it
+        is out, costs the daily fee, and every day past `expected_return`
+        costs it `FINE_MULTIPLIER` times more.
+        """
+        today = today or datetime.now().date()
+        returned = Coalesce(F("actual_return"), Value(today, models.DateField()))
+        return self.annotate(
+            overdue_days=Greatest(
+                DaysBetween(returned, F("expected_return")), Value(0)
+            ),
+        ).annotate(
+            # Rounded so that SQLite's float arithmetic gives exact cents.
+            accrued_fee=Round(
+                (
+                    DaysBetween(returned, F("borrow_date"))
+                    + F("overdue_days") * FINE_MULTIPLIER
+                )
+                * F("book__daily_fee"),
+                2,
+                output_field=MONEY,
+            ),
+        )
+
 
 class Borrow(models.Model):
     borrow_date = models.DateField()
@@ -11,5 +78,21 @@ class Borrow(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
+    objects = BorrowQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["user"],
+                condition=models.Q(actual_return__isnull=True),
+                name="borrow_active_user_idx",
+            ),
+            models.Index(
+                fields=["expected_return"],
+                condition=models.Q(actual_return__isnull=True),
+                name="borrow_active_due_idx",
+            ),
+        ]
+
     def __str__(self):
         return f"Borrow date: {self.borrow_date}"
@@ -4,16 +4,38 @@ from django.db import transaction
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
+from books.models import Book
+from books.serializers import BookListSerializer
+from library_project_final.fieldsets import SparseFieldsetMixin
+from notifications.helper import enqueue_notification
+from payments.helper import sync_overdue_fines
 from payments.serializers import PaymentSerializer
-from telegram_helper import send_telegram_notification
+from user.serializers import UserSerializer
 
 from borrows.models import Borrow
 
 
-class BorrowSerializer(serializers.ModelSerializer):
+class BorrowSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Borrow
+        fields = (
+            "id",
+            "borrow_date",
+            "expected_return",
+            "actual_return",
+            "book",
+            "user",
+        )
+
+
+class BorrowSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     is_active = serializers.SerializerMethodField(read_only=True)
     payment_set = PaymentSerializer(many=True, read_only=True)
 
+    expandable_fields = {"book": BookListSerializer, "user": UserSerializer}
+    field_sources = {"is_active": ("actual_return",)}
+    annotated_fields = ("overdue_days", "accrued_fee")
+
     class Meta:
         model = Borrow
         fields = (
@@ -34,6 +56,10 @@ class BorrowSerializer(serializers.ModelSerializer):
 class BorrowListSerializer(BorrowSerializer):
     book_title = serializers.CharField(source="book.title", read_only=True)
     book_author = serializers.CharField(source="book.author", read_only=True)
+    overdue_days = serializers.IntegerField(read_only=True)
+    accrued_fee = serializers.DecimalField(
+        max_digits=16, decimal_places=2, read_only=True
+    )
     payment_set = PaymentSerializer(many=True, read_only=True)
 
     class Meta:
@@ -42,6 +68,8 @@ class BorrowListSerializer(BorrowSerializer):
             "id",
             "book_title",
             "book_author",
+            "overdue_days",
+            "accrued_fee",
             "payment_set",
         )
 
@@ -53,6 +81,10 @@ class BorrowDetailSerializer(BorrowSerializer):
     book_inventory = serializers.CharField(source="book.inventory", read_only=True)
     daily_fee = serializers.CharField(source="book.daily_fee", read_only=True)
     is_active = serializers.SerializerMethodField(read_only=True)
+    overdue_days = serializers.IntegerField(read_only=True)
+    accrued_fee = serializers.DecimalField(
+        max_digits=16, decimal_places=2, read_only=True
+    )
     payment_set = PaymentSerializer(many=True, read_only=True)
 
     class Meta:
@@ -65,6 +97,8 @@ class BorrowDetailSerializer(BorrowSerializer):
             "book_inventory",
             "daily_fee",
             "is_active",
+            "overdue_days",
+            "accrued_fee",
             "payment_set",
         )
 
@@ -119,14 +153,29 @@ class BorrowReturnSerializer(serializers.ModelSerializer):
             raise ValidationError(detail="Borrowing has been already returned.")
         return super().validate(attrs=attrs)
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        book = instance.book
-        instance.actual_return = datetime.now().date()
-        instance.save()
-        book.inventory += 1
-        book.save()
+        actual_return = datetime.now().date()
+        returned = Borrow.objects.filter(
+            pk=instance.pk, actual_return__isnull=True
+        ).update(actual_return=actual_return)
+        if not returned:
+            raise ValidationError(detail="Borrowing has been already returned.")
+        instance.actual_return = actual_return
+        Book.objects.return_copy(instance.book_id)
+        if actual_return > instance.expected_return:
+            # Settles the fine for the days since the last nightly run.
+            sync_overdue_fines(Borrow.objects.filter(pk=instance.pk), actual_return)
 
-        message = f"Borrowing returned: Book {book.title}, User {instance.user.email}"
-        send_telegram_notification(message)
+        message = f"Borrowing returned: Book {instance.book.title}, User {instance.user.email}"
+        enqueue_notification(message)
 
         return instance
+
+
+class BorrowFeeSummarySerializer(serializers.Serializer):
+    count = serializers.IntegerField()
+    overdue = serializers.IntegerField()
+    total_fee = serializers.DecimalField(max_digits=None, decimal_places=2)
+    average_fee = serializers.DecimalField(max_digits=16, decimal_places=2)
+    max_overdue_days = serializers.IntegerField()
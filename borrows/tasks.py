@@ -1,20 +1,86 @@
-from celery import shared_task
+import logging
+import time
+
+from celery import chord, shared_task
 from django.utils import timezone
 from .models import Borrow
-from telegram_helper import (
-    send_telegram_notification,
-)
+from notifications.helper import enqueue_notification, enqueue_notifications
+from notifications.tasks import merge_messages
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+
+def _overdue_borrowings(today):
+    return Borrow.objects.filter(expected_return__lte=today, actual_return=None)
+
+
+def _id_ranges(queryset, size):
+    """
+    Streams primary keys in order and yields (first_id, last_id) bounds
+    of consecutive chunks holding at most `size` rows each.
+    """
+    first_id = last_id = None
+    count = 0
+    ids = queryset.order_by("id").values_list("id", flat=True)
+    for pk in ids.iterator(chunk_size=size):
+        if first_id is None:
+            first_id = pk
+        last_id = pk
+        count += 1
+        if count == size:
+            yield first_id, last_id
+            first_id, count = None, 0
+    if first_id is not None:
+        yield first_id, last_id
 
 
 @shared_task
-def check_overdue_borrowings():
-    overdue_borrowings = Borrow.objects.filter(
-        expected_return__lte=timezone.now().date(), actual_return=None
+def check_overdue_borrowings(chunk_size=CHUNK_SIZE):
+    """
+    Splits overdue borrowings into id ranges and fans them out to
+    `notify_overdue_chunk` workers; `report_overdue_borrowings` sums up.
+    """
+    started_at = time.time()
+    today = timezone.now().date().isoformat()
+    ranges = list(_id_ranges(_overdue_borrowings(today), chunk_size))
+
+    if not ranges:
+        enqueue_notification("No borrowings overdue today!")
+        report_overdue_borrowings([], started_at)
+        return {"chunks": 0}
+
+    header = [
+        notify_overdue_chunk.s(first_id, last_id, today) for first_id, last_id in ranges
+    ]
+    chord(header)(report_overdue_borrowings.s(started_at))
+    return {"chunks": len(ranges)}
+
+
+@shared_task
+def notify_overdue_chunk(first_id, last_id, today):
+    """
+    Queues digest messages for the overdue borrowings in one id range,
+    reading book titles and user emails through a single join.
+    """
+    rows = (
+        _overdue_borrowings(today)
+        .filter(id__range=(first_id, last_id))
+        .order_by("id")
+        .values_list("book__title", "user__email")
     )
+    lines = [
+        f"Borrowing overdue: Book {title}, User {email}"
+        for title, email in rows.iterator(chunk_size=CHUNK_SIZE)
+    ]
+    enqueue_notifications(merge_messages(lines))
+    return len(lines)
+
 
-    if overdue_borrowings.exists():
-        for borrowing in overdue_borrowings:
-            message = f"Borrowing overdue: Book {borrowing.book.title}, User {borrowing.user.email}"
-            send_telegram_notification(message)
-    else:
-        send_telegram_notification("No borrowings overdue today!")
+@shared_task
+def report_overdue_borrowings(counts, started_at):
+    processed = sum(counts)
+    seconds = round(time.time() - started_at, 3)
+    logger.info("Overdue check processed %s borrowings in %ss", processed, seconds)
+    return {"processed": processed, "seconds": seconds}
@@ -1,17 +1,38 @@
-from datetime import datetime, date
+import json
+import random
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from unittest import skipUnless
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.reverse import reverse
-from rest_framework.test import APIClient
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 
 from books.models import Book
 from borrows.models import Borrow
 from borrows.serializers import BorrowListSerializer, BorrowDetailSerializer
-from borrows.tasks import check_overdue_borrowings
+from borrows.tasks import (
+    _overdue_borrowings,
+    check_overdue_borrowings,
+    notify_overdue_chunk,
+)
+from borrows.views import ORDERING_FIELDS, BorrowViewSet
+from library_project_final.fastpath import compile_mapper
+from library_project_final.celery import app as celery_app
+from library_project_final.throttling import LocalBuckets, TokenBucketThrottle
+from notifications.models import Notification
+from payments.helper import calculate_total_price
+from payments.models import Payment, PaymentOutbox
 
 BORROWS_URL = reverse("borrows:borrow-list")
 
@@ -59,7 +80,7 @@ class AuthenticatedBorrowsTests(TestCase):
     def test_borrows_list(self):
         sample_borrow(self.user)
         response = self.client.get(BORROWS_URL)
-        borrows = Borrow.objects.all()
+        borrows = Borrow.objects.with_fees()
         serializer = BorrowListSerializer(borrows, many=True)
 
         self.assertEqual(response.data["results"], serializer.data)
@@ -68,12 +89,13 @@ class AuthenticatedBorrowsTests(TestCase):
         borrow = sample_borrow(self.user)
         url = reverse("borrows:borrow-detail", kwargs={"pk": borrow.pk})
         response = self.client.get(url)
-        serializer = BorrowDetailSerializer(borrow)
+        serializer = BorrowDetailSerializer(
+            Borrow.objects.with_fees().get(pk=borrow.pk)
+        )
 
         self.assertEqual(response.data, serializer.data)
 
-    @patch("borrows.views.send_telegram_notification")
-    def test_borrows_create_and_telegram_message(self, mock_send_telegram_notification):
+    def test_borrows_create_and_telegram_message(self):
         book = Book.objects.create(
             title="Sample",
             author="Name",
@@ -96,15 +118,21 @@ class AuthenticatedBorrowsTests(TestCase):
                 date_object = datetime.strptime(payload[key], "%Y-%m-%d").date()
                 self.assertEqual(date_object, getattr(borrow, key))
 
-        self.assertEqual(mock_send_telegram_notification.call_count, 1)
-
         expected_message = (
             f"Borrowing create: Book {book.title}, User {self.user.email}"
         )
-        mock_send_telegram_notification.assert_called_once_with(expected_message)
+        self.assertEqual(
+            list(Notification.objects.values_list("text", flat=True)),
+            [expected_message],
+        )
 
-    @patch("borrows.serializers.send_telegram_notification")
-    def test_return_borrows_and_telegram_message(self, mock_send_telegram_notification):
+        payment = Payment.objects.get(borrowing=borrow)
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(payment.session_id, "")
+        self.assertTrue(PaymentOutbox.objects.filter(payment=payment).exists())
+        self.assertEqual(res.data["payment_set"][0]["id"], payment.id)
+
+    def test_return_borrows_and_telegram_message(self):
         book = Book.objects.create(
             title="Sample",
             author="Name",
@@ -129,13 +157,407 @@ class AuthenticatedBorrowsTests(TestCase):
             borrow.actual_return,
             date.today(),
         )
-
-        self.assertEqual(mock_send_telegram_notification.call_count, 1)
+        book.refresh_from_db()
+        self.assertEqual(book.inventory, 24)
 
         expected_message = (
             f"Borrowing returned: Book {book.title}, User {self.user.email}"
         )
-        mock_send_telegram_notification.assert_called_once_with(expected_message)
+        self.assertEqual(
+            list(Notification.objects.values_list("text", flat=True)),
+            [expected_message],
+        )
+
+
+class BorrowQueryCountTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.user)
+
+    def _create_borrows(self, count, payments_per_borrow=3):
+        borrows = [sample_borrow(self.user) for _ in range(count)]
+        Payment.objects.bulk_create(
+            Payment(
+                status=Payment.StatusChoices.PENDING,
+                type=Payment.TypeChoices.PAYMENT,
+                borrowing=borrow,
+                money_to_pay="4.90",
+            )
+            for borrow in borrows
+            for _ in range(payments_per_borrow)
+        )
+        return borrows
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_list_query_count_is_constant(self):
+        self._create_borrows(1)
+        few = self._count_queries(BORROWS_URL)
+        self._create_borrows(4)
+        many = self._count_queries(BORROWS_URL)
+
+        # COUNT, the borrow page and one prefetch for all payments.
+        self.assertEqual(few, 3)
+        self.assertEqual(many, few)
+
+    def test_detail_query_count_is_constant(self):
+        borrow = self._create_borrows(1, payments_per_borrow=1)[0]
+        few = self._count_queries(
+            reverse("borrows:borrow-detail", kwargs={"pk": borrow.pk})
+        )
+        borrow = self._create_borrows(1, payments_per_borrow=10)[0]
+        many = self._count_queries(
+            reverse("borrows:borrow-detail", kwargs={"pk": borrow.pk})
+        )
+
+        self.assertEqual(few, 2)
+        self.assertEqual(many, few)
+
+    def test_list_prefetch_matches_unprefetched_payments(self):
+        self._create_borrows(2)
+        response = self.client.get(BORROWS_URL)
+        serializer = BorrowListSerializer(Borrow.objects.with_fees(), many=True)
+
+        self.assertEqual(response.data["results"], serializer.data)
+
+
+class BorrowSparseFieldsetTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.user)
+        self.borrow = sample_borrow(self.user)
+        Payment.objects.create(
+            status=Payment.StatusChoices.PENDING,
+            type=Payment.TypeChoices.PAYMENT,
+            borrowing=self.borrow,
+            money_to_pay="4.90",
+        )
+        self.detail_url = reverse(
+            "borrows:borrow-detail", kwargs={"pk": self.borrow.pk}
+        )
+
+    def _get(self, url, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, [query["sql"] for query in queries]
+
+    def test_fields_skip_joins_and_prefetches(self):
+        response, queries = self._get(BORROWS_URL, fields="id")
+
+        self.assertEqual(response.data["results"], [{"id": self.borrow.id}])
+        # COUNT and the page, without the book join or the payment prefetch.
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn("books_book", queries[1])
+        self.assertNotIn("borrow_date", queries[1])
+
+    def test_fields_load_only_rendered_columns(self):
+        response, queries = self._get(self.detail_url, fields="book_title,is_active")
+
+        self.assertEqual(response.data, {"book_title": "Sample", "is_active": False})
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"books_book"."title"', queries[0])
+        self.assertIn("actual_return", queries[0])
+        self.assertNotIn("inventory", queries[0])
+
+    def test_default_response_is_unchanged(self):
+        response = self.client.get(self.detail_url)
+        borrow = Borrow.objects.with_fees().get(pk=self.borrow.pk)
+
+        self.assertEqual(response.data, BorrowDetailSerializer(borrow).data)
+
+    def test_expand_book(self):
+        response, queries = self._get(self.detail_url, expand="book", fields="id,book")
+
+        self.assertEqual(response.data["book"]["title"], "Sample")
+        self.assertEqual(response.data["book"]["id"], self.borrow.book_id)
+        self.assertEqual(len(queries), 1)
+
+    def test_unknown_fields_are_rejected(self):
+        response = self.client.get(BORROWS_URL, {"fields": "id,secret"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(BORROWS_URL, {"expand": "payment_set"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BorrowFastReadPathTest(TestCase):
+    """
+    The values() based list must render byte for byte what
+    BorrowListSerializer renders.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.admin_user)
+
+        sample_borrow(self.user)
+        sample_borrow(self.admin_user, actual_return=None)
+        for fee, money in (("0.10", "0.25"), ("999999.99", "12345678.90")):
+            borrow = sample_borrow(self.user, actual_return=None)
+            Book.objects.filter(pk=borrow.book_id).update(
+                daily_fee=fee, cover="Soft", title='Ünïcode, "quoted"'
+            )
+            Payment.objects.bulk_create(
+                Payment(
+                    status=status_choice,
+                    type=Payment.TypeChoices.FINE,
+                    borrowing=borrow,
+                    money_to_pay=money,
+                    session_url="",
+                    session_id="cs_test",
+                )
+                for status_choice in Payment.StatusChoices.values
+            )
+
+    def _assert_same_content(self, **params):
+        with self.settings(FAST_READ_PATH=False):
+            expected = self.client.get(BORROWS_URL, params)
+        with self.settings(FAST_READ_PATH=True):
+            actual = self.client.get(BORROWS_URL, params)
+
+        self.assertEqual(expected.status_code, status.HTTP_200_OK)
+        self.assertEqual(actual.content, expected.content)
+
+    def test_default_list(self):
+        self._assert_same_content(limit=100)
+
+    def test_filters_and_pagination(self):
+        self._assert_same_content(is_active="true", limit=2, offset=1)
+        self._assert_same_content(user_id=str(self.user.id), count="false")
+        self._assert_same_content(pagination="cursor", page_size=2)
+
+    def test_fields_and_expand(self):
+        self._assert_same_content(fields="id,payment_set")
+        self._assert_same_content(expand="book,user", limit=100)
+
+    def test_fast_path_skips_serializer_fields(self):
+        with self.settings(FAST_READ_PATH=True), patch.object(
+            BorrowListSerializer, "to_representation", side_effect=AssertionError
+        ), CaptureQueriesContext(connection) as queries:
+            response = self.client.get(BORROWS_URL, {"limit": 100})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # COUNT, the joined page and one query for all payments.
+        self.assertEqual(len(queries), 3)
+
+    def test_method_fields_use_the_serializer(self):
+        self.assertIsNone(compile_mapper(BorrowDetailSerializer()))
+        self.assertIsNotNone(compile_mapper(BorrowListSerializer()))
+
+
+class BorrowFeeAnnotationTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.user)
+        self.today = datetime.now().date()
+
+    def _random_borrows(self, count, seed):
+        rng = random.Random(seed)
+        books = Book.objects.bulk_create(
+            Book(
+                title=f"Book {number}",
+                author="Name",
+                cover="Hard",
+                inventory=5,
+                daily_fee=Decimal(rng.randint(1, 99999999)) / 100,
+            )
+            for number in range(10)
+        )
+        borrows = []
+        for _ in range(count):
+            borrow_date = self.today - timedelta(days=rng.randint(0, 4000))
+            expected_return = borrow_date + timedelta(days=rng.randint(0, 60))
+            actual_return = rng.choice(
+                [None, borrow_date + timedelta(days=rng.randint(0, 120))]
+            )
+            borrows.append(
+                Borrow(
+                    borrow_date=borrow_date,
+                    expected_return=expected_return,
+                    actual_return=actual_return,
+                    book=rng.choice(books),
+                    user=self.user,
+                )
+            )
+        return Borrow.objects.bulk_create(borrows)
+
+    def test_annotation_matches_calculate_total_price(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                Borrow.objects.all().delete()
+                self._random_borrows(100, seed)
+
+                for borrow in Borrow.objects.with_fees().select_related("book"):
+                    returned = borrow.actual_return or self.today
+                    self.assertEqual(borrow.accrued_fee, calculate_total_price(borrow))
+                    self.assertEqual(
+                        borrow.overdue_days,
+                        max(0, (returned - borrow.expected_return).days),
+                    )
+
+    def test_list_renders_fees(self):
+        borrow = Borrow.objects.get(pk=sample_borrow(self.user).pk)
+
+        response = self.client.get(BORROWS_URL)
+
+        result = response.data["results"][0]
+        self.assertEqual(result["accrued_fee"], str(calculate_total_price(borrow)))
+        self.assertEqual(result["overdue_days"], 0)
+
+    def test_ordering_and_min_fee(self):
+        self._random_borrows(30, seed=7)
+        expected = sorted(
+            (calculate_total_price(borrow), borrow.id)
+            for borrow in Borrow.objects.select_related("book")
+        )
+        threshold = expected[len(expected) // 2][0]
+
+        response = self.client.get(
+            BORROWS_URL,
+            {"ordering": "-accrued_fee", "min_fee": str(threshold), "limit": 100},
+        )
+
+        fees = [Decimal(row["accrued_fee"]) for row in response.data["results"]]
+        self.assertEqual(fees, sorted(fees, reverse=True))
+        self.assertEqual(
+            len(fees), len([fee for fee, _ in expected if fee >= threshold])
+        )
+
+    def _walk(self, params):
+        ids = []
+        pages = [self.client.get(BORROWS_URL, params)]
+        while True:
+            self.assertEqual(pages[-1].status_code, status.HTTP_200_OK)
+            ids += [row["id"] for row in pages[-1].data["results"]]
+            if not pages[-1].data["next"]:
+                return ids, pages
+            pages.append(self.client.get(pages[-1].data["next"]))
+
+    def test_cursor_pages_follow_ordering(self):
+        self._random_borrows(30, seed=3)
+
+        for field in ORDERING_FIELDS:
+            for ordering in (field, f"-{field}"):
+                with self.subTest(ordering=ordering):
+                    expected = self.client.get(
+                        BORROWS_URL, {"ordering": ordering, "limit": 100}
+                    )
+                    ids, pages = self._walk(
+                        {"ordering": ordering, "pagination": "cursor", "page_size": 7}
+                    )
+
+                    self.assertEqual(
+                        ids, [row["id"] for row in expected.data["results"]]
+                    )
+                    previous = self.client.get(pages[2].data["previous"])
+                    self.assertEqual(previous.data["results"], pages[1].data["results"])
+
+    def test_invalid_fee_parameters(self):
+        for params in (
+            {"min_fee": "abc"},
+            {"min_fee": "nan"},
+            {"ordering": "user"},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(BORROWS_URL, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_fee_summary_is_one_query(self):
+        self._random_borrows(30, seed=11)
+        borrows = list(Borrow.objects.select_related("book"))
+        fees = [calculate_total_price(borrow) for borrow in borrows]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("borrows:borrow-fees"))
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.data["count"], len(borrows))
+        self.assertEqual(response.data["total_fee"], str(sum(fees)))
+        self.assertEqual(
+            response.data["max_overdue_days"],
+            max(b.overdue_days for b in Borrow.objects.with_fees()),
+        )
+
+    def test_sparse_fields_skip_fee_annotation(self):
+        sample_borrow(self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(BORROWS_URL, {"fields": "id"})
+
+        self.assertNotIn("julianday", queries[-1]["sql"])
+
+
+class BorrowExportTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.admin_user)
+        self.returned = sample_borrow(self.user)
+        self.active = sample_borrow(self.admin_user, actual_return=None)
+
+    def _export(self, **params):
+        response = self.client.get(reverse("borrows:borrow-export"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(1):
+            content = b"".join(response.streaming_content).decode()
+        return content
+
+    def test_export_csv_joins_book_and_user(self):
+        lines = self._export().splitlines()
+
+        self.assertEqual(
+            lines[0],
+            "id,borrow_date,expected_return,actual_return,book_id,"
+            "book_title,book_author,user_id,user_email",
+        )
+        self.assertEqual(
+            lines[1],
+            f"{self.returned.id},2020-05-21,2020-05-30,2020-05-29,"
+            f"{self.returned.book_id},Sample,Name,{self.user.id},example@mail.com",
+        )
+        self.assertTrue(
+            lines[2].startswith(f"{self.active.id},2020-05-21,2020-05-30,,")
+        )
+
+    def test_export_jsonl_applies_list_filters(self):
+        content = self._export(output="jsonl", is_active="true")
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["id"], self.active.id)
+        self.assertIsNone(rows[0]["actual_return"])
+        self.assertEqual(rows[0]["user_email"], "admin@mail.com")
+
+    def test_export_requires_staff(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("borrows:borrow-export"))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
 
 class CheckOverdueBorrowingsTest(TestCase):
@@ -158,10 +580,313 @@ class CheckOverdueBorrowingsTest(TestCase):
             book=self.book,
             user=self.user,
         )
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
 
-    @patch("borrows.tasks.send_telegram_notification")
-    def test_check_overdue_borrowings(self, mock_send_telegram_notification):
-        check_overdue_borrowings()
-        self.assertTrue(mock_send_telegram_notification.called)
+    def _create_overdue(self, count):
+        Borrow.objects.bulk_create(
+            Borrow(
+                borrow_date=self.borrow.borrow_date,
+                expected_return=self.borrow.expected_return,
+                book=self.book,
+                user=self.user,
+            )
+            for _ in range(count)
+        )
+
+    def test_check_overdue_borrowings(self):
+        with self.assertLogs("borrows.tasks", "INFO") as logs:
+            check_overdue_borrowings()
         expected_message = f"Borrowing overdue: Book {self.borrow.book.title}, User {self.borrow.user.email}"
-        mock_send_telegram_notification.assert_called_once_with(expected_message)
+        self.assertEqual(
+            list(Notification.objects.values_list("text", flat=True)),
+            [expected_message],
+        )
+        self.assertIn("processed 1 borrowings", logs.output[0])
+
+    def test_no_overdue_borrowings(self):
+        Borrow.objects.update(actual_return=timezone.now().date())
+
+        result = check_overdue_borrowings()
+
+        self.assertEqual(
+            list(Notification.objects.values_list("text", flat=True)),
+            ["No borrowings overdue today!"],
+        )
+        self.assertEqual(result, {"chunks": 0})
+
+    def test_overdue_borrowings_are_split_into_chunks(self):
+        self._create_overdue(9)
+
+        with self.assertLogs("borrows.tasks", "INFO") as logs:
+            result = check_overdue_borrowings(chunk_size=4)
+
+        self.assertEqual(result, {"chunks": 3})
+        self.assertIn("processed 10 borrowings", logs.output[0])
+        # One digest per chunk of 4, 4 and 2 borrowings.
+        digests = list(Notification.objects.values_list("text", flat=True))
+        self.assertEqual([digest.count("\n") + 1 for digest in digests], [4, 4, 2])
+
+    def test_chunk_query_count_does_not_grow_with_rows(self):
+        self._create_overdue(49)
+        last_id = Borrow.objects.latest("id").id
+        today = timezone.now().date().isoformat()
+
+        # One joined SELECT for the rows and one INSERT for the digest.
+        with self.assertNumQueries(2):
+            self.assertEqual(notify_overdue_chunk(0, last_id, today), 50)
+
+
+class ConcurrentBorrowTest(TransactionTestCase):
+    BORROWERS = 20
+    INVENTORY = 5
+
+    def setUp(self):
+        self.users = get_user_model().objects.bulk_create(
+            get_user_model()(email=f"user{i}@mail.com") for i in range(self.BORROWERS)
+        )
+        self.book = Book.objects.create(
+            title="Popular",
+            author="Name",
+            cover="Hard",
+            inventory=self.INVENTORY,
+            daily_fee=2.45,
+        )
+
+    def _borrow(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            return client.post(
+                BORROWS_URL,
+                {
+                    "book": self.book.id,
+                    "borrow_date": "2020-05-21",
+                    "expected_return": "2020-05-30",
+                },
+            ).status_code
+        finally:
+            connection.close()
+
+    @patch("payments.helper.schedule_payment_outbox")
+    def test_parallel_borrowers_never_oversell(self, mock_schedule):
+        with ThreadPoolExecutor(max_workers=self.BORROWERS) as executor:
+            statuses = list(executor.map(self._borrow, self.users))
+
+        self.book.refresh_from_db()
+        self.assertEqual(statuses.count(status.HTTP_201_CREATED), self.INVENTORY)
+        self.assertEqual(
+            statuses.count(status.HTTP_400_BAD_REQUEST),
+            self.BORROWERS - self.INVENTORY,
+        )
+        self.assertEqual(self.book.inventory, 0)
+        self.assertEqual(Borrow.objects.count(), self.INVENTORY)
+
+    def test_inventory_cannot_go_negative(self):
+        with self.assertRaises(IntegrityError):
+            Book.objects.filter(pk=self.book.pk).update(inventory=-1)
+
+
+@skipUnless(connection.vendor == "sqlite", "Tests the SQLite profile")
+class SqliteProfileTest(TransactionTestCase):
+    def test_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            settings = {
+                pragma: cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+                for pragma in ("journal_mode", "synchronous", "busy_timeout")
+            }
+
+        self.assertEqual(
+            settings, {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 20000}
+        )
+
+    def test_transactions_take_the_write_lock_up_front(self):
+        other = sqlite3.connect(connection.settings_dict["NAME"], timeout=0)
+        self.addCleanup(other.close)
+
+        with transaction.atomic():
+            Book.objects.exists()
+            with self.assertRaisesMessage(sqlite3.OperationalError, "locked"):
+                other.execute("BEGIN IMMEDIATE")
+
+        other.execute("BEGIN IMMEDIATE")
+        other.rollback()
+
+
+class BorrowCreateThrottleTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        for patcher in (
+            patch(
+                "library_project_final.throttling._buckets",
+                LocalBuckets(clock=lambda: self.now),
+            ),
+            patch.object(
+                TokenBucketThrottle, "THROTTLE_RATES", {"borrow_create": "2/min"}
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.book = Book.objects.create(
+            title="Sample",
+            author="Name",
+            cover="Hard",
+            inventory=23,
+            daily_fee=2.45,
+        )
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _create(self, client=None):
+        return (client or self.client).post(
+            BORROWS_URL,
+            {
+                "book": self.book.id,
+                "borrow_date": "2020-05-21",
+                "expected_return": "2020-05-30",
+            },
+        )
+
+    def test_bucket_empties_and_refills(self):
+        self.assertEqual(self._create().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._create().status_code, status.HTTP_201_CREATED)
+
+        res = self._create()
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(res["Retry-After"], "30")
+        self.assertEqual(Borrow.objects.count(), 2)
+
+        self.now += 30
+        self.assertEqual(self._create().status_code, status.HTTP_201_CREATED)
+
+    def test_buckets_are_per_user(self):
+        self._create()
+        self._create()
+        other = APIClient()
+        other.force_authenticate(
+            get_user_model().objects.create_user(
+                email="other@mail.com", password="password"
+            )
+        )
+
+        self.assertEqual(self._create(other).status_code, status.HTTP_201_CREATED)
+
+    def test_reads_are_not_throttled(self):
+        self._create()
+        self._create()
+
+        self.assertEqual(self.client.get(BORROWS_URL).status_code, status.HTTP_200_OK)
+
+
+class BorrowQueryPlanTest(TestCase):
+    """
+    Keeps the active and overdue borrow queries on the partial indexes.
+    Plans are taken on analyzed data shaped like production: many users,
+    most borrowings already returned, and the active ones split between
+    overdue and not yet due.
+    """
+
+    USERS = 20
+    RETURNED = 100  # per user
+    ACTIVE = 4  # per user, half of them overdue
+
+    @classmethod
+    def setUpTestData(cls):
+        users = get_user_model().objects.bulk_create(
+            get_user_model()(email=f"user{i}@mail.com") for i in range(cls.USERS)
+        )
+        cls.user = users[0]
+        cls.admin = get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Sample",
+            author="Name",
+            cover="Hard",
+            inventory=23,
+            daily_fee=2.45,
+        )
+        borrow = {"borrow_date": date(2020, 5, 21), "book": book}
+        due = [date(2020, 5, 30), date.today() + timedelta(days=30)]
+        Borrow.objects.bulk_create(
+            [
+                Borrow(
+                    user=user,
+                    expected_return=due[0],
+                    actual_return=date(2020, 5, 29),
+                    **borrow,
+                )
+                for user in users
+                for _ in range(cls.RETURNED)
+            ]
+            + [
+                Borrow(user=user, expected_return=due[i % 2], **borrow)
+                for user in users
+                for i in range(cls.ACTIVE)
+            ]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # Any usable index beats a sequential scan, so the planner's
+            # choice among the indexes is what the assertions check.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, *indexes):
+        """
+        Asserts that the plan reads borrows_borrow through one of `indexes`.
+        """
+        plan = queryset.explain()
+        if connection.vendor == "postgresql":
+            pattern = r"Index (?:Only )?Scan using (\w+) on borrows_borrow\b"
+        else:
+            pattern = r"\bSEARCH borrows_borrow USING (?:COVERING )?INDEX (\w+)"
+        used = re.findall(pattern, plan)
+        self.assertTrue(
+            used and set(used) <= set(indexes),
+            f"borrows_borrow is not read through {', '.join(indexes)}:\n{plan}",
+        )
+
+    def _list_queryset(self, user, **params):
+        request = Request(APIRequestFactory().get(BORROWS_URL, params))
+        request.user = user
+        return BorrowViewSet(request=request, action="list").get_queryset()
+
+    def test_active_borrows_of_user(self):
+        self.assertUsesIndex(
+            self._list_queryset(self.user, is_active="true"),
+            "borrow_active_user_idx",
+        )
+
+    def test_active_borrows_filtered_by_user_id(self):
+        queryset = self._list_queryset(
+            self.admin, is_active="true", user_id=str(self.user.id)
+        )
+        self.assertUsesIndex(queryset, "borrow_active_user_idx")
+
+    def test_all_active_borrows(self):
+        # Both partial indexes hold exactly the active borrowings.
+        self.assertUsesIndex(
+            self._list_queryset(self.admin, is_active="true"),
+            "borrow_active_user_idx",
+            "borrow_active_due_idx",
+        )
+
+    def test_overdue_scan(self):
+        today = date.today().isoformat()
+        self.assertUsesIndex(
+            _overdue_borrowings(today).order_by("id").values_list("id", flat=True),
+            "borrow_active_due_idx",
+        )
+        self.assertUsesIndex(
+            _overdue_borrowings(today)
+            .filter(id__range=(1, Borrow.objects.count()))
+            .values_list("book__title", "user__email"),
+            "borrow_active_due_idx",
+        )
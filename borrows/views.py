@@ -1,16 +1,26 @@
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
 from drf_spectacular.types import OpenApiTypes
-from drf_spectacular.utils import extend_schema, OpenApiParameter
+from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
-from payments.helper import create_stripe_session
-from telegram_helper import send_telegram_notification
+from notifications.helper import enqueue_notification
+from payments.helper import create_pending_payment
 
-from borrows.models import Borrow
+from books.models import Book
+from borrows.models import MONEY, Borrow
+from library_project_final.export import OUTPUT_PARAMETER, stream_export
+from library_project_final.fastpath import FastListMixin
+from library_project_final.fieldsets import FIELDSET_PARAMETERS, SparseQuerysetMixin
+from library_project_final.throttling import TokenBucketThrottle
 
 # from borrows.permissions import IsAdminOrIsSelf
 from borrows.serializers import (
@@ -18,14 +28,66 @@ from borrows.serializers import (
     BorrowListSerializer,
     BorrowDetailSerializer,
     BorrowCreateSerializer,
+    BorrowFeeSummarySerializer,
     BorrowReturnSerializer,
 )
 
 
-class BorrowViewSet(viewsets.ModelViewSet):
+FILTER_PARAMETERS = [
+    OpenApiParameter(
+        name="user_id",
+        type=OpenApiTypes.INT,
+        location=OpenApiParameter.QUERY,
+        description="Filter borrows by user ID",
+        required=False,
+    ),
+    OpenApiParameter(
+        name="is_active",
+        type=OpenApiTypes.BOOL,
+        location=OpenApiParameter.QUERY,
+        description="Filter borrows by active status",
+        required=False,
+    ),
+    OpenApiParameter(
+        name="min_fee",
+        type=OpenApiTypes.DECIMAL,
+        location=OpenApiParameter.QUERY,
+        description="Filter borrows by the lowest accrued fee",
+        required=False,
+    ),
+]
+FEE_FIELDS = {"accrued_fee", "overdue_days"}
+ORDERING_FIELDS = ("accrued_fee", "overdue_days", "borrow_date", "expected_return")
+ORDERING_PARAMETER = OpenApiParameter(
+    name="ordering",
+    type=OpenApiTypes.STR,
+    location=OpenApiParameter.QUERY,
+    description="Sort borrows by a field, descending with a leading '-'",
+    enum=[*ORDERING_FIELDS, *(f"-{field}" for field in ORDERING_FIELDS)],
+    required=False,
+)
+EXPORT_COLUMNS = {
+    "id": "id",
+    "borrow_date": "borrow_date",
+    "expected_return": "expected_return",
+    "actual_return": "actual_return",
+    "book_id": "book_id",
+    "book_title": "book__title",
+    "book_author": "book__author",
+    "user_id": "user_id",
+    "user_email": "user__email",
+}
+
+
+@extend_schema_view(
+    list=extend_schema(parameters=FIELDSET_PARAMETERS),
+    retrieve=extend_schema(parameters=FIELDSET_PARAMETERS),
+)
+class BorrowViewSet(FastListMixin, SparseQuerysetMixin, viewsets.ModelViewSet):
     queryset = Borrow.objects.all().select_related("user", "book")
     serializer_class = BorrowSerializer
     permission_classes = (IsAuthenticated,)
+    throttle_scope = "borrow_create"
 
     @staticmethod
     def _params_to_ints(qs):
@@ -35,8 +97,32 @@ class BorrowViewSet(viewsets.ModelViewSet):
     def _params_to_bool(qs: str) -> bool:
         return qs.lower() == "true"
 
+    @staticmethod
+    def _params_to_decimal(name, qs):
+        try:
+            value = Decimal(qs)
+        except InvalidOperation:
+            value = None
+        if value is None or not value.is_finite():
+            raise ValidationError({name: ["A valid number is required."]})
+        return value
+
+    def _needs_fees(self):
+        # The fee annotation joins the book table, so it is only added
+        # when the response renders fees or the request filters or sorts
+        # by them.
+        params = self.request.query_params
+        if self.action == "fees" or params.get("min_fee"):
+            return True
+        if params.get("ordering", "").lstrip("-") in FEE_FIELDS:
+            return True
+        serializer = self.get_serializer_class()(context={"request": self.request})
+        return bool(FEE_FIELDS & set(serializer.fields))
+
     def get_queryset(self):
         queryset = self.queryset
+        if self._needs_fees():
+            queryset = queryset.with_fees()
 
         user = self.request.query_params.get("user_id")
         if user:
@@ -51,11 +137,30 @@ class BorrowViewSet(viewsets.ModelViewSet):
             else:
                 queryset = queryset.filter(actual_return__isnull=False)
 
+        min_fee = self.request.query_params.get("min_fee")
+        if min_fee:
+            queryset = queryset.filter(
+                accrued_fee__gte=self._params_to_decimal("min_fee", min_fee)
+            )
+
+        ordering = self.request.query_params.get("ordering")
+        if ordering:
+            if ordering.lstrip("-") not in ORDERING_FIELDS:
+                raise ValidationError(
+                    {"ordering": [f"Choose one of: {', '.join(ORDERING_FIELDS)}."]}
+                )
+            queryset = queryset.order_by(ordering, "id")
+
         if not self.request.user.is_staff:
             queryset = queryset.filter(user=self.request.user)
 
         return queryset
 
+    def get_throttles(self):
+        if self.action == "create":
+            return [TokenBucketThrottle()]
+        return super().get_throttles()
+
     def get_serializer_class(self):
         if self.action == "list":
             return BorrowListSerializer
@@ -68,14 +173,15 @@ class BorrowViewSet(viewsets.ModelViewSet):
 
         return super().get_serializer_class()
 
+    @transaction.atomic
     def perform_create(self, serializer):
         book = serializer.validated_data.get("book")
-        book.inventory -= 1
-        book.save()
+        if not Book.objects.take_copy(book.id):
+            raise ValidationError({"book": ["This book is currently out of stock."]})
         serializer.save(user=self.request.user)
         message = f"Borrowing create: Book {book.title}, User {serializer.instance.user.email}"
-        send_telegram_notification(message)
-        create_stripe_session(serializer.instance)
+        enqueue_notification(message)
+        create_pending_payment(serializer.instance)
 
     @extend_schema(
         request=BorrowReturnSerializer,
@@ -109,22 +215,46 @@ class BorrowViewSet(viewsets.ModelViewSet):
 
     @extend_schema(
         parameters=[
-            OpenApiParameter(
-                name="user_id",
-                type=OpenApiTypes.INT,
-                location=OpenApiParameter.QUERY,
-                description="Filter borrows by user ID",
-                required=False,
-            ),
-            OpenApiParameter(
-                name="is_active",
-                type=OpenApiTypes.BOOL,
-                location=OpenApiParameter.QUERY,
-                description="Filter borrows by active status",
-                required=False,
-            ),
-        ]
+            OUTPUT_PARAMETER,
+            *FILTER_PARAMETERS,
+        ],
+        responses=OpenApiTypes.BINARY,
     )
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="export",
+        permission_classes=[IsAdminUser],
+    )
+    def export(self, request):
+        """
+        Streams the borrow history with book and user details as CSV or
+        JSON Lines. Accepts the same filters as the list.
+        """
+        return stream_export(request, self.get_queryset(), EXPORT_COLUMNS, "borrows")
+
+    @extend_schema(parameters=FILTER_PARAMETERS)
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="fees",
+        serializer_class=BorrowFeeSummarySerializer,
+    )
+    def fees(self, request):
+        """
+        Sums up the accrued fees of the borrows that match the list
+        filters, in a single aggregate query.
+        """
+        totals = self.get_queryset().aggregate(
+            count=Count("id"),
+            overdue=Count("id", filter=Q(overdue_days__gt=0)),
+            total_fee=Coalesce(Sum("accrued_fee"), Value(Decimal(0), MONEY)),
+            average_fee=Coalesce(Avg("accrued_fee"), Value(Decimal(0), MONEY)),
+            max_overdue_days=Coalesce(Max("overdue_days"), 0),
+        )
+        return Response(BorrowFeeSummarySerializer(totals).data)
+
+    @extend_schema(parameters=[*FILTER_PARAMETERS, ORDERING_PARAMETER])
     def list(self, request, *args, **kwargs):
         """
         Returns a list of all the borrows.
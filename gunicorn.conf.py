@@ -0,0 +1,47 @@
+"""
+Gunicorn settings for the web service, read from the environment:
+
+    gunicorn -c gunicorn.conf.py library_project_final.wsgi
+
+Serve the ASGI application instead with
+GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker and
+library_project_final.asgi:application.
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# Threads let a worker keep serving while other requests hash passwords;
+# PASSWORD_HASH_PROCESS_SLOTS must stay below this.
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+keepalive = 5
+
+# Load Django once in the master so that workers share its memory
+# copy-on-write instead of each importing the project.
+preload_app = True
+
+# Recycle workers now and then so that slow leaks cannot add up.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+
+
+def when_ready(server):
+    # Objects created while loading the app are never freed; moving them
+    # out of the collector's reach keeps collections in the workers from
+    # touching, and so copying, the pages they live on.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections must not be shared across processes. Nothing should be
+    # open after loading the app, but close them to be sure.
+    from django.db import connections
+
+    connections.close_all()
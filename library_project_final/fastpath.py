@@ -0,0 +1,235 @@
+import decimal
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import fields as drf_fields
+from rest_framework import serializers
+from rest_framework.relations import PrimaryKeyRelatedField, RelatedField
+from rest_framework.response import Response
+from rest_framework.settings import ISO_8601, api_settings
+
+from library_project_final.fieldsets import get_model_field
+
+COLUMN, NESTED, LIST = "column", "nested", "list"
+
+_compiled = {}
+
+
+class Unsupported(Exception):
+    """
+    Raised while compiling a serializer with a field that cannot be read
+    from `.values()` rows. Such serializers use the regular DRF path.
+    """
+
+
+def _decimal_converter(field):
+    coerce_to_string = getattr(
+        field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING
+    )
+    if field.normalize_output or field.localize or not coerce_to_string:
+        return field.to_representation
+    if field.decimal_places is None:
+        return "{:f}".format
+
+    exponent = decimal.Decimal(".1") ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        return "{:f}".format(
+            value.quantize(exponent, rounding=rounding, context=context)
+        )
+
+    return convert
+
+
+def _date_converter(field):
+    output_format = getattr(field, "format", api_settings.DATE_FORMAT)
+    if output_format is None or output_format.lower() != ISO_8601:
+        return field.to_representation
+    return lambda value: value.isoformat() if value else None
+
+
+def _converter(field):
+    """
+    Returns a function that turns a column value into what
+    `field.to_representation` would return for it, without the per-call
+    setting lookups where the field type allows it.
+    """
+    if isinstance(field, PrimaryKeyRelatedField):
+        if field.pk_field is not None:
+            return field.pk_field.to_representation
+        return lambda value: value
+    if type(field) is drf_fields.ChoiceField:
+        choices = field.choice_strings_to_values
+        return lambda value: value if value == "" else choices.get(str(value), value)
+    if isinstance(field, drf_fields.DecimalField):
+        return _decimal_converter(field)
+    if isinstance(field, drf_fields.DateField):
+        return _date_converter(field)
+    if isinstance(field, drf_fields.IntegerField):
+        return int
+    if isinstance(field, drf_fields.CharField):
+        return str
+    if isinstance(field, (RelatedField, drf_fields.SerializerMethodField)):
+        raise Unsupported(field.field_name)
+    return field.to_representation
+
+
+class ValuesMapper:
+    """
+    Renders `.values()` rows exactly as a serializer would render the
+    model instances. Compiled once per serializer class and field set, it
+    maps every field to a column lookup and a converter; nested lists of
+    a reverse relation are read with one extra `.values()` query.
+    """
+
+    def __init__(self, serializer, model, prefix=""):
+        self.model = model
+        self.pk_lookup = prefix + model._meta.pk.name
+        self.lookups = {self.pk_lookup}
+        self.steps = []
+        self.lists = []
+        annotated_fields = () if prefix else getattr(serializer, "annotated_fields", ())
+
+        for field in serializer._readable_fields:
+            if field.source == "*":
+                raise Unsupported(field.field_name)
+
+            if field.source in annotated_fields:
+                self.lookups.add(field.source)
+                self.steps.append(
+                    (COLUMN, field.field_name, (field.source, _converter(field)))
+                )
+                continue
+
+            if isinstance(field, serializers.ListSerializer):
+                if prefix:
+                    raise Unsupported(field.field_name)
+                self._add_list(field, model)
+                continue
+
+            lookup, related_model = self._resolve(field, model, prefix)
+            if isinstance(field, serializers.Serializer):
+                mapper = ValuesMapper(field, related_model, lookup + "__")
+                self.lookups |= mapper.lookups
+                self.steps.append((NESTED, field.field_name, mapper))
+            else:
+                self.lookups.add(lookup)
+                self.steps.append(
+                    (COLUMN, field.field_name, (lookup, _converter(field)))
+                )
+
+    @staticmethod
+    def _resolve(field, model, prefix):
+        current = model
+        for attr in field.source_attrs:
+            try:
+                model_field = get_model_field(current, attr)
+            except FieldDoesNotExist:
+                raise Unsupported(field.field_name)
+            if model_field.one_to_many or model_field.many_to_many:
+                raise Unsupported(field.field_name)
+            current = model_field.related_model
+        return prefix + "__".join(field.source_attrs), current
+
+    def _add_list(self, field, model):
+        if len(field.source_attrs) != 1:
+            raise Unsupported(field.field_name)
+        try:
+            relation = get_model_field(model, field.source)
+        except FieldDoesNotExist:
+            raise Unsupported(field.field_name)
+        if not relation.one_to_many:
+            raise Unsupported(field.field_name)
+
+        child_model = relation.related_model
+        mapper = ValuesMapper(field.child, child_model)
+        if mapper.lists:
+            raise Unsupported(field.field_name)
+        fk_lookup = relation.field.attname
+        mapper.lookups.add(fk_lookup)
+        ordering = child_model._meta.ordering or [child_model._meta.pk.name]
+        self.lists.append((field.field_name, mapper, fk_lookup, ordering))
+        self.steps.append((LIST, field.field_name, None))
+
+    def values(self, queryset):
+        return queryset.prefetch_related(None).values(*self.lookups)
+
+    def _render_row(self, row, related):
+        data = {}
+        for kind, name, spec in self.steps:
+            if kind == COLUMN:
+                lookup, convert = spec
+                value = row[lookup]
+                data[name] = None if value is None else convert(value)
+            elif kind == NESTED:
+                data[name] = (
+                    None if row[spec.pk_lookup] is None else spec._render_row(row, {})
+                )
+            else:
+                data[name] = related[name].get(row[self.pk_lookup], [])
+        return data
+
+    def _related(self, rows):
+        related = {}
+        if not self.lists:
+            return related
+        ids = [row[self.pk_lookup] for row in rows]
+        for name, mapper, fk_lookup, ordering in self.lists:
+            queryset = mapper.values(
+                mapper.model.objects.filter(**{f"{fk_lookup}__in": ids})
+            ).order_by(*ordering)
+            grouped = defaultdict(list)
+            for child in queryset:
+                grouped[child[fk_lookup]].append(mapper._render_row(child, {}))
+            related[name] = grouped
+        return related
+
+    def render(self, rows):
+        rows = list(rows)
+        related = self._related(rows)
+        return [self._render_row(row, related) for row in rows]
+
+
+def compile_mapper(serializer):
+    """
+    Returns the cached ValuesMapper for `serializer`, or None when one of
+    its fields needs the model instance.
+    """
+    key = (
+        type(serializer),
+        tuple((name, type(field)) for name, field in serializer.fields.items()),
+    )
+    if key not in _compiled:
+        try:
+            _compiled[key] = ValuesMapper(serializer, serializer.Meta.model)
+        except Unsupported:
+            _compiled[key] = None
+    return _compiled[key]
+
+
+class FastListMixin:
+    """
+    Viewset mixin that builds list responses from `.values()` rows when
+    `settings.FAST_READ_PATH` is on and the list serializer can be
+    compiled; otherwise the regular serializer is used.
+    """
+
+    def list(self, request, *args, **kwargs):
+        if not settings.FAST_READ_PATH:
+            return super().list(request, *args, **kwargs)
+        mapper = compile_mapper(self.get_serializer())
+        if mapper is None:
+            return super().list(request, *args, **kwargs)
+
+        rows = mapper.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(mapper.render(page))
+        return Response(mapper.render(rows))
@@ -0,0 +1,203 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from django.utils.module_loading import import_string
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+
+FIELDS_QUERY_PARAM = "fields"
+EXPAND_QUERY_PARAM = "expand"
+
+FIELDSET_PARAMETERS = [
+    OpenApiParameter(
+        name=FIELDS_QUERY_PARAM,
+        type=OpenApiTypes.STR,
+        location=OpenApiParameter.QUERY,
+        description="Comma-separated fields to return, all by default",
+        required=False,
+    ),
+    OpenApiParameter(
+        name=EXPAND_QUERY_PARAM,
+        type=OpenApiTypes.STR,
+        location=OpenApiParameter.QUERY,
+        description="Comma-separated related fields to return as nested objects",
+        required=False,
+    ),
+]
+
+
+def _param_list(request, name):
+    value = request.query_params.get(name, "")
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+class SparseFieldsetMixin:
+    """
+    Serializer mixin for `?fields=` and `?expand=` on read requests.
+
+    `?fields=a,b` keeps only the listed top-level fields. `?expand=name`
+    renders a field from `expandable_fields` as a nested object, replacing
+    its primary key or adding it. Values in `expandable_fields` are
+    serializer classes or dotted paths to them. Method fields name the
+    model fields they read in `field_sources`, so the view can defer the
+    rest of the columns. Fields read from annotations of the view's
+    queryset are listed in `annotated_fields`.
+    """
+
+    expandable_fields = {}
+    field_sources = {}
+    annotated_fields = ()
+
+    def _is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is None or request.method not in SAFE_METHODS or not self._is_root():
+            return fields
+
+        expand = _param_list(request, EXPAND_QUERY_PARAM)
+        unknown = set(expand) - set(self.expandable_fields)
+        if unknown:
+            raise ValidationError(
+                {EXPAND_QUERY_PARAM: [f"Cannot expand: {', '.join(sorted(unknown))}."]}
+            )
+        for name in expand:
+            serializer_class = self.expandable_fields[name]
+            if isinstance(serializer_class, str):
+                serializer_class = import_string(serializer_class)
+            fields[name] = serializer_class(read_only=True)
+
+        only = _param_list(request, FIELDS_QUERY_PARAM)
+        if only:
+            unknown = set(only) - set(fields)
+            if unknown:
+                raise ValidationError(
+                    {
+                        FIELDS_QUERY_PARAM: [
+                            f"Unknown fields: {', '.join(sorted(unknown))}."
+                        ]
+                    }
+                )
+            fields = {name: field for name, field in fields.items() if name in only}
+        return fields
+
+
+def get_model_field(model, attr):
+    # Serializers name reverse relations by their accessor (`payment_set`).
+    for field in model._meta.get_fields():
+        if field.auto_created and field.is_relation and not field.concrete:
+            if field.get_accessor_name() == attr:
+                return field
+    return model._meta.get_field(attr)
+
+
+def _collect(serializer, model, prefix, plan):
+    """
+    Adds the columns, joins and prefetches that `serializer` reads from
+    `model` to `plan`. Returns False when a field cannot be mapped to
+    columns, in which case no columns should be deferred.
+    """
+    columns, related, prefetches = plan
+    complete = True
+    field_sources = getattr(serializer, "field_sources", {})
+    annotated_fields = () if prefix else getattr(serializer, "annotated_fields", ())
+
+    for field in serializer._readable_fields:
+        if field.source in annotated_fields:
+            continue
+        if field.source == "*":
+            if field.field_name not in field_sources:
+                complete = False
+            columns.update(
+                prefix + source for source in field_sources.get(field.field_name, ())
+            )
+            continue
+
+        path = field.source_attrs
+        current = model
+        for depth, attr in enumerate(path):
+            try:
+                model_field = get_model_field(current, attr)
+            except FieldDoesNotExist:
+                complete = False
+                break
+            lookup = prefix + "__".join(path[: depth + 1])
+
+            if model_field.one_to_many or model_field.many_to_many:
+                if isinstance(field, serializers.ListSerializer) and depth == 0:
+                    child = field.child
+                    child_model = model_field.related_model
+                    child_plan = (set(), set(), [])
+                    child_complete = _collect(child, child_model, "", child_plan)
+                    child_plan[0].add(model_field.field.name)
+                    prefetches.append(
+                        Prefetch(
+                            lookup,
+                            queryset=_apply(
+                                child_model.objects.all(), child_plan, child_complete
+                            ),
+                        )
+                    )
+                else:
+                    complete = False
+                break
+
+            if depth == len(path) - 1:
+                if isinstance(field, serializers.Serializer):
+                    related.add(lookup)
+                    complete &= _collect(
+                        field, model_field.related_model, lookup + "__", plan
+                    )
+                else:
+                    columns.add(lookup)
+            elif model_field.is_relation:
+                related.add(lookup)
+                current = model_field.related_model
+            else:
+                complete = False
+                break
+
+    return complete
+
+
+def _apply(queryset, plan, complete):
+    columns, related, prefetches = plan
+    queryset = queryset.select_related(None).prefetch_related(None)
+    if related:
+        queryset = queryset.select_related(*related)
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    if complete:
+        queryset = queryset.only("pk", *columns)
+    return queryset
+
+
+def queryset_for_serializer(queryset, serializer):
+    """
+    Narrows `queryset` to what `serializer` renders: `only()` the columns
+    of its fields, joins for the relations it reads and prefetches with
+    their own column lists for nested lists. Everything else is dropped.
+    """
+    plan = (set(), set(), [])
+    complete = _collect(serializer, queryset.model, "", plan)
+    return _apply(queryset, plan, complete)
+
+
+class SparseQuerysetMixin:
+    """
+    Viewset mixin that fits the queryset of read requests to the fields
+    the serializer will render.
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        return queryset_for_serializer(queryset, self.get_serializer())
@@ -0,0 +1,67 @@
+"""
+Pooled HTTP client for outbound Stripe calls made from async code. httpx
+connections belong to the event loop that opened them, so there is one
+client per loop. Under ASGI that is the server's loop; sync code, such as
+the Celery workers, runs its coroutines through `run_async` on one
+background loop per process. Either way the pool lives as long as the
+process and keeps its connections alive from one batch to the next.
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+from django.conf import settings
+
+_clients = weakref.WeakKeyDictionary()
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_async_client():
+    """
+    Returns the client of the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=settings.OUTBOUND_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(settings.OUTBOUND_TIMEOUT),
+        )
+        _clients[loop] = client
+    return client
+
+
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="outbound-loop", daemon=True
+            ).start()
+        return _loop
+
+
+def _forget_loop():
+    # A forked child has the parent's loop object but not its thread.
+    global _loop, _loop_lock
+    _loop = None
+    _loop_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_loop)
+
+
+def run_async(func, *args):
+    """
+    Runs the coroutine function `func` from sync code on the process's
+    background loop and waits for its result. That loop runs on a thread
+    of its own, with its own database connection, so `func` should only
+    do I/O: read the rows before and save the results after, on the
+    calling thread. Not for use from async code, which would block its loop.
+    """
+    return asyncio.run_coroutine_threadsafe(func(*args), _background_loop()).result()
@@ -0,0 +1,245 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import (
+    BasePagination,
+    CursorPagination,
+    LimitOffsetPagination,
+    replace_query_param,
+)
+
+MAX_PAGE_SIZE = 100
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset pagination on the queryset's own ordering, or the view's
+    `cursor_ordering` when it has none, with the id appended as a tie
+    breaker. The cursor carries the last row's value of every ordering
+    field, and the next page is read with
+    `(f1 > v1) OR (f1 = v1 AND f2 > v2) OR ...`, so `?ordering=` and
+    search rank are kept. Ordering fields must not be null.
+    """
+
+    ordering = ("id",)
+    page_size_query_param = "page_size"
+    max_page_size = MAX_PAGE_SIZE
+    key_prefix = "cursor_key_"
+
+    def get_ordering(self, request, queryset, view):
+        ordering = tuple(queryset.query.order_by) or tuple(
+            getattr(view, "cursor_ordering", self.ordering)
+        )
+        if not all(isinstance(field, str) and field != "?" for field in ordering):
+            raise ValidationError(
+                {"pagination": ["This ordering cannot be paged with a cursor."]}
+            )
+        if ordering[-1].lstrip("-") not in ("id", "pk"):
+            ordering += ("id",)
+        return tuple(dict.fromkeys(ordering))
+
+    def _keys(self):
+        # (annotation alias, field, descending) per ordering field.
+        return [
+            (f"{self.key_prefix}{index}", field.lstrip("-"), field.startswith("-"))
+            for index, field in enumerate(self.ordering)
+        ]
+
+    def _after(self, values, reverse):
+        """
+        Filter for the rows after `values` in the ordering, or before them
+        when `reverse` is set.
+        """
+        condition = Q()
+        equal = Q()
+        for (alias, _, descending), value in zip(self._keys(), values):
+            lookup = "lt" if descending != reverse else "gt"
+            condition |= equal & Q(**{f"{alias}__{lookup}": value})
+            equal &= Q(**{alias: value})
+        return condition
+
+    def _values(self, row):
+        if isinstance(row, dict):
+            return [row[alias] for alias, _, _ in self._keys()]
+        return [getattr(row, alias) for alias, _, _ in self._keys()]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = self.cursor is not None and self.cursor["reverse"]
+
+        keys = self._keys()
+        queryset = queryset.annotate(
+            **{alias: F(field) for alias, field, _ in keys}
+        ).order_by(
+            *(
+                f"{'-' if descending != reverse else ''}{alias}"
+                for alias, _, descending in keys
+            )
+        )
+        if self.cursor is not None:
+            try:
+                queryset = queryset.filter(self._after(self.cursor["values"], reverse))
+            except (TypeError, ValueError, DjangoValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[: self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _link(self, row, reverse):
+        cursor = {"values": self._values(row), "reverse": reverse}
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, self.encode_cursor(cursor)
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self._link(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self._link(self.page[0], True)
+
+    def encode_cursor(self, cursor):
+        payload = {"o": self.ordering, "v": cursor["values"], "r": cursor["reverse"]}
+        return urlsafe_b64encode(
+            json.dumps(payload, cls=DjangoJSONEncoder).encode()
+        ).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            payload = json.loads(urlsafe_b64decode(encoded.encode()))
+            if (
+                tuple(payload["o"]) != self.ordering
+                or len(payload["v"]) != len(self.ordering)
+                or not isinstance(payload["r"], bool)
+            ):
+                raise ValueError(encoded)
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return {"values": payload["v"], "reverse": payload["r"]}
+
+
+class OffsetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination that skips the COUNT query for `?count=false`.
+    Without a count, one extra row is read to tell whether a next page exists.
+    """
+
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.count_query_param, "").lower() != "false":
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        self.count = None
+        self.offset = self.get_offset(request)
+        results = list(queryset[self.offset : self.offset + self.limit + 1])
+        self.has_next = len(results) > self.limit
+        return results[: self.limit]
+
+    def get_next_link(self):
+        if self.count is not None:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(
+            url, self.offset_query_param, self.offset + self.limit
+        )
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count"]["nullable"] = True
+        return response_schema
+
+    def get_schema_operation_parameters(self, view):
+        return super().get_schema_operation_parameters(view) + [
+            {
+                "name": self.count_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Set to false to skip counting the total results.",
+                "schema": {"type": "boolean"},
+            },
+        ]
+
+
+class LibraryPagination(BasePagination):
+    """
+    Limit/offset pagination by default, so existing clients keep working.
+    `?pagination=cursor` switches to keyset pagination, which stays fast on
+    deep pages and never counts the table.
+    """
+
+    mode_query_param = "pagination"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.mode_query_param) == "cursor":
+            self.paginator = KeysetPagination()
+        else:
+            self.paginator = OffsetPagination()
+            if not queryset.ordered:
+                queryset = queryset.order_by(
+                    *getattr(view, "cursor_ordering", KeysetPagination.ordering)
+                )
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return OffsetPagination().get_paginated_response_schema(schema)
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            *OffsetPagination().get_schema_operation_parameters(view),
+            {
+                "name": self.mode_query_param,
+                "required": False,
+                "in": "query",
+                "description": "Set to cursor for keyset pagination.",
+                "schema": {"type": "string", "enum": ["offset", "cursor"]},
+            },
+            *KeysetPagination().get_schema_operation_parameters(view),
+        ]
+
+    @property
+    def display_page_controls(self):
+        paginator = getattr(self, "paginator", None)
+        return bool(paginator and paginator.display_page_controls)
+
+    def to_html(self):
+        return self.paginator.to_html()
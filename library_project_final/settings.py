@@ -14,6 +14,7 @@ from datetime import timedelta
 from pathlib import Path
 import os
 import requests
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -29,9 +30,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.getenv("SECRET_KEY")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.getenv("ALLOWED_HOSTS", "").split(",") if host]
 
 
 # Application definition
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
     "user",
     "borrows",
     "payments",
+    "notifications",
     "django_extensions",
     "drf_spectacular",
 ]
@@ -88,12 +90,75 @@ WSGI_APPLICATION = "library_project_final.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# DATABASE_PROFILE picks the engine: "sqlite" (the default) or "postgres".
+
+DATABASE_PROFILE = os.getenv("DATABASE_PROFILE", "sqlite")
+
+if DATABASE_PROFILE == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("POSTGRES_DB", "library"),
+            "USER": os.getenv("POSTGRES_USER", "postgres"),
+            "PASSWORD": os.getenv("POSTGRES_PASSWORD", ""),
+            "HOST": os.getenv("POSTGRES_HOST", "localhost"),
+            "PORT": os.getenv("POSTGRES_PORT", "5432"),
+            # Each worker thread keeps its connection for up to
+            # CONN_MAX_AGE seconds, checked before reuse, so connections
+            # are pooled per process and a dropped one is replaced.
+            "CONN_MAX_AGE": int(os.getenv("POSTGRES_CONN_MAX_AGE", 600)),
+            "CONN_HEALTH_CHECKS": True,
+            # Set POSTGRES_POOLER=true behind PgBouncer in transaction
+            # mode, which cannot keep server-side cursors open.
+            "DISABLE_SERVER_SIDE_CURSORS": (
+                os.getenv("POSTGRES_POOLER", "false").lower() == "true"
+            ),
+        }
+    }
+elif DATABASE_PROFILE == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "library_project_final.sqlite_backend",
+            "NAME": os.getenv("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
+            "OPTIONS": {
+                # WAL lets readers run alongside the writer and NORMAL sync
+                # is safe with it short of power loss. Writers wait up to 20
+                # seconds for the lock; reads go through a memory map.
+                "init_command": (
+                    "PRAGMA journal_mode = WAL;"
+                    "PRAGMA synchronous = NORMAL;"
+                    "PRAGMA busy_timeout = 20000;"
+                    "PRAGMA mmap_size = 268435456;"
+                ),
+                "transaction_mode": "IMMEDIATE",
+            },
+            # A file-backed test database locks like the real one, which the
+            # concurrent borrow tests rely on.
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}")
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
     }
-}
 
 
 # Password validation
@@ -114,6 +179,28 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Passwords are hashed with PBKDF2 on the request thread, but only in a
+# free hashing slot: one of PASSWORD_HASH_PROCESS_SLOTS in the process,
+# fewer than GUNICORN_THREADS so that a login burst always leaves threads
+# for the other endpoints, and one of PASSWORD_HASH_SLOTS across the
+# deployment, which caps the CPUs hashing can take. The shared slots live
+# in the cache, so they only span processes with REDIS_URL set. Token and
+# registration requests that find no free slot get a 503 with Retry-After
+# at once; other callers, such as the admin, wait. Changing
+# PASSWORD_HASH_ITERATIONS rehashes passwords on their next login.
+PASSWORD_HASHERS = [
+    "user.hashers.PooledPBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+PASSWORD_HASH_ITERATIONS = int(os.getenv("PASSWORD_HASH_ITERATIONS", 720000))
+PASSWORD_HASH_PROCESS_SLOTS = int(os.getenv("PASSWORD_HASH_PROCESS_SLOTS", 2))
+PASSWORD_HASH_SLOTS = int(
+    os.getenv("PASSWORD_HASH_SLOTS", max(1, (os.cpu_count() or 1) // 2))
+)
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
@@ -131,6 +218,7 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
 STATIC_URL = "static/"
+STATIC_ROOT = os.getenv("STATIC_ROOT", BASE_DIR / "staticfiles")
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -138,14 +226,34 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
-    "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
-    ),
-    "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
+    "DEFAULT_AUTHENTICATION_CLASSES": ("user.authentication.CachedJWTAuthentication",),
+    "DEFAULT_PAGINATION_CLASS": "library_project_final.pagination.LibraryPagination",
     "PAGE_SIZE": 5,
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
+    "DEFAULT_RENDERER_CLASSES": (
+        "library_project_final.renderers.FastJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "library_project_final.parsers.FastJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
+    # Related fields in browsable API forms (the book of a borrowing)
+    # load at most this many choices instead of the whole table.
+    "HTML_SELECT_CUTOFF": 100,
+    # Token bucket sizes and refill periods of the throttled views.
+    "DEFAULT_THROTTLE_RATES": {
+        "token": os.getenv("THROTTLE_TOKEN_RATE", "10/min"),
+        "register": os.getenv("THROTTLE_REGISTER_RATE", "5/hour"),
+        "borrow_create": os.getenv("THROTTLE_BORROW_CREATE_RATE", "30/hour"),
+    },
 }
 
+# Build list responses of the book and borrow endpoints from .values()
+# rows instead of model instances and serializer fields.
+FAST_READ_PATH = os.getenv("FAST_READ_PATH", "true").lower() != "false"
+
 SPECTACULAR_SETTINGS = {
     "TITLE": "Library Service API",
     "DESCRIPTION": "Borrowing books",
@@ -166,6 +274,14 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": False,
 }
 
+# CachedJWTAuthentication keeps user state in the shared cache for
+# USER_CACHE_TTL seconds and in a per-process LRU for USER_CACHE_LOCAL_TTL
+# seconds. Saving a user clears both in the saving process; other
+# processes follow within the local TTL.
+USER_CACHE_TTL = 60
+USER_CACHE_LOCAL_TTL = 5
+USER_CACHE_LOCAL_SIZE = 1024
+
 from celery.schedules import crontab
 
 CELERY_BEAT_SCHEDULE = {
@@ -173,10 +289,27 @@ CELERY_BEAT_SCHEDULE = {
         "task": "borrows.tasks.check_overdue_borrowings",
         "schedule": crontab(hour=9, minute=30),  # Executes every day at 9:30 a.m.
     },
+    "flush-telegram-notifications": {
+        "task": "notifications.tasks.flush_notifications",
+        "schedule": 10.0,  # Delivers queued notifications every 10 seconds.
+    },
+    "process-payment-outbox": {
+        "task": "payments.tasks.drain_payment_outbox",
+        "schedule": 30.0,  # Picks up sessions that could not be created right away.
+    },
+    "generate-overdue-fines-every-night": {
+        "task": "payments.tasks.generate_overdue_fines",
+        "schedule": crontab(hour=2, minute=0),  # Executes every day at 2:00 a.m.
+    },
+    "expire-stale-payments": {
+        "task": "payments.tasks.expire_stale_payments",
+        # Catches sessions whose expiry webhook was missed.
+        "schedule": crontab(minute="*/15"),
+    },
 }
 
-CELERY_BROKER_URL = "redis://redis:6379"
-CELERY_RESULT_BACKEND = "redis://redis:6379"
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://redis:6379")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://redis:6379")
 CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
@@ -184,3 +317,20 @@ CELERY_TIMEZONE = "Europe/Berlin"
 
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
+STRIPE_CONNECT_TIMEOUT = 3.05
+STRIPE_READ_TIMEOUT = 10
+STRIPE_MAX_RETRIES = 2
+STRIPE_CIRCUIT_FAILURES = 5
+STRIPE_CIRCUIT_RESET_TIMEOUT = 30
+STRIPE_SESSIONS_PER_SECOND = 20
+
+# With ASYNC_OUTBOUND on, the payment outbox worker creates the Stripe
+# sessions of a batch OUTBOUND_CONCURRENCY at a time, over one httpx pool
+# per worker process. Telegram messages go to one chat in order, so they
+# are always sent one after the other.
+ASYNC_OUTBOUND = os.getenv("ASYNC_OUTBOUND", "false").lower() == "true"
+OUTBOUND_CONCURRENCY = 10
+OUTBOUND_MAX_CONNECTIONS = 20
+OUTBOUND_TIMEOUT = 10
@@ -0,0 +1,36 @@
+"""
+Production settings. Select them with
+DJANGO_SETTINGS_MODULE=library_project_final.settings_production.
+"""
+
+from library_project_final.settings import *  # noqa: F401,F403
+from library_project_final.settings import MIDDLEWARE, REST_FRAMEWORK
+
+DEBUG = False
+
+# WhiteNoise serves the collected static files, so it only runs where
+# collectstatic has filled STATIC_ROOT.
+MIDDLEWARE = [
+    MIDDLEWARE[0],
+    "whitenoise.middleware.WhiteNoiseMiddleware",
+    *MIDDLEWARE[1:],
+]
+
+# collectstatic writes gzip and brotli copies of every static file under a
+# hashed name, which WhiteNoise serves with far-future cache headers.
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
+    },
+}
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    # JSON only: no browsable API, so no HTML forms that render every
+    # related object as a select option.
+    "DEFAULT_RENDERER_CLASSES": ("library_project_final.renderers.FastJSONRenderer",),
+    "HTML_SELECT_CUTOFF": 0,
+}
@@ -0,0 +1,29 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend that takes two extra OPTIONS, as Django 5.1 does:
+    `init_command`, SQL run on every new connection (the PRAGMAs), and
+    `transaction_mode`. With "IMMEDIATE", transactions take the write lock
+    when they begin, so concurrent writers wait for it up to the busy
+    timeout; a deferred transaction that reads first and then writes fails
+    at once with "database is locked" instead.
+    """
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        kwargs.pop("init_command", None)
+        kwargs.pop("transaction_mode", None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        init_command = self.settings_dict["OPTIONS"].get("init_command")
+        if init_command:
+            conn.executescript(init_command)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict["OPTIONS"].get("transaction_mode")
+        self.cursor().execute(f"BEGIN {mode}" if mode else "BEGIN")
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+from rest_framework.throttling import ScopedRateThrottle
+
+logger = logging.getLogger(__name__)
+
+# Takes one token from the bucket at KEYS[1] after refilling it for the
+# time since the last call. ARGV: capacity, tokens per second. The time
+# is Redis's own, so hosts with skewed clocks share one timeline.
+# Returns {allowed, seconds to wait as a string}.
+TAKE_TOKEN_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(wait)}
+"""
+
+
+def _refill(tokens, last, now, capacity, rate):
+    tokens = min(capacity, tokens + max(0.0, now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, True, 0.0
+    return tokens, False, (1 - tokens) / rate
+
+
+class LocalBuckets:
+    """
+    In-process token buckets, used while Redis is unavailable. Updates
+    replace an immutable tuple without taking a lock, so two threads
+    racing for the last token may both get it; as a fallback that is an
+    acceptable trade for never blocking a request. Limits apply per
+    process rather than across the deployment.
+    """
+
+    def __init__(self, max_keys=10000, clock=time.time):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = {}
+
+    def take(self, key, capacity, rate):
+        now = self._clock()
+        tokens, last = self._buckets.get(key, (capacity, now))
+        tokens, allowed, wait = _refill(tokens, last, now, capacity, rate)
+        if key not in self._buckets and len(self._buckets) >= self.max_keys:
+            # Drop the oldest keys; they are the most likely to be full.
+            for stale in list(self._buckets)[: self.max_keys // 10 or 1]:
+                self._buckets.pop(stale, None)
+        self._buckets[key] = (tokens, now)
+        return allowed, wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RedisBuckets:
+    """
+    Token buckets shared by all processes, each updated atomically by a
+    Lua script. After a Redis error, Redis is skipped for `retry_after`
+    seconds and `fallback` answers instead.
+    """
+
+    def __init__(self, url, fallback, retry_after=5.0, timeout=0.1, clock=time.time):
+        self._client = redis.Redis.from_url(
+            url, socket_timeout=timeout, socket_connect_timeout=timeout
+        )
+        self._take = self._client.register_script(TAKE_TOKEN_SCRIPT)
+        self.fallback = fallback
+        self.retry_after = retry_after
+        self._clock = clock
+        self._down_until = 0.0
+
+    def take(self, key, capacity, rate):
+        now = self._clock()
+        if now < self._down_until:
+            return self.fallback.take(key, capacity, rate)
+        try:
+            allowed, wait = self._take(keys=[key], args=[capacity, rate])
+        except redis.RedisError as error:
+            logger.warning("Throttling falls back to local buckets: %s", error)
+            self._down_until = now + self.retry_after
+            return self.fallback.take(key, capacity, rate)
+        return bool(allowed), float(wait)
+
+
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets():
+    """
+    Returns the process-wide buckets: Redis when REDIS_URL is set, local
+    ones otherwise.
+    """
+    global _buckets
+    if _buckets is None:
+        with _buckets_lock:
+            if _buckets is None:
+                local = LocalBuckets()
+                if settings.REDIS_URL:
+                    _buckets = RedisBuckets(settings.REDIS_URL, local)
+                else:
+                    _buckets = local
+    return _buckets
+
+
+class TokenBucketThrottle(ScopedRateThrottle):
+    """
+    Token bucket per client for the view's `throttle_scope`, with the
+    rate taken from DEFAULT_THROTTLE_RATES: "10/min" is a bucket of ten
+    requests refilled evenly over a minute. Authenticated requests are
+    keyed by user, anonymous ones by IP.
+    """
+
+    cache_format = "throttle:%(scope)s:%(ident)s"
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = f"user:{request.user.pk}"
+        else:
+            ident = f"ip:{self.get_ident(request)}"
+        return self.cache_format % {"scope": self.scope, "ident": ident}
+
+    def allow_request(self, request, view):
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        allowed, self._wait = get_buckets().take(
+            self.key, self.num_requests, self.num_requests / self.duration
+        )
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class IPTokenBucketThrottle(TokenBucketThrottle):
+    """
+    Token bucket keyed by client IP, for authenticated requests too.
+    """
+
+    def get_cache_key(self, request, view):
+        ident = f"ip:{self.get_ident(request)}"
+        return self.cache_format % {"scope": self.scope, "ident": ident}
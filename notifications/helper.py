@@ -0,0 +1,18 @@
+from notifications.models import Notification
+
+
+def enqueue_notification(message):
+    """
+    Queues a Telegram message. Delivery happens in the
+    `flush_notifications` Celery task, so callers never wait on Telegram.
+    """
+    return Notification.objects.create(text=message)
+
+
+def enqueue_notifications(messages):
+    """
+    Queues several Telegram messages with a single INSERT.
+    """
+    return Notification.objects.bulk_create(
+        Notification(text=message) for message in messages
+    )
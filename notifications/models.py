@@ -0,0 +1,19 @@
+from django.db import models
+
+
+class Notification(models.Model):
+    """
+    A Telegram message waiting to be delivered by the notifications worker.
+    Rows are deleted once they have been sent.
+    """
+
+    text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("id",)
+
+    def __str__(self):
+        return f"Notification {self.id}: {self.text[:50]}"
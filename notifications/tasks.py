@@ -0,0 +1,106 @@
+import uuid
+from datetime import timedelta
+
+import requests
+from celery import shared_task
+from django.db.models import Q
+from django.utils import timezone
+
+from notifications.models import Notification
+from telegram_helper import TELEGRAM_MESSAGE_LIMIT, send_telegram_notification
+
+BATCH_SIZE = 100
+MAX_BATCHES_PER_RUN = 10
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def _merge_rows(rows, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Merges `(id, text)` rows like `merge_messages` and returns `(message,
+    ids)` pairs, where `ids` are the rows whose text ends in that message.
+    """
+    merged = []
+    current = ""
+    ids = []
+    for row_id, text in rows:
+        while len(text) > limit:
+            if current:
+                merged.append((current, ids))
+                current, ids = "", []
+            merged.append((text[:limit], []))
+            text = text[limit:]
+        if current and len(current) + 1 + len(text) > limit:
+            merged.append((current, ids))
+            current, ids = "", []
+        current = f"{current}\n{text}" if current else text
+        ids.append(row_id)
+    if ids:
+        merged.append((current, ids))
+    return merged
+
+
+def merge_messages(texts, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Joins queued texts into as few Telegram messages as possible,
+    keeping every message within the Telegram length limit.
+    """
+    return [message for message, _ in _merge_rows(enumerate(texts), limit) if message]
+
+
+def _claim_batch(size):
+    """
+    Marks up to `size` unclaimed notifications with a fresh claim token,
+    so concurrent flushes never pick up the same rows.
+    """
+    now = timezone.now()
+    token = uuid.uuid4()
+    available = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    ids = list(
+        Notification.objects.filter(available)
+        .order_by("id")
+        .values_list("id", flat=True)[:size]
+    )
+    if ids:
+        Notification.objects.filter(available, id__in=ids).update(
+            claim=token, claimed_until=now + CLAIM_TIMEOUT
+        )
+    return token
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(requests.RequestException,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    retry_jitter=True,
+    max_retries=8,
+)
+def flush_notifications(self, batch_size=BATCH_SIZE):
+    """
+    Delivers queued notifications in merged batches. Rows are deleted
+    once the message carrying them is sent; if a message fails, the rows
+    not yet sent are released for the next attempt and the task retries
+    with backoff. A text split over several messages is sent again in
+    full if one of its later parts fails.
+    """
+    delivered = 0
+    for _ in range(MAX_BATCHES_PER_RUN):
+        token = _claim_batch(batch_size)
+        claimed = Notification.objects.filter(claim=token)
+        rows = list(claimed.order_by("id").values_list("id", "text"))
+        if not rows:
+            break
+
+        try:
+            for message, ids in _merge_rows(rows):
+                if message:
+                    send_telegram_notification(message)
+                # Rows go as soon as their message is out, so a failure
+                # later in the batch cannot send them a second time.
+                claimed.filter(id__in=ids).delete()
+                delivered += len(ids)
+        except Exception:
+            claimed.update(claim=None, claimed_until=None)
+            raise
+
+    return delivered
@@ -0,0 +1,64 @@
+from unittest.mock import patch
+
+import requests
+from django.test import TestCase
+
+from notifications.helper import enqueue_notification
+from notifications.models import Notification
+from notifications.tasks import flush_notifications, merge_messages
+
+
+class MergeMessagesTest(TestCase):
+    def test_burst_is_merged_into_one_message(self):
+        self.assertEqual(merge_messages(["first", "second"]), ["first\nsecond"])
+
+    def test_messages_respect_the_length_limit(self):
+        merged = merge_messages(["a" * 6, "b" * 6, "c" * 15], limit=10)
+
+        self.assertEqual(merged, ["a" * 6, "b" * 6, "c" * 10, "c" * 5])
+
+
+class FlushNotificationsTest(TestCase):
+    @patch("notifications.tasks.send_telegram_notification")
+    def test_flush_sends_queued_messages_in_one_batch(self, mock_send):
+        enqueue_notification("Borrowing create: Book A, User a@mail.com")
+        enqueue_notification("Borrowing create: Book B, User b@mail.com")
+
+        delivered = flush_notifications()
+
+        self.assertEqual(delivered, 2)
+        mock_send.assert_called_once_with(
+            "Borrowing create: Book A, User a@mail.com\n"
+            "Borrowing create: Book B, User b@mail.com"
+        )
+        self.assertFalse(Notification.objects.exists())
+
+    @patch("notifications.tasks.send_telegram_notification")
+    def test_failed_batch_is_released_for_retry(self, mock_send):
+        mock_send.side_effect = requests.ConnectionError
+        enqueue_notification("Borrowing returned: Book A, User a@mail.com")
+
+        with self.assertRaises(requests.ConnectionError):
+            flush_notifications.run()
+
+        notification = Notification.objects.get()
+        self.assertIsNone(notification.claim)
+        self.assertIsNone(notification.claimed_until)
+
+    @patch("notifications.tasks.send_telegram_notification")
+    def test_sent_messages_are_not_released_when_a_later_one_fails(self, mock_send):
+        mock_send.side_effect = [None, requests.ConnectionError]
+        sent = enqueue_notification("a" * 3000)
+        failed = enqueue_notification("b" * 3000)
+
+        with self.assertRaises(requests.ConnectionError):
+            flush_notifications.run()
+
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertFalse(Notification.objects.filter(pk=sent.pk).exists())
+        self.assertIsNone(Notification.objects.get(pk=failed.pk).claim)
+
+    @patch("notifications.tasks.send_telegram_notification")
+    def test_flush_without_queued_messages(self, mock_send):
+        self.assertEqual(flush_notifications(), 0)
+        mock_send.assert_not_called()
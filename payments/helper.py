@@ -1,12 +1,33 @@
+import asyncio
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
 import stripe
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Round
+from django.utils import timezone
 
-from library_project_final import settings
-from payments.models import Payment
+from borrows.models import FINE_MULTIPLIER, MONEY
+from library_project_final.outbound import run_async
+from payments.models import Payment, PaymentOutbox
+from payments.stripe_client import get_stripe_client
 
 from datetime import datetime
 
 
-FINE_MULTIPLIER = 2
+logger = logging.getLogger(__name__)
+
+# Stripe accepts session lifetimes of 30 minutes to 24 hours.
+SESSION_LIFETIME = timedelta(hours=23)
+# A session this close to expiry is not handed out again.
+SESSION_REUSE_MARGIN = timedelta(minutes=10)
+# Stripe's clock may run behind ours; until this long after its expiry a
+# replaced session is expired explicitly.
+SESSION_EXPIRY_SKEW = timedelta(minutes=1)
+FINE_BATCH_SIZE = 1000
 
 
 def calculate_total_price(borrowing):
@@ -23,40 +44,307 @@ def calculate_total_price(borrowing):
     return total_price
 
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+def fine_due():
+    """
+    Expression for the fine a borrowing annotated by `with_fees()` still
+    owes: its overdue days at `FINE_MULTIPLIER` times the daily fee, less
+    the fines already paid.
+    """
+    paid = (
+        Payment.objects.filter(
+            borrowing=OuterRef("pk"),
+            type=Payment.TypeChoices.FINE,
+            status=Payment.StatusChoices.PAID,
+        )
+        .values("borrowing")
+        .annotate(total=Sum("money_to_pay"))
+        .values("total")
+    )
+    # Rounded so that SQLite's float arithmetic compares equal to the
+    # stored amounts.
+    return Round(
+        F("overdue_days") * F("book__daily_fee") * FINE_MULTIPLIER
+        - Coalesce(Subquery(paid), Value(Decimal(0), MONEY)),
+        2,
+        output_field=MONEY,
+    )
+
+
+def sync_overdue_fines(borrowings, today, batch_size=FINE_BATCH_SIZE):
+    """
+    Brings the FINE payments of `borrowings` in line with what they owe,
+    in set-based queries. Unpaid fines that changed get the new amount in
+    one UPDATE, which also marks their Stripe session as no longer live,
+    and are queued in the outbox for a new one. Borrowings without an unpaid fine get one
+    through `bulk_create` in batches of `batch_size`, queued likewise.
+    Returns the numbers of created and updated fines.
+    """
+    owing = borrowings.with_fees(today).annotate(due=fine_due()).filter(due__gt=0)
+    unpaid = Payment.objects.filter(
+        type=Payment.TypeChoices.FINE,
+        status__in=[Payment.StatusChoices.PENDING, Payment.StatusChoices.EXPIRED],
+    )
+
+    due = Subquery(owing.filter(pk=OuterRef("borrowing_id")).values("due")[:1])
+    # The session of a changed fine asks for the old amount, so a new one
+    # is queued below. The old one stays on the payment until the outbox
+    # has expired it at Stripe, so that a webhook for it still matches.
+    updated = (
+        unpaid.filter(borrowing__in=owing.values("pk"))
+        .exclude(money_to_pay=due)
+        .update(money_to_pay=due, expires_at=None)
+    )
+    unqueued = (
+        unpaid.filter(expires_at__isnull=True)
+        .exclude(Exists(PaymentOutbox.objects.filter(payment=OuterRef("pk"))))
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    queued = 0
+    while True:
+        batch = list(unqueued[:batch_size])
+        if not batch:
+            break
+        PaymentOutbox.objects.bulk_create(
+            (PaymentOutbox(payment_id=payment_id) for payment_id in batch),
+            ignore_conflicts=True,
+        )
+        queued += len(batch)
+
+    missing = (
+        owing.exclude(Exists(unpaid.filter(borrowing=OuterRef("pk"))))
+        .order_by("pk")
+        .values_list("pk", "due")
+    )
+    created = 0
+    last_pk = 0
+    while True:
+        batch = list(missing.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        with transaction.atomic():
+            payments = Payment.objects.bulk_create(
+                Payment(
+                    status=Payment.StatusChoices.PENDING,
+                    type=Payment.TypeChoices.FINE,
+                    borrowing_id=borrowing_id,
+                    money_to_pay=amount,
+                )
+                for borrowing_id, amount in batch
+            )
+            PaymentOutbox.objects.bulk_create(
+                PaymentOutbox(payment=payment) for payment in payments
+            )
+        created += len(payments)
 
+    if created or queued:
+        transaction.on_commit(schedule_payment_outbox)
+    return created, updated
 
-def create_stripe_session(borrowing):
-    # Calculate the total price of borrowing
-    total_price = calculate_total_price(borrowing)
 
-    # Create a new Stripe Session
-    session = stripe.checkout.Session.create(
+def has_live_session(payment):
+    """
+    Tells whether the payment has a Checkout Session that can still be
+    handed out to the user.
+    """
+    return (
+        payment.status == Payment.StatusChoices.PENDING
+        and bool(payment.session_id)
+        and payment.expires_at is not None
+        and payment.expires_at > timezone.now() + SESSION_REUSE_MARGIN
+    )
+
+
+def _open_session(payment):
+    """
+    Returns the id of the payment's session if it may still be open at
+    Stripe, so that it has to be expired before it is replaced. Sessions
+    of expired payments have run out or failed to pay.
+    """
+    if not payment.session_id or payment.status == Payment.StatusChoices.EXPIRED:
+        return None
+    if (
+        payment.expires_at is not None
+        and payment.expires_at < timezone.now() - SESSION_EXPIRY_SKEW
+    ):
+        return None
+    return payment.session_id
+
+
+def create_pending_payment(
+    borrowing, amount=None, payment_type=Payment.TypeChoices.PAYMENT
+):
+    """
+    Returns the unpaid payment of the borrowing for this type and amount,
+    creating it if there is none, and queues a Stripe session in the
+    outbox unless the payment already has a live one. Runs only database
+    writes, so it can be part of the borrowing transaction.
+    """
+    if amount is None:
+        amount = calculate_total_price(borrowing)
+
+    payment = (
+        Payment.objects.filter(
+            borrowing=borrowing, type=payment_type, money_to_pay=amount
+        )
+        .exclude(status=Payment.StatusChoices.PAID)
+        .order_by("-id")
+        .first()
+    )
+    if payment is None:
+        payment = Payment.objects.create(
+            status=Payment.StatusChoices.PENDING,
+            type=payment_type,
+            borrowing=borrowing,
+            money_to_pay=amount,
+        )
+    elif has_live_session(payment):
+        return payment
+
+    _, queued = PaymentOutbox.objects.get_or_create(payment=payment)
+    if queued:
+        transaction.on_commit(schedule_payment_outbox)
+
+    return payment
+
+
+def schedule_payment_outbox():
+    """
+    Asks a worker to drain the outbox right away. Failing to reach the
+    broker is not an error: the periodic run picks the entry up later.
+    """
+    from payments.tasks import drain_payment_outbox
+
+    try:
+        drain_payment_outbox.apply_async(retry=False)
+    except Exception:
+        logger.warning("Could not schedule the payment outbox", exc_info=True)
+
+
+def _session_params(payment, expires_at):
+    return dict(
         payment_method_types=["card"],
         line_items=[
             {
                 "price_data": {
                     "currency": "usd",
                     "product_data": {
-                        "name": borrowing.book.title,
+                        "name": payment.borrowing.book.title,
                     },
-                    "unit_amount": int(total_price * 100),
+                    "unit_amount": int(payment.money_to_pay * 100),
                 },
                 "quantity": 1,
             }
         ],
         mode="payment",
+        expires_at=int(expires_at.timestamp()),
         success_url="http://localhost:8000/api/payments/payment-success/{CHECKOUT_SESSION_ID}/",
         cancel_url="http://localhost:8000/api/payments/payment-cancelled/",
     )
 
-    payment = Payment.objects.create(
-        status=Payment.StatusChoices.PENDING,
-        type=Payment.TypeChoices.PAYMENT,
-        borrowing=borrowing,
-        session_url=f"https://checkout.stripe.com/pay/{session.id}",
-        session_id=session.id,
-        money_to_pay=total_price,
-    )
 
+def _save_session(payment, session, expires_at):
+    # Only replace the session the caller has seen, so a concurrent refresh
+    # or a payment that was settled meanwhile is left alone.
+    values = {
+        "status": Payment.StatusChoices.PENDING,
+        "session_id": session.id,
+        "session_url": f"https://checkout.stripe.com/pay/{session.id}",
+        "expires_at": expires_at,
+    }
+    updated = (
+        Payment.objects.filter(pk=payment.pk, session_id=payment.session_id)
+        .exclude(status=Payment.StatusChoices.PAID)
+        .update(**values)
+    )
+    payment.refresh_from_db(fields=list(values))
+    if not updated:
+        logger.info("Payment %s changed while its session was refreshed", payment.pk)
     return payment
+
+
+def _expire_session(client, session_id):
+    """
+    Expires a session at Stripe so that its URL can no longer be paid.
+    Stripe refuses sessions that are not open; one that expired on its
+    own is fine, but one that was completed raises, and the payment keeps
+    it for the webhook to settle.
+    """
+    try:
+        client.expire_checkout_session(session_id)
+    except stripe.error.InvalidRequestError:
+        if client.retrieve_checkout_session(session_id).status != "expired":
+            raise
+
+
+async def _expire_session_async(client, session_id):
+    try:
+        await client.expire_checkout_session_async(session_id)
+    except stripe.error.InvalidRequestError:
+        session = await client.retrieve_checkout_session_async(session_id)
+        if session.status != "expired":
+            raise
+
+
+def create_stripe_session(payment):
+    """
+    Makes sure the payment has a live Checkout Session. A live session is
+    reused; a missing or expired one is replaced in place, which also
+    brings an expired payment back to pending. A replaced session that may
+    still be open is expired at Stripe first, so that only the session
+    stored on the payment can be paid.
+    """
+    if has_live_session(payment):
+        return payment
+
+    client = get_stripe_client()
+    old_session = _open_session(payment)
+    if old_session:
+        _expire_session(client, old_session)
+    expires_at = timezone.now() + SESSION_LIFETIME
+    session = client.create_checkout_session(**_session_params(payment, expires_at))
+    return _save_session(payment, session, expires_at)
+
+
+async def _request_sessions(requests):
+    client = get_stripe_client()
+    semaphore = asyncio.Semaphore(settings.OUTBOUND_CONCURRENCY)
+
+    async def request(old_session, params):
+        async with semaphore:
+            try:
+                if old_session:
+                    await _expire_session_async(client, old_session)
+                return await client.create_checkout_session_async(**params)
+            except stripe.error.StripeError as error:
+                return error
+
+    return await asyncio.gather(*(request(*arguments) for arguments in requests))
+
+
+def create_stripe_sessions(payments):
+    """
+    `create_stripe_session` for a batch: the Stripe calls are made
+    OUTBOUND_CONCURRENCY at a time over the shared outbound pool, while
+    the payments are saved on the calling thread. The payments must come
+    with their borrowing and book loaded. Returns the Stripe error of each
+    payment, None for success.
+    """
+    expires_at = timezone.now() + SESSION_LIFETIME
+    stale = [payment for payment in payments if not has_live_session(payment)]
+    sessions = run_async(
+        _request_sessions,
+        [
+            (_open_session(payment), _session_params(payment, expires_at))
+            for payment in stale
+        ],
+    )
+
+    errors = {}
+    for payment, session in zip(stale, sessions):
+        if isinstance(session, stripe.error.StripeError):
+            errors[payment.pk] = session
+        else:
+            _save_session(payment, session, expires_at)
+    return [errors.get(payment.pk) for payment in payments]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.4 on 2026-10-18 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("borrows", "0004_borrow_active_indexes"),
+        ("payments", "0003_payment_status_expired"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                condition=models.Q(("status", "Pending")),
+                fields=["expires_at"],
+                name="payment_pending_expiry_idx",
+            ),
+        ),
+    ]
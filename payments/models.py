@@ -8,6 +8,7 @@ class Payment(models.Model):
     class StatusChoices(models.TextChoices):
         PENDING = "Pending"
         PAID = "Paid"
+        EXPIRED = "Expired"
 
     class TypeChoices(models.TextChoices):
         PAYMENT = "Payment"
@@ -16,9 +17,40 @@ class Payment(models.Model):
     status = models.CharField(max_length=10, choices=StatusChoices.choices)
     type = models.CharField(max_length=10, choices=TypeChoices.choices)
     borrowing = models.ForeignKey(Borrow, on_delete=models.CASCADE)
-    session_url = models.URLField()
-    session_id = models.CharField(max_length=255, blank=True)
+    session_url = models.URLField(blank=True)
+    session_id = models.CharField(max_length=255, blank=True, db_index=True)
     money_to_pay = models.DecimalField(max_digits=10, decimal_places=2)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["expires_at"],
+                condition=models.Q(status="Pending"),
+                name="payment_pending_expiry_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"Status {self.status}; Type {self.type}; Session id {self.session_id}"
+
+
+class PaymentOutbox(models.Model):
+    """
+    A payment whose Stripe Checkout Session still has to be created.
+    Written in the same transaction as the payment and deleted by the
+    outbox worker once the session exists.
+    """
+
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ("id",)
+
+    def __str__(self):
+        return f"Outbox for payment {self.payment_id}; Attempts {self.attempts}"
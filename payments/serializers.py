@@ -1,15 +1,19 @@
 from rest_framework import serializers
 
+from library_project_final.fieldsets import SparseFieldsetMixin
 from payments.models import Payment
 
+BORROWING_SERIALIZER = "borrows.serializers.BorrowSummarySerializer"
 
-class PaymentSerializer(serializers.ModelSerializer):
+
+class PaymentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = "__all__"
 
 
-class PaymentListSerializer(serializers.ModelSerializer):
+class PaymentListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    expandable_fields = {"borrowing": BORROWING_SERIALIZER}
 
     class Meta:
         model = Payment
@@ -21,7 +25,9 @@ class PaymentListSerializer(serializers.ModelSerializer):
         )
 
 
-class PaymentDetailSerializer(serializers.ModelSerializer):
+class PaymentDetailSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    expandable_fields = {"borrowing": BORROWING_SERIALIZER}
+
     class Meta:
         model = Payment
         fields = (
@@ -32,4 +38,16 @@ class PaymentDetailSerializer(serializers.ModelSerializer):
             "session_url",
             "session_id",
             "money_to_pay",
+            "expires_at",
+        )
+
+
+class PaymentCheckoutSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = (
+            "id",
+            "status",
+            "session_url",
+            "expires_at",
         )
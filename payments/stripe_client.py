@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+
+import httpx
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from library_project_final.outbound import get_async_client
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY_PREFIX = "payments:stripe:"
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000)
+COUNTERS = ("requests", "errors", "retries", "rejected", "latency_ms_total")
+
+
+class CircuitOpenError(stripe.error.StripeError):
+    """
+    Raised instead of calling Stripe while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` failed calls in a row and then rejects
+    calls for `reset_timeout` seconds. After that a single trial call is
+    let through: success closes the circuit, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return self.CLOSED
+            if self._clock() - self._opened_at < self.reset_timeout:
+                return self.OPEN
+            return self.HALF_OPEN
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+                self._trial = False
+
+
+class StripeMetrics:
+    """
+    Request, error, retry and latency counters, kept in the cache so that
+    every web and worker process adds to the same totals.
+    """
+
+    def incr(self, name, delta=1):
+        key = METRICS_KEY_PREFIX + name
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            if not cache.add(key, delta, None):
+                cache.incr(key, delta)
+
+    def observe(self, latency_ms, failed):
+        self.incr("requests")
+        self.incr("latency_ms_total", round(latency_ms))
+        if failed:
+            self.incr("errors")
+        bucket = next(
+            (f"le_{bound}" for bound in LATENCY_BUCKETS_MS if latency_ms <= bound),
+            "le_inf",
+        )
+        self.incr(f"latency_ms_{bucket}")
+
+    def snapshot(self):
+        buckets = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ["le_inf"]
+        names = list(COUNTERS) + [f"latency_ms_{bucket}" for bucket in buckets]
+        values = cache.get_many([METRICS_KEY_PREFIX + name for name in names])
+        return {name: values.get(METRICS_KEY_PREFIX + name, 0) for name in names}
+
+
+class PooledHTTPXClient(stripe.HTTPXClient):
+    """
+    Stripe's httpx client, sending async requests through the shared
+    outbound pool of the running event loop instead of a client of its own.
+    """
+
+    def __init__(self, timeout):
+        # Skip HTTPXClient.__init__, which opens a client per instance.
+        stripe.HTTPClient.__init__(self)
+        self.httpx = httpx
+        self.anyio = None
+        self._client = None
+        self._timeout = timeout
+
+    @property
+    def _client_async(self):
+        return get_async_client()
+
+    def sleep_async(self, secs):
+        return asyncio.sleep(secs)
+
+
+def _is_retryable(error):
+    if isinstance(
+        error, (stripe.error.APIConnectionError, stripe.error.RateLimitError)
+    ):
+        return True
+    return isinstance(error, stripe.error.APIError) and (
+        error.http_status is None or error.http_status >= 500
+    )
+
+
+class StripeClient:
+    """
+    Stripe API access with a pooled keep-alive HTTP session, connect and
+    read timeouts on every request, bounded retries with full jitter
+    (reusing one idempotency key per call) and a circuit breaker that
+    fails fast while Stripe is unreachable. The `_async` methods do the
+    same over the shared outbound httpx pool.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        *,
+        api_base=None,
+        timeout=(3.05, 10),
+        max_retries=2,
+        backoff=0.5,
+        max_backoff=4.0,
+        pool_size=10,
+        breaker=None,
+        metrics=None,
+        sleep=time.sleep,
+    ):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        self._client = stripe.StripeClient(
+            api_key,
+            base_addresses={"api": api_base} if api_base else {},
+            http_client=stripe.RequestsClient(
+                timeout=timeout,
+                session=session,
+                async_fallback_client=PooledHTTPXClient(
+                    httpx.Timeout(timeout[1], connect=timeout[0])
+                ),
+            ),
+            max_network_retries=0,
+        )
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics or StripeMetrics()
+        self._sleep = sleep
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _start(self, operation):
+        if not self.breaker.allow():
+            self.metrics.incr("rejected")
+            raise CircuitOpenError(f"Stripe circuit is open, {operation} skipped")
+        return {"idempotency_key": str(uuid.uuid4())}
+
+    def _should_retry(self, operation, error, attempt, started):
+        self.metrics.observe((time.perf_counter() - started) * 1000, True)
+        if not _is_retryable(error):
+            # Stripe answered, so it is up; the request was wrong.
+            self.breaker.record_success()
+            return False
+        if attempt == self.max_retries:
+            self.breaker.record_failure()
+            logger.warning("Stripe %s failed: %s", operation, error)
+            return False
+        self.metrics.incr("retries")
+        return True
+
+    def _succeeded(self, started):
+        self.metrics.observe((time.perf_counter() - started) * 1000, False)
+        self.breaker.record_success()
+
+    def call(self, operation, request):
+        """
+        Runs `request(options)` against Stripe, where `options` carries the
+        idempotency key shared by all attempts of this call.
+        """
+        options = self._start(operation)
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = request(options)
+            except stripe.error.StripeError as error:
+                if not self._should_retry(operation, error, attempt, started):
+                    raise
+                self._sleep(self._delay(attempt))
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            else:
+                self._succeeded(started)
+                return result
+
+    async def call_async(self, operation, request):
+        """
+        Like `call`, for a `request(options)` that returns an awaitable.
+        """
+        options = self._start(operation)
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                result = await request(options)
+            except stripe.error.StripeError as error:
+                if not self._should_retry(operation, error, attempt, started):
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            else:
+                self._succeeded(started)
+                return result
+
+    def create_checkout_session(self, **params):
+        return self.call(
+            "checkout.sessions.create",
+            lambda options: self._client.checkout.sessions.create(
+                params=params, options=options
+            ),
+        )
+
+    async def create_checkout_session_async(self, **params):
+        return await self.call_async(
+            "checkout.sessions.create",
+            lambda options: self._client.checkout.sessions.create_async(
+                params=params, options=options
+            ),
+        )
+
+    def expire_checkout_session(self, session_id):
+        return self.call(
+            "checkout.sessions.expire",
+            lambda options: self._client.checkout.sessions.expire(
+                session_id, options=options
+            ),
+        )
+
+    async def expire_checkout_session_async(self, session_id):
+        return await self.call_async(
+            "checkout.sessions.expire",
+            lambda options: self._client.checkout.sessions.expire_async(
+                session_id, options=options
+            ),
+        )
+
+    def retrieve_checkout_session(self, session_id):
+        return self.call(
+            "checkout.sessions.retrieve",
+            lambda options: self._client.checkout.sessions.retrieve(
+                session_id, options=options
+            ),
+        )
+
+    async def retrieve_checkout_session_async(self, session_id):
+        return await self.call_async(
+            "checkout.sessions.retrieve",
+            lambda options: self._client.checkout.sessions.retrieve_async(
+                session_id, options=options
+            ),
+        )
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_stripe_client():
+    """
+    Returns the process-wide StripeClient, built from settings on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = StripeClient(
+                    settings.STRIPE_SECRET_KEY,
+                    api_base=settings.STRIPE_API_BASE,
+                    timeout=(
+                        settings.STRIPE_CONNECT_TIMEOUT,
+                        settings.STRIPE_READ_TIMEOUT,
+                    ),
+                    max_retries=settings.STRIPE_MAX_RETRIES,
+                    breaker=CircuitBreaker(
+                        settings.STRIPE_CIRCUIT_FAILURES,
+                        settings.STRIPE_CIRCUIT_RESET_TIMEOUT,
+                    ),
+                )
+    return _client
+
+
+def circuit_state():
+    """
+    Returns the circuit breaker state of this process's client.
+    """
+    if _client is None:
+        return CircuitBreaker.CLOSED
+    return _client.breaker.state
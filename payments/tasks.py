@@ -0,0 +1,206 @@
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+import stripe
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from borrows.models import Borrow
+from payments.helper import (
+    create_stripe_session,
+    create_stripe_sessions,
+    sync_overdue_fines,
+)
+from payments.models import Payment, PaymentOutbox
+from payments.stripe_client import CircuitOpenError
+
+BATCH_SIZE = 50
+EXPIRE_BATCH_SIZE = 1000
+CLAIM_TIMEOUT = timedelta(minutes=5)
+DRAIN_LOCK_KEY = "payments:outbox:drain"
+# Seconds; refreshed by every batch, so it only runs out if a drain dies.
+DRAIN_LOCK_TIMEOUT = 60
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+logger = logging.getLogger(__name__)
+
+
+def _available(now):
+    return Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+
+
+def _claim_batch(size):
+    """
+    Marks up to `size` due outbox entries with a fresh claim token,
+    so concurrent workers never create two sessions for one payment.
+    """
+    now = timezone.now()
+    token = uuid.uuid4()
+    available = _available(now)
+    ids = list(
+        PaymentOutbox.objects.filter(available)
+        .order_by("id")
+        .values_list("id", flat=True)[:size]
+    )
+    if ids:
+        PaymentOutbox.objects.filter(available, id__in=ids).update(
+            claim=token, claimed_until=now + CLAIM_TIMEOUT
+        )
+    return token
+
+
+def _retry_delay(attempts):
+    return min(timedelta(seconds=2**attempts), MAX_RETRY_DELAY)
+
+
+def _create_sessions(entries):
+    """
+    Creates the sessions one after the other and returns the error of each
+    entry, None for success. Once the circuit is open the remaining
+    entries get its error without calling Stripe.
+    """
+    errors = []
+    for entry in entries:
+        if errors and isinstance(errors[-1], CircuitOpenError):
+            errors.append(errors[-1])
+            continue
+        try:
+            create_stripe_session(entry.payment)
+        except stripe.error.StripeError as error:
+            errors.append(error)
+        else:
+            errors.append(None)
+    return errors
+
+
+@shared_task
+def process_payment_outbox(batch_size=BATCH_SIZE):
+    """
+    Creates Stripe sessions for queued payments, concurrently when
+    ASYNC_OUTBOUND is on. Entries that fail stay in the outbox and become
+    due again after an exponential backoff.
+    """
+    token = _claim_batch(batch_size)
+    entries = list(
+        PaymentOutbox.objects.filter(claim=token).select_related(
+            "payment__borrowing__book"
+        )
+    )
+    if settings.ASYNC_OUTBOUND:
+        errors = create_stripe_sessions([entry.payment for entry in entries])
+    else:
+        errors = _create_sessions(entries)
+
+    done = []
+    released = []
+    for entry, error in zip(entries, errors):
+        if error is None:
+            done.append(entry.pk)
+        elif isinstance(error, CircuitOpenError):
+            # Stripe is known to be down: hand the entry back without
+            # counting an attempt against it.
+            released.append(entry.pk)
+        else:
+            entry.attempts += 1
+            entry.last_error = str(error)[:255]
+            entry.claim = None
+            entry.claimed_until = timezone.now() + _retry_delay(entry.attempts)
+            entry.save(
+                update_fields=["attempts", "last_error", "claim", "claimed_until"]
+            )
+
+    PaymentOutbox.objects.filter(pk__in=released).update(claim=None, claimed_until=None)
+    PaymentOutbox.objects.filter(pk__in=done).delete()
+    return len(done)
+
+
+def _has_due_entries(**filters):
+    return PaymentOutbox.objects.filter(_available(timezone.now()), **filters).exists()
+
+
+@shared_task
+def drain_payment_outbox(batch_size=BATCH_SIZE, per_second=None, lock=None):
+    """
+    Works through the outbox one batch at a time and reschedules itself
+    while due entries remain. Batches are spaced so that no more than
+    `per_second` sessions (STRIPE_SESSIONS_PER_SECOND by default) are
+    created per second, which keeps large fine runs under the Stripe
+    rate limit. The limit holds across workers because only one drain
+    runs at a time: it holds a cache lock, passed on to its rescheduled
+    run as `lock`, and any other drain exits at once.
+    """
+    per_second = per_second or settings.STRIPE_SESSIONS_PER_SECOND
+    if lock is None:
+        lock = str(uuid.uuid4())
+        if not cache.add(DRAIN_LOCK_KEY, lock, DRAIN_LOCK_TIMEOUT):
+            return 0
+    elif cache.get(DRAIN_LOCK_KEY) == lock:
+        cache.touch(DRAIN_LOCK_KEY, DRAIN_LOCK_TIMEOUT)
+    else:
+        # The lock ran out and another drain has taken over.
+        return 0
+
+    started_at = timezone.now()
+    started = time.monotonic()
+    processed = process_payment_outbox(batch_size)
+    countdown = max(0.0, batch_size / per_second - (time.monotonic() - started))
+
+    if processed and _has_due_entries():
+        drain_payment_outbox.apply_async(
+            (batch_size, per_second, lock), countdown=countdown
+        )
+        return processed
+
+    if cache.get(DRAIN_LOCK_KEY) == lock:
+        cache.delete(DRAIN_LOCK_KEY)
+    # Drains scheduled for entries queued meanwhile found the lock taken.
+    if _has_due_entries(created_at__gte=started_at):
+        drain_payment_outbox.apply_async((batch_size, per_second), countdown=countdown)
+    return processed
+
+
+@shared_task
+def generate_overdue_fines():
+    """
+    Creates or updates the FINE payments of all borrowings that are out
+    past their return date; new fines get their sessions through the
+    rate-limited outbox drain.
+    """
+    started_at = time.time()
+    today = timezone.now().date()
+    overdue = Borrow.objects.filter(
+        actual_return__isnull=True, expected_return__lt=today
+    )
+
+    created, updated = sync_overdue_fines(overdue, today)
+
+    seconds = round(time.time() - started_at, 3)
+    logger.info(
+        "Overdue fines: %s created, %s updated in %ss", created, updated, seconds
+    )
+    return {"created": created, "updated": updated, "seconds": seconds}
+
+
+@shared_task
+def expire_stale_payments(batch_size=EXPIRE_BATCH_SIZE):
+    """
+    Marks pending payments whose Checkout Session has run out as expired,
+    in batches of single UPDATE statements. Backs up the
+    `checkout.session.expired` webhook; an expired payment gets a new
+    session the next time someone checks it out.
+    """
+    now = timezone.now()
+    stale = Payment.objects.filter(
+        status=Payment.StatusChoices.PENDING, expires_at__lt=now
+    )
+    expired = 0
+    while True:
+        ids = list(stale.order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return expired
+        expired += stale.filter(id__in=ids).update(status=Payment.StatusChoices.EXPIRED)
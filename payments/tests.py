@@ -1,18 +1,57 @@
-from unittest.mock import patch, MagicMock
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from unittest.mock import AsyncMock, patch, MagicMock
+
+import stripe
+from asgiref.sync import async_to_sync
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase, RequestFactory
+from django.db import connection
+from django.core.cache import cache
+from django.http import Http404
+from django.test import Client, TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
 from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.reverse import reverse
 from rest_framework.test import APIClient
 
 from books.models import Book
+from library_project_final.parsers import FastJSONParser
+from library_project_final.renderers import FastJSONRenderer
 from borrows.models import Borrow
-from payments.models import Payment
+from payments.helper import create_pending_payment, sync_overdue_fines
+from payments.models import Payment, PaymentOutbox
 from payments.serializers import PaymentListSerializer, PaymentDetailSerializer
+from payments import stripe_client
+from payments.stripe_client import (
+    CircuitBreaker,
+    CircuitOpenError,
+    StripeClient,
+    StripeMetrics,
+)
+from payments.tasks import (
+    DRAIN_LOCK_KEY,
+    drain_payment_outbox,
+    expire_stale_payments,
+    generate_overdue_fines,
+    process_payment_outbox,
+)
 from payments.views import payment_success, payment_cancelled
 
 PAYMENTS_URLS = reverse("payments:payment-list")
+WEBHOOK_URL = reverse("payments:stripe_webhook")
 
 
 def sample_payments(user, book, **params):
@@ -73,6 +112,27 @@ class AuthenticatedPaymentsTests(TestCase):
 
         self.assertEqual(response.data["results"], serializer.data)
 
+    def test_payments_of_other_users_are_hidden(self):
+        other = get_user_model().objects.create_user(
+            email="other@mail.com", password="password"
+        )
+        own = sample_payments(self.user, self.book)
+        foreign = sample_payments(other, self.book)
+
+        response = self.client.get(PAYMENTS_URLS, {"expand": "borrowing"})
+        detail = self.client.get(
+            reverse("payments:payment-detail", kwargs={"pk": foreign.pk}),
+            {"expand": "borrowing"},
+        )
+
+        self.assertEqual([row["id"] for row in response.data["results"]], [own.id])
+        self.assertEqual(detail.status_code, status.HTTP_404_NOT_FOUND)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(PAYMENTS_URLS)
+        self.assertEqual(response.data["count"], 2)
+
     def test_payments_detail(self):
         payment = sample_payments(self.user, self.book)
         url = reverse("payments:payment-detail", kwargs={"pk": payment.pk})
@@ -82,6 +142,134 @@ class AuthenticatedPaymentsTests(TestCase):
         self.assertEqual(response.data, serializer.data)
 
 
+class PaymentSparseFieldsetTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client.force_authenticate(self.user)
+        book = Book.objects.create(
+            title="Sample", author="Name", cover="Hard", inventory=3, daily_fee=2
+        )
+        self.payment = sample_payments(self.user, book)
+
+    def test_list_fields_skip_borrowing_join(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(PAYMENTS_URLS, {"fields": "id,status"})
+
+        self.assertEqual(
+            response.data["results"], [{"id": self.payment.id, "status": "Pending"}]
+        )
+        # The borrowing is joined to scope the list, but not selected.
+        self.assertNotIn('"borrows_borrow"."borrow_date"', queries[-1]["sql"])
+        self.assertNotIn("session_url", queries[-1]["sql"])
+
+    def test_expand_borrowing(self):
+        url = reverse("payments:payment-detail", kwargs={"pk": self.payment.pk})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"expand": "borrowing"})
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(
+            response.data["borrowing"],
+            {
+                "id": self.payment.borrowing_id,
+                "borrow_date": "2022-01-21",
+                "expected_return": "2022-01-27",
+                "actual_return": "2022-01-28",
+                "book": self.payment.borrowing.book_id,
+                "user": self.user.id,
+            },
+        )
+        self.assertEqual(response.data["money_to_pay"], "23.48")
+
+
+class FastJSONTest(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Sample", author="Name", cover="Hard", inventory=3, daily_fee=2
+        )
+        sample_payments(user, book, money_to_pay="1234567.89")
+        sample_payments(user, book, money_to_pay="0.10", session_url="")
+        self.payload = {
+            "results": PaymentListSerializer(Payment.objects.all(), many=True).data,
+            "total": Decimal("1234567.99"),
+            "created": datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=dt_timezone.utc),
+            "due": date(2024, 5, 2),
+            "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+            "detail": gettext_lazy("Not found."),
+            "text": "Ünïcode \u2028 line \u2029 separators",
+            "counts": {1: 2},
+        }
+
+    def test_renders_like_json_renderer(self):
+        self.assertEqual(
+            FastJSONRenderer().render(self.payload),
+            JSONRenderer().render(self.payload),
+        )
+
+    def test_stdlib_fallback(self):
+        with patch("library_project_final.renderers.orjson", None):
+            self.assertEqual(
+                FastJSONRenderer().render(self.payload),
+                JSONRenderer().render(self.payload),
+            )
+
+    def test_indent_uses_json_renderer(self):
+        media_type = "application/json; indent=4"
+        self.assertEqual(
+            FastJSONRenderer().render(self.payload, media_type),
+            JSONRenderer().render(self.payload, media_type),
+        )
+
+    def test_parser(self):
+        body = '{"money": 1.5, "title": "Ünïcode", "items": [1, null]}'.encode()
+        parsed = FastJSONParser().parse(BytesIO(body))
+
+        self.assertEqual(parsed, {"money": 1.5, "title": "Ünïcode", "items": [1, None]})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b"{oops"))
+
+    def test_api_responses_use_fast_renderer(self):
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.get())
+        response = client.get(PAYMENTS_URLS)
+
+        self.assertIsInstance(response.accepted_renderer, FastJSONRenderer)
+        self.assertEqual(response.json()["count"], 2)
+
+    def test_browsable_api_limits_related_choices(self):
+        Book.objects.bulk_create(
+            Book(
+                title=f"Book {i}", author="Name", cover="Hard", inventory=1, daily_fee=1
+            )
+            for i in range(150)
+        )
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.get())
+        response = client.get(reverse("borrows:borrow-list"), HTTP_ACCEPT="text/html")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, "More than 100 items...")
+
+    def test_production_profile_is_json_only(self):
+        from library_project_final import settings_production
+
+        renderers = settings_production.REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"]
+        self.assertEqual(
+            renderers, ("library_project_final.renderers.FastJSONRenderer",)
+        )
+        self.assertFalse(settings_production.DEBUG)
+        self.assertEqual(
+            settings_production.STORAGES["staticfiles"]["BACKEND"],
+            "whitenoise.storage.CompressedManifestStaticFilesStorage",
+        )
+
+
 class PaymentSuccessTest(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -112,52 +300,48 @@ class PaymentSuccessTest(TestCase):
             money_to_pay=23.49,
         )
 
-    @patch("stripe.checkout.Session.retrieve")
+    @patch("stripe.checkout.Session.retrieve", side_effect=AssertionError)
     def test_payment_success(self, mock_retrieve):
-        # Mock the Stripe Session retrieve call
-        mock_session = MagicMock()
-        mock_session.payment_status = "paid"
-        mock_retrieve.return_value = mock_session
-
-        # Create a request object
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status=Payment.StatusChoices.PAID
+        )
         request = self.factory.get("/payment_success_url")
 
-        # Call the view function
-        response = payment_success(request, self.session_id)
+        response = async_to_sync(payment_success)(request, self.session_id)
 
-        # Refresh the payment object from the database
-        self.payment.refresh_from_db()
-
-        # Check that the payment status was updated
-        self.assertEqual(self.payment.status, Payment.StatusChoices.PAID)
-
-        # Check that the response is correct
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content.decode(), "Payment was successful!")
+        mock_retrieve.assert_not_called()
 
-    @patch("stripe.checkout.Session.retrieve")
-    def test_payment_not_successful(self, mock_retrieve):
-        # Mock the Stripe Session retrieve call
-        mock_session = MagicMock()
-        mock_session.payment_status = "unpaid"
-        mock_retrieve.return_value = mock_session
-
-        # Create a request object
+    @patch("stripe.checkout.Session.retrieve", side_effect=AssertionError)
+    def test_payment_waiting_for_webhook(self, mock_retrieve):
         request = self.factory.get("/payment_success_url")
 
-        # Call the view function
-        response = payment_success(request, self.session_id)
+        response = async_to_sync(payment_success)(request, self.session_id)
 
-        # Refresh the payment object from the database
         self.payment.refresh_from_db()
-
-        # Check that the payment status was not updated
         self.assertEqual(self.payment.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(
+            response.content.decode(),
+            "Payment is being processed. Refresh this page in a few seconds.",
+        )
+
+    def test_payment_not_successful(self):
+        Payment.objects.filter(pk=self.payment.pk).update(
+            status=Payment.StatusChoices.EXPIRED
+        )
+        request = self.factory.get("/payment_success_url")
+
+        response = async_to_sync(payment_success)(request, self.session_id)
 
-        # Check that the response is correct
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.content.decode(), "Payment was not successful.")
 
+    def test_unknown_session(self):
+        request = self.factory.get("/payment_success_url")
+        with self.assertRaises(Http404):
+            async_to_sync(payment_success)(request, "cs_unknown")
+
     def test_payment_cancel(self):
         request = self.factory.get("/payment_cancelled_url")
         response = payment_cancelled(request)
@@ -167,3 +351,936 @@ class PaymentSuccessTest(TestCase):
             response.content.decode(),
             "Payment was cancelled. You can pay later, but the session is available for only 24 hours.",
         )
+
+
+class FakeStripeEventSource:
+    """
+    Sends Checkout Session events to the webhook the way Stripe does:
+    a JSON event signed with the webhook secret in Stripe-Signature.
+    """
+
+    def __init__(self, client, secret):
+        self.client = client
+        self.secret = secret
+        self.sent = 0
+
+    def sign(self, payload, timestamp=None):
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        signature = hmac.new(
+            self.secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256
+        ).hexdigest()
+        return f"t={timestamp},v1={signature}"
+
+    def event(self, event_type, session_id, payment_status="paid", amount_total=2348):
+        self.sent += 1
+        return json.dumps(
+            {
+                "id": f"evt_test_{self.sent}",
+                "object": "event",
+                "type": event_type,
+                "data": {
+                    "object": {
+                        "id": session_id,
+                        "object": "checkout.session",
+                        "payment_status": payment_status,
+                        "amount_total": amount_total,
+                    }
+                },
+            }
+        )
+
+    def post(self, payload, signature):
+        return self.client.post(
+            WEBHOOK_URL,
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+
+    def send(self, event_type, session_id, **kwargs):
+        payload = self.event(event_type, session_id, **kwargs)
+        return self.post(payload, self.sign(payload))
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+class StripeWebhookTest(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Sample", author="Name", cover="Hard", inventory=3, daily_fee=2
+        )
+        self.payment = sample_payments(user, book, session_id="cs_test_1")
+        self.stripe = FakeStripeEventSource(Client(), "whsec_test")
+
+    def _status(self):
+        self.payment.refresh_from_db()
+        return self.payment.status
+
+    def test_completed_session_marks_payment_paid(self):
+        response = self.stripe.send("checkout.session.completed", "cs_test_1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._status(), Payment.StatusChoices.PAID)
+
+    def test_repeated_delivery_is_idempotent(self):
+        for _ in range(3):
+            response = self.stripe.send("checkout.session.completed", "cs_test_1")
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self._status(), Payment.StatusChoices.PAID)
+
+    def test_expired_session(self):
+        self.stripe.send(
+            "checkout.session.expired", "cs_test_1", payment_status="unpaid"
+        )
+        self.assertEqual(self._status(), Payment.StatusChoices.EXPIRED)
+
+    def test_late_expiry_does_not_undo_payment(self):
+        self.stripe.send("checkout.session.completed", "cs_test_1")
+        self.stripe.send("checkout.session.expired", "cs_test_1")
+
+        self.assertEqual(self._status(), Payment.StatusChoices.PAID)
+
+    def test_delayed_payment_waits_for_async_success(self):
+        self.stripe.send(
+            "checkout.session.completed", "cs_test_1", payment_status="unpaid"
+        )
+        self.assertEqual(self._status(), Payment.StatusChoices.PENDING)
+
+        self.stripe.send("checkout.session.async_payment_succeeded", "cs_test_1")
+        self.assertEqual(self._status(), Payment.StatusChoices.PAID)
+
+    def test_failed_delayed_payment_expires_the_payment(self):
+        self.stripe.send(
+            "checkout.session.completed", "cs_test_1", payment_status="unpaid"
+        )
+        self.stripe.send(
+            "checkout.session.async_payment_failed",
+            "cs_test_1",
+            payment_status="unpaid",
+        )
+
+        self.assertEqual(self._status(), Payment.StatusChoices.EXPIRED)
+
+    def test_session_for_another_amount_does_not_settle(self):
+        with self.assertLogs("payments.webhooks", "WARNING"):
+            response = self.stripe.send(
+                "checkout.session.completed", "cs_test_1", amount_total=1000
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._status(), Payment.StatusChoices.PENDING)
+
+    def test_paid_session_without_payment_is_logged(self):
+        with self.assertLogs("payments.webhooks", "WARNING") as logs:
+            response = self.stripe.send("checkout.session.completed", "cs_unknown")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("matches no payment", logs.output[0])
+
+    def test_other_events_are_acknowledged(self):
+        response = self.stripe.send("customer.created", "cus_1")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._status(), Payment.StatusChoices.PENDING)
+
+    def test_invalid_signature_is_rejected(self):
+        payload = self.stripe.event("checkout.session.completed", "cs_test_1")
+        forged = FakeStripeEventSource(Client(), "whsec_other").sign(payload)
+        stale = self.stripe.sign(payload, timestamp=int(time.time()) - 3600)
+
+        for signature in (forged, stale, ""):
+            response = self.stripe.post(payload, signature)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._status(), Payment.StatusChoices.PENDING)
+
+    def test_only_post_is_allowed(self):
+        self.assertEqual(Client().get(WEBHOOK_URL).status_code, 405)
+
+    def test_success_page_after_webhook(self):
+        self.stripe.send("checkout.session.completed", "cs_test_1")
+        response = Client().get(
+            reverse("payments:payment_success", kwargs={"session_id": "cs_test_1"})
+        )
+
+        self.assertEqual(response.content.decode(), "Payment was successful!")
+
+
+class PaymentOutboxTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.book = Book.objects.create(
+            title="Sample",
+            author="Name",
+            cover="Hard",
+            inventory=23,
+            daily_fee=2.45,
+        )
+        self.borrowing = Borrow.objects.create(
+            borrow_date=date(2022, 1, 21),
+            expected_return=date(2022, 1, 27),
+            actual_return=date(2022, 1, 28),
+            book=self.book,
+            user=self.user,
+        )
+
+    def test_pending_payment_is_queued_without_calling_stripe(self):
+        with patch("payments.helper.get_stripe_client") as mock_client:
+            payment = create_pending_payment(self.borrowing)
+
+        mock_client.assert_not_called()
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(payment.session_url, "")
+        self.assertTrue(PaymentOutbox.objects.filter(payment=payment).exists())
+
+    @patch("payments.helper.get_stripe_client")
+    def test_outbox_worker_fills_in_the_session(self, mock_client):
+        mock_create = mock_client.return_value.create_checkout_session
+        mock_create.return_value = MagicMock(id="cs_test_outbox")
+        payment = create_pending_payment(self.borrowing)
+
+        processed = process_payment_outbox()
+
+        payment.refresh_from_db()
+        self.assertEqual(processed, 1)
+        self.assertEqual(payment.session_id, "cs_test_outbox")
+        self.assertEqual(
+            payment.session_url, "https://checkout.stripe.com/pay/cs_test_outbox"
+        )
+        self.assertFalse(PaymentOutbox.objects.exists())
+
+    @patch("payments.helper.get_stripe_client")
+    def test_failed_session_stays_in_outbox_with_backoff(self, mock_client):
+        mock_create = mock_client.return_value.create_checkout_session
+        mock_create.side_effect = stripe.error.APIConnectionError("Stripe is down")
+        payment = create_pending_payment(self.borrowing)
+
+        processed = process_payment_outbox()
+
+        entry = PaymentOutbox.objects.get(payment=payment)
+        self.assertEqual(processed, 0)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.last_error, "Stripe is down")
+        self.assertIsNone(entry.claim)
+        self.assertEqual(process_payment_outbox(), 0)
+        self.assertEqual(mock_create.call_count, 1)
+
+
+class PaymentSessionReuseTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.book = Book.objects.create(
+            title="Sample",
+            author="Name",
+            cover="Hard",
+            inventory=23,
+            daily_fee=2.45,
+        )
+        self.borrowing = Borrow.objects.create(
+            borrow_date=date(2022, 1, 21),
+            expected_return=date(2022, 1, 27),
+            actual_return=date(2022, 1, 28),
+            book=self.book,
+            user=self.user,
+        )
+        patcher = patch("payments.helper.get_stripe_client")
+        self.mock_client = patcher.start().return_value
+        self.mock_create = self.mock_client.create_checkout_session
+        self.mock_create.return_value = MagicMock(id="cs_test_new")
+        self.addCleanup(patcher.stop)
+
+    def _payment(self, expires_in, **params):
+        defaults = {
+            "status": Payment.StatusChoices.PENDING,
+            "type": Payment.TypeChoices.PAYMENT,
+            "borrowing": self.borrowing,
+            "session_id": "cs_test_old",
+            "session_url": "https://checkout.stripe.com/pay/cs_test_old",
+            "money_to_pay": Decimal("22.05"),
+            "expires_at": None if expires_in is None else timezone.now() + expires_in,
+        }
+        defaults.update(params)
+        return Payment.objects.create(**defaults)
+
+    def _checkout(self, payment):
+        return self.client.post(
+            reverse("payments:payment-checkout", kwargs={"pk": payment.pk})
+        )
+
+    def test_pending_payment_is_reused_per_borrowing_and_amount(self):
+        first = create_pending_payment(self.borrowing)
+        again = create_pending_payment(self.borrowing)
+        fine = create_pending_payment(
+            self.borrowing, Decimal("4.90"), Payment.TypeChoices.FINE
+        )
+
+        self.assertEqual(again, first)
+        self.assertNotEqual(fine, first)
+        self.assertEqual(Payment.objects.count(), 2)
+        self.assertEqual(PaymentOutbox.objects.count(), 2)
+
+    def test_live_session_is_not_queued_again(self):
+        payment = self._payment(timedelta(hours=2))
+
+        self.assertEqual(create_pending_payment(self.borrowing), payment)
+        self.assertFalse(PaymentOutbox.objects.exists())
+
+    def test_session_is_created_with_an_expiry(self):
+        payment = create_pending_payment(self.borrowing)
+
+        process_payment_outbox()
+
+        payment.refresh_from_db()
+        expires_at = self.mock_create.call_args.kwargs["expires_at"]
+        self.assertEqual(int(payment.expires_at.timestamp()), expires_at)
+        self.assertGreater(payment.expires_at, timezone.now() + timedelta(hours=22))
+
+    def test_checkout_reuses_live_session(self):
+        payment = self._payment(timedelta(hours=2))
+
+        response = self._checkout(payment)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["session_url"], payment.session_url)
+        self.mock_create.assert_not_called()
+
+    def test_checkout_refreshes_expired_session_in_place(self):
+        for state in (Payment.StatusChoices.PENDING, Payment.StatusChoices.EXPIRED):
+            with self.subTest(state=state):
+                payment = self._payment(timedelta(minutes=-5), status=state)
+
+                response = self._checkout(payment)
+
+                payment.refresh_from_db()
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+                self.assertEqual(payment.session_id, "cs_test_new")
+                self.assertEqual(response.data["session_url"], payment.session_url)
+                self.assertGreater(payment.expires_at, timezone.now())
+                payment.delete()
+
+        self.assertEqual(self.mock_create.call_count, 2)
+        self.mock_client.expire_checkout_session.assert_not_called()
+
+    def test_session_close_to_expiry_is_expired_and_replaced(self):
+        payment = self._payment(timedelta(minutes=2))
+
+        self._checkout(payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.session_id, "cs_test_new")
+        self.mock_client.expire_checkout_session.assert_called_once_with("cs_test_old")
+
+    def test_session_that_expired_at_stripe_is_replaced(self):
+        payment = self._payment(timedelta(minutes=2))
+        self.mock_client.expire_checkout_session.side_effect = (
+            stripe.error.InvalidRequestError("Session is not open", None)
+        )
+        self.mock_client.retrieve_checkout_session.return_value = MagicMock(
+            status="expired"
+        )
+
+        self._checkout(payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.session_id, "cs_test_new")
+
+    def test_completed_session_is_not_replaced(self):
+        payment = self._payment(timedelta(minutes=2))
+        self.mock_client.expire_checkout_session.side_effect = (
+            stripe.error.InvalidRequestError("Session is not open", None)
+        )
+        self.mock_client.retrieve_checkout_session.return_value = MagicMock(
+            status="complete"
+        )
+
+        response = self._checkout(payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(payment.session_id, "cs_test_old")
+        self.mock_create.assert_not_called()
+
+    def test_expired_payment_gets_a_new_session_at_once(self):
+        # Its delayed payment failed; the session is complete, not open.
+        payment = self._payment(
+            timedelta(hours=20), status=Payment.StatusChoices.EXPIRED
+        )
+
+        self._checkout(payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.session_id, "cs_test_new")
+        self.assertEqual(payment.status, Payment.StatusChoices.PENDING)
+        self.mock_client.expire_checkout_session.assert_not_called()
+
+    def test_checkout_rejects_paid_payment(self):
+        payment = self._payment(timedelta(hours=2), status=Payment.StatusChoices.PAID)
+
+        response = self._checkout(payment)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.mock_create.assert_not_called()
+
+    def test_checkout_of_another_users_payment(self):
+        payment = self._payment(timedelta(hours=2))
+        other = get_user_model().objects.create_user(
+            email="other@mail.com", password="password"
+        )
+        self.client.force_authenticate(other)
+
+        response = self._checkout(payment)
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_checkout_while_stripe_is_down(self):
+        payment = self._payment(timedelta(minutes=-5))
+        self.mock_create.side_effect = CircuitOpenError("Stripe circuit is open")
+
+        response = self._checkout(payment)
+
+        payment.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(payment.session_id, "cs_test_old")
+
+    def test_expire_stale_payments_in_batches(self):
+        stale = [self._payment(timedelta(minutes=-1)) for _ in range(5)]
+        live = self._payment(timedelta(hours=1))
+        paid = self._payment(timedelta(hours=-1), status=Payment.StatusChoices.PAID)
+        queued = self._payment(None, session_id="")
+
+        with CaptureQueriesContext(connection) as queries:
+            expired = expire_stale_payments(batch_size=2)
+
+        self.assertEqual(expired, 5)
+        self.assertEqual(len(queries), 7)
+        self.assertEqual(
+            set(
+                Payment.objects.filter(
+                    status=Payment.StatusChoices.EXPIRED
+                ).values_list("id", flat=True)
+            ),
+            {payment.id for payment in stale},
+        )
+        for payment in (live, paid, queued):
+            old_status = payment.status
+            payment.refresh_from_db()
+            self.assertEqual(payment.status, old_status)
+
+
+class OverdueFineTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.book = Book.objects.create(
+            title="Sample",
+            author="Name",
+            cover="Hard",
+            inventory=23,
+            daily_fee=Decimal("2.45"),
+        )
+        self.today = timezone.now().date()
+
+    def _borrow(self, due_in_days, **params):
+        defaults = {
+            "borrow_date": self.today - timedelta(days=30),
+            "expected_return": self.today + timedelta(days=due_in_days),
+            "book": self.book,
+            "user": self.user,
+        }
+        defaults.update(params)
+        return Borrow.objects.create(**defaults)
+
+    def _fines(self):
+        return Payment.objects.filter(type=Payment.TypeChoices.FINE)
+
+    def test_nightly_job_fines_overdue_borrowings(self):
+        overdue = self._borrow(-3)
+        self._borrow(0)
+        self._borrow(5)
+        self._borrow(-10, actual_return=self.today - timedelta(days=9))
+
+        result = generate_overdue_fines()
+
+        fine = self._fines().get()
+        self.assertEqual((result["created"], result["updated"]), (1, 0))
+        self.assertEqual(fine.borrowing, overdue)
+        self.assertEqual(fine.status, Payment.StatusChoices.PENDING)
+        self.assertEqual(fine.money_to_pay, Decimal("14.70"))
+        self.assertTrue(PaymentOutbox.objects.filter(payment=fine).exists())
+
+    def test_rerun_is_idempotent(self):
+        self._borrow(-3)
+        generate_overdue_fines()
+
+        result = generate_overdue_fines()
+
+        self.assertEqual((result["created"], result["updated"]), (0, 0))
+        self.assertEqual(self._fines().count(), 1)
+
+    def test_growing_fine_is_updated_in_place(self):
+        self._borrow(-3)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+        PaymentOutbox.objects.all().delete()
+        self._fines().update(
+            session_id="cs_test_old",
+            session_url="https://checkout.stripe.com/pay/cs_test_old",
+            expires_at=timezone.now(),
+        )
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            created, updated = sync_overdue_fines(
+                Borrow.objects.all(), self.today + timedelta(days=1)
+            )
+
+        fine = self._fines().get()
+        self.assertEqual((created, updated), (0, 1))
+        self.assertEqual(fine.money_to_pay, Decimal("19.60"))
+        self.assertIsNone(fine.expires_at)
+        # The old session asks for the old amount, so a new one is queued;
+        # the old one stays linked until the outbox expires it.
+        self.assertEqual(fine.session_id, "cs_test_old")
+        self.assertTrue(PaymentOutbox.objects.filter(payment=fine).exists())
+        self.assertEqual(len(callbacks), 1)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET="whsec_test")
+    @patch("payments.helper.get_stripe_client")
+    def test_old_session_paid_after_the_fine_grows(self, mock_client):
+        self._borrow(-3)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+        PaymentOutbox.objects.all().delete()
+        self._fines().update(
+            session_id="cs_test_old", expires_at=timezone.now() + timedelta(hours=2)
+        )
+        sync_overdue_fines(Borrow.objects.all(), self.today + timedelta(days=1))
+        fine = self._fines().get()
+
+        with self.assertLogs("payments.webhooks", "WARNING") as logs:
+            FakeStripeEventSource(Client(), "whsec_test").send(
+                "checkout.session.completed", "cs_test_old", amount_total=1470
+            )
+        mock_client.return_value.expire_checkout_session.side_effect = (
+            stripe.error.InvalidRequestError("Session is not open", None)
+        )
+        mock_client.return_value.retrieve_checkout_session.return_value = MagicMock(
+            status="complete"
+        )
+        process_payment_outbox()
+
+        fine.refresh_from_db()
+        self.assertIn(f"does not match payment {fine.pk}", logs.output[0])
+        self.assertEqual(fine.status, Payment.StatusChoices.PENDING)
+        # The paid session is kept on the fine rather than replaced.
+        self.assertEqual(fine.session_id, "cs_test_old")
+        self.assertEqual(PaymentOutbox.objects.get(payment=fine).attempts, 1)
+        mock_client.return_value.create_checkout_session.assert_not_called()
+
+    @patch("payments.helper.get_stripe_client")
+    def test_changed_fine_expires_its_old_session(self, mock_client):
+        mock_client.return_value.create_checkout_session.return_value = MagicMock(
+            id="cs_test_new"
+        )
+        self._borrow(-3)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+        PaymentOutbox.objects.all().delete()
+        self._fines().update(
+            session_id="cs_test_old", expires_at=timezone.now() + timedelta(hours=2)
+        )
+        sync_overdue_fines(Borrow.objects.all(), self.today + timedelta(days=1))
+
+        process_payment_outbox()
+
+        mock_client.return_value.expire_checkout_session.assert_called_once_with(
+            "cs_test_old"
+        )
+        self.assertEqual(self._fines().get().session_id, "cs_test_new")
+
+    def test_paid_fine_is_deducted(self):
+        self._borrow(-3)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+        self._fines().update(status=Payment.StatusChoices.PAID)
+
+        created, _ = sync_overdue_fines(
+            Borrow.objects.all(), self.today + timedelta(days=2)
+        )
+
+        remainder = self._fines().get(status=Payment.StatusChoices.PENDING)
+        self.assertEqual(created, 1)
+        self.assertEqual(remainder.money_to_pay, Decimal("9.80"))
+
+    def test_queries_do_not_grow_with_borrowings(self):
+        def count_queries(borrowings):
+            Borrow.objects.all().delete()
+            for _ in range(borrowings):
+                self._borrow(-3)
+            with CaptureQueriesContext(connection) as queries:
+                created, _ = sync_overdue_fines(Borrow.objects.all(), self.today)
+            self.assertEqual(created, borrowings)
+            return len(queries)
+
+        self.assertEqual(count_queries(3), count_queries(30))
+
+    def test_late_return_settles_the_fine(self):
+        borrow = self._borrow(-3)
+        sync_overdue_fines(Borrow.objects.all(), self.today - timedelta(days=1))
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        client.post(
+            reverse("borrows:borrow-borrowing-return", kwargs={"pk": borrow.pk})
+        )
+
+        self.assertEqual(self._fines().get().money_to_pay, Decimal("14.70"))
+
+    @patch("payments.helper.get_stripe_client")
+    def test_outbox_drain_is_rate_limited(self, mock_client):
+        mock_create = mock_client.return_value.create_checkout_session
+        mock_create.return_value = MagicMock(id="cs_test_fine")
+        for days in (-3, -4, -5):
+            self._borrow(days)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+
+        with patch.object(drain_payment_outbox, "apply_async") as mock_next:
+            self.assertEqual(drain_payment_outbox(batch_size=2, per_second=1), 2)
+            args = mock_next.call_args.args[0]
+            countdown = mock_next.call_args.kwargs["countdown"]
+            mock_next.reset_mock()
+            self.assertEqual(drain_payment_outbox(*args), 1)
+
+        self.assertGreater(countdown, 1)
+        self.assertLessEqual(countdown, 2)
+        mock_next.assert_not_called()
+        self.assertFalse(PaymentOutbox.objects.exists())
+
+    @patch("payments.helper.get_stripe_client")
+    def test_only_one_drain_runs_at_a_time(self, mock_client):
+        mock_create = mock_client.return_value.create_checkout_session
+        mock_create.return_value = MagicMock(id="cs_test_fine")
+        for days in (-3, -4, -5):
+            self._borrow(days)
+        sync_overdue_fines(Borrow.objects.all(), self.today)
+
+        with patch.object(drain_payment_outbox, "apply_async") as mock_next:
+            self.assertEqual(drain_payment_outbox(batch_size=2, per_second=1), 2)
+            args = mock_next.call_args.args[0]
+            # Every new borrowing or fine run starts a drain of its own.
+            self.assertEqual(drain_payment_outbox(batch_size=2, per_second=1), 0)
+            self.assertEqual(drain_payment_outbox(*args), 1)
+
+        self.assertEqual(mock_create.call_count, 3)
+        self.assertEqual(drain_payment_outbox(batch_size=2, per_second=1), 0)
+        self.assertIsNone(cache.get(DRAIN_LOCK_KEY))
+
+
+class StubStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests.append(
+                {
+                    "path": self.path,
+                    "connection": self.client_address,
+                    "idempotency_key": self.headers.get("Idempotency-Key"),
+                }
+            )
+            status_code, delay = (
+                server.responses.pop(0) if server.responses else (200, 0)
+            )
+        time.sleep(delay)
+
+        if status_code == 200:
+            body = {
+                "id": f"cs_stub_{len(server.requests)}",
+                "object": "checkout.session",
+            }
+        else:
+            body = {"error": {"type": "api_error", "message": "Stub failure"}}
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubStripeServer(ThreadingHTTPServer):
+    """
+    Local HTTP server that answers like the Stripe API. `responses` is a
+    queue of (status code, delay in seconds); once empty, it answers 200.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubStripeHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.responses = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StripeClientTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        logger_patch = patch.object(stripe_client.logger, "disabled", True)
+        logger_patch.start()
+        self.addCleanup(logger_patch.stop)
+        self.server = StubStripeServer()
+        self.addCleanup(self.server.stop)
+        self.now = 0.0
+        self.breaker = CircuitBreaker(
+            failure_threshold=2, reset_timeout=30, clock=lambda: self.now
+        )
+        self.client = StripeClient(
+            "sk_test_stub",
+            api_base=self.server.url,
+            timeout=(1, 0.3),
+            max_retries=2,
+            breaker=self.breaker,
+            sleep=lambda seconds: None,
+        )
+
+    def _create(self):
+        return self.client.create_checkout_session(mode="payment")
+
+    def test_reuses_pooled_connections(self):
+        sessions = [self._create() for _ in range(5)]
+
+        self.assertEqual(sessions[-1].id, "cs_stub_5")
+        self.assertEqual(len(self.server.requests), 5)
+        connections = {request["connection"] for request in self.server.requests}
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(self.server.requests[0]["path"], "/v1/checkout/sessions")
+
+    def test_retries_server_errors_with_one_idempotency_key(self):
+        self.server.responses = [(500, 0), (503, 0)]
+
+        session = self._create()
+
+        self.assertEqual(session.id, "cs_stub_3")
+        keys = {request["idempotency_key"] for request in self.server.requests}
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(StripeMetrics().snapshot()["retries"], 2)
+
+    def test_timeouts_are_retried_then_raised(self):
+        self.server.responses = [(200, 1)] * 3
+
+        started = time.monotonic()
+        with self.assertRaises(stripe.error.APIConnectionError):
+            self._create()
+
+        self.assertLess(time.monotonic() - started, 2.5)
+        self.assertEqual(len(self.server.requests), 3)
+        metrics = StripeMetrics().snapshot()
+        self.assertEqual(metrics["requests"], 3)
+        self.assertEqual(metrics["errors"], 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.server.responses = [(400, 0)]
+
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            self._create()
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_opens_and_fails_fast(self):
+        self.server.responses = [(500, 0)] * 6
+        for _ in range(2):
+            with self.assertRaises(stripe.error.APIError):
+                self._create()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self._create()
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(StripeMetrics().snapshot()["rejected"], 1)
+
+        self.now += 31
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self._create().id, "cs_stub_7")
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens_the_circuit(self):
+        self.server.responses = [(500, 0)] * 9
+        for _ in range(2):
+            with self.assertRaises(stripe.error.APIError):
+                self._create()
+        self.now += 31
+
+        with self.assertRaises(stripe.error.APIError):
+            self._create()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_latency_buckets(self):
+        self._create()
+
+        metrics = StripeMetrics().snapshot()
+        self.assertEqual(metrics["requests"], 1)
+        self.assertEqual(metrics["latency_ms_le_100"], 1)
+
+    def test_metrics_endpoint_is_admin_only(self):
+        self._create()
+        api_client = APIClient()
+        url = reverse("payments:stripe_metrics")
+        user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        api_client.force_authenticate(user)
+        self.assertEqual(api_client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        response = api_client.get(url)
+        self.assertEqual(response.data["requests"], 1)
+        self.assertEqual(response.data["circuit"], CircuitBreaker.CLOSED)
+
+    @patch("payments.helper.get_stripe_client")
+    def test_open_circuit_hands_outbox_batch_back(self, mock_client):
+        mock_client.return_value.create_checkout_session.side_effect = CircuitOpenError(
+            "Stripe circuit is open"
+        )
+        user = get_user_model().objects.create_user(
+            email="user@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Sample", author="Name", cover="Hard", inventory=3, daily_fee=2
+        )
+        for _ in range(3):
+            borrowing = Borrow.objects.create(
+                borrow_date=date(2022, 1, 21),
+                expected_return=date(2022, 1, 27),
+                book=book,
+                user=user,
+            )
+            create_pending_payment(borrowing)
+
+        self.assertEqual(process_payment_outbox(), 0)
+
+        self.assertEqual(mock_client.return_value.create_checkout_session.call_count, 1)
+        self.assertFalse(PaymentOutbox.objects.exclude(attempts=0, claim=None).exists())
+
+
+@override_settings(ASYNC_OUTBOUND=True, OUTBOUND_CONCURRENCY=5)
+class AsyncPaymentOutboxTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = StubStripeServer()
+        self.addCleanup(self.server.stop)
+        self.client = StripeClient(
+            "sk_test_stub", api_base=self.server.url, timeout=(1, 2), backoff=0
+        )
+        patcher = patch("payments.helper.get_stripe_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        book = Book.objects.create(
+            title="Sample", author="Name", cover="Hard", inventory=23, daily_fee=2
+        )
+        self.payments = [
+            create_pending_payment(
+                Borrow.objects.create(
+                    borrow_date=date(2022, 1, 21),
+                    expected_return=date(2022, 1, 27),
+                    book=book,
+                    user=user,
+                )
+            )
+            for _ in range(10)
+        ]
+
+    def test_sessions_are_created_concurrently_over_a_pool(self):
+        self.server.responses = [(200, 0.2)] * 10
+
+        started = time.monotonic()
+        processed = process_payment_outbox()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(processed, 10)
+        self.assertLess(elapsed, 1.5)
+        self.assertFalse(PaymentOutbox.objects.exists())
+        self.assertFalse(Payment.objects.filter(session_id="").exists())
+        self.assertEqual(
+            Payment.objects.filter(expires_at__isnull=False).count(), len(self.payments)
+        )
+        connections = {request["connection"] for request in self.server.requests}
+        self.assertLessEqual(len(connections), 5)
+
+    def test_later_batches_reuse_the_pooled_connections(self):
+        self.server.responses = [(200, 0.1)] * 10
+
+        self.assertEqual(process_payment_outbox(batch_size=5), 5)
+        first = {request["connection"] for request in self.server.requests}
+        self.assertEqual(process_payment_outbox(batch_size=5), 5)
+
+        connections = {request["connection"] for request in self.server.requests}
+        self.assertEqual(connections, first)
+
+    def test_open_session_is_expired_before_it_is_replaced(self):
+        payment = self.payments[0]
+        Payment.objects.filter(pk=payment.pk).update(
+            session_id="cs_test_old", expires_at=timezone.now() + timedelta(minutes=5)
+        )
+
+        self.assertEqual(process_payment_outbox(), 10)
+
+        paths = [request["path"] for request in self.server.requests]
+        self.assertEqual(len(paths), 11)
+        expire = paths.index("/v1/checkout/sessions/cs_test_old/expire")
+        payment.refresh_from_db()
+        # Stub session ids count the requests, so the new one came later.
+        self.assertGreater(int(payment.session_id.rsplit("_", 1)[1]), expire + 1)
+
+    def test_retries_keep_one_idempotency_key(self):
+        self.server.responses = [(500, 0), (200, 0)]
+
+        session = async_to_sync(self.client.create_checkout_session_async)(
+            mode="payment"
+        )
+
+        self.assertEqual(session.id, "cs_stub_2")
+        keys = {request["idempotency_key"] for request in self.server.requests}
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(StripeMetrics().snapshot()["retries"], 1)
+
+    def test_failures_back_off_and_open_circuit_hands_entries_back(self):
+        errors = [CircuitOpenError("Stripe circuit is open")] * 5 + [
+            stripe.error.APIConnectionError("Stripe is down")
+        ] * 5
+        with patch.object(
+            self.client, "create_checkout_session_async", AsyncMock(side_effect=errors)
+        ):
+            self.assertEqual(process_payment_outbox(), 0)
+
+        self.assertEqual(PaymentOutbox.objects.filter(attempts=0).count(), 5)
+        self.assertEqual(PaymentOutbox.objects.filter(attempts=1).count(), 5)
+        self.assertFalse(PaymentOutbox.objects.filter(claim__isnull=False).exists())
@@ -16,6 +16,8 @@ urlpatterns = [
         name="payment_success",
     ),
     path("payment-cancelled/", views.payment_cancelled, name="payment_cancelled"),
+    path("webhook/", views.stripe_webhook, name="stripe_webhook"),
+    path("stripe-metrics/", views.stripe_metrics, name="stripe_metrics"),
     path("", include(router.urls)),
 ]
 
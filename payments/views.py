@@ -1,28 +1,54 @@
 import stripe
-from django.db import transaction
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import aget_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema, extend_schema_view
 from rest_framework import viewsets, mixins
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from library_project_final import settings
+from rest_framework.response import Response
 
 from books.models import Book
+from library_project_final.fieldsets import FIELDSET_PARAMETERS, SparseQuerysetMixin
+from payments.helper import create_stripe_session
 from payments.models import Payment
+from payments.stripe_client import StripeMetrics, circuit_state
+from payments.webhooks import handle_event
 from payments.serializers import (
     PaymentSerializer,
+    PaymentCheckoutSerializer,
     PaymentDetailSerializer,
     PaymentListSerializer,
 )
 
 
+class PaymentProviderUnavailable(APIException):
+    status_code = 503
+    default_detail = "The payment provider is unavailable, try again later."
+    default_code = "payment_provider_unavailable"
+
+
+@extend_schema_view(
+    list=extend_schema(parameters=FIELDSET_PARAMETERS),
+    retrieve=extend_schema(parameters=FIELDSET_PARAMETERS),
+)
 class PaymentViewSet(
-    mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet
+    SparseQuerysetMixin,
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet,
 ):
     """
     retrieve:
     Return the given payment.
 
     list:
-    Return a list of all the existing payments.
+    Return a list of the payments of the user, or of all users for staff.
     """
 
     queryset = Payment.objects.all().select_related("borrowing")
@@ -32,35 +58,96 @@ class PaymentViewSet(
         """
         Returns the list of permissions that this view requires.
         """
-        if self.action in ["retrieve", "list"]:
+        if self.action in ["retrieve", "list", "checkout"]:
             permission_classes = [IsAuthenticated]
         else:
             permission_classes = [IsAdminUser]
         return [permission() for permission in permission_classes]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(borrowing__user=self.request.user)
+        return queryset
+
     def get_serializer_class(self):
         if self.action in ["retrieve"]:
             return PaymentDetailSerializer
+        if self.action == "checkout":
+            return PaymentCheckoutSerializer
         else:
             return PaymentListSerializer
 
+    @extend_schema(request=None, responses=PaymentCheckoutSerializer)
+    @action(detail=True, methods=["post"])
+    def checkout(self, request, pk=None):
+        """
+        Returns a Checkout Session for an unpaid payment. The stored
+        session is reused while it is live; Stripe is only called to
+        replace a missing or expired one.
+        """
+        payment = self.get_object()
+        if payment.status == Payment.StatusChoices.PAID:
+            raise ValidationError({"status": ["This payment is already paid."]})
+
+        try:
+            payment = create_stripe_session(payment)
+        except stripe.error.StripeError:
+            raise PaymentProviderUnavailable()
+        return Response(self.get_serializer(payment).data)
+
 
-@transaction.atomic
-def payment_success(request, session_id):
+async def payment_success(request, session_id):
     """
-    Handles successful payments. Retrieves the payment session from Stripe and updates the payment status in the database.
+    Shows the result of a payment from its local status, which the Stripe
+    webhook keeps up to date. Stripe is not called here. Under ASGI the
+    page is served on the event loop without taking a worker thread.
     """
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-    session = stripe.checkout.Session.retrieve(session_id)
-
-    if session.payment_status == "paid":
-        payment = Payment.objects.get(session_id=session_id)
-        payment.status = Payment.StatusChoices.PAID
-        payment.save()
+    payment = await aget_object_or_404(
+        Payment.objects.only("status"), session_id=session_id
+    )
 
+    if payment.status == Payment.StatusChoices.PAID:
         return HttpResponse("Payment was successful!")
-    else:
-        return HttpResponse("Payment was not successful.")
+    if payment.status == Payment.StatusChoices.PENDING:
+        return HttpResponse(
+            "Payment is being processed. Refresh this page in a few seconds."
+        )
+    return HttpResponse("Payment was not successful.")
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """
+    Receives Stripe events. The signature is checked against the webhook
+    signing secret, so no Stripe API call is needed to trust the event.
+    """
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        raise ImproperlyConfigured("STRIPE_WEBHOOK_SECRET is not set.")
+
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body,
+            request.headers.get("Stripe-Signature", ""),
+            settings.STRIPE_WEBHOOK_SECRET,
+        )
+    except (ValueError, stripe.error.SignatureVerificationError):
+        return HttpResponseBadRequest("Invalid payload or signature.")
+
+    handle_event(event)
+    return HttpResponse(status=200)
+
+
+@extend_schema(responses=OpenApiTypes.OBJECT)
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def stripe_metrics(request):
+    """
+    Returns the Stripe request, error, retry and latency counters of all
+    processes and the circuit breaker state of this one.
+    """
+    return Response({"circuit": circuit_state(), **StripeMetrics().snapshot()})
 
 
 def payment_cancelled(request):
@@ -0,0 +1,92 @@
+import logging
+from decimal import Decimal
+
+from payments.models import Payment
+
+logger = logging.getLogger(__name__)
+
+
+def _finish_pending(session_id, status):
+    """
+    Moves the pending payment of a Checkout Session to `status`. Stripe
+    delivers events at least once and in any order, so the update is
+    conditional: repeats and late events for a settled payment change
+    nothing.
+    """
+    return Payment.objects.filter(
+        session_id=session_id, status=Payment.StatusChoices.PENDING
+    ).update(status=status)
+
+
+def _settle(session):
+    """
+    Marks the payment of a paid session as paid, provided the session
+    charged what the payment asks for. A fine can grow after its session
+    was created; paying the old amount must not settle the new one. Money
+    that settles nothing is logged, so that it can be refunded or booked
+    by hand.
+    """
+    payments = Payment.objects.filter(session_id=session["id"])
+    settled = payments.filter(
+        status=Payment.StatusChoices.PENDING,
+        money_to_pay=Decimal(session["amount_total"]).scaleb(-2),
+    ).update(status=Payment.StatusChoices.PAID)
+    if settled:
+        return settled
+
+    payment = payments.first()
+    if payment is None:
+        logger.warning(
+            "Session %s paid %s cents but matches no payment",
+            session["id"],
+            session["amount_total"],
+        )
+    elif payment.status != Payment.StatusChoices.PAID:
+        logger.warning(
+            "Session %s paid %s cents, which does not match payment %s",
+            session["id"],
+            session["amount_total"],
+            payment.pk,
+        )
+    return 0
+
+
+def session_completed(session):
+    # Delayed payment methods complete the session before the money
+    # arrives; those are settled by async_payment_succeeded.
+    if session["payment_status"] != "paid":
+        return 0
+    return _settle(session)
+
+
+def session_async_payment_succeeded(session):
+    return _settle(session)
+
+
+def session_async_payment_failed(session):
+    # A completed session never expires, so without this the payment
+    # would keep pointing at a session that can no longer be paid.
+    return _finish_pending(session["id"], Payment.StatusChoices.EXPIRED)
+
+
+def session_expired(session):
+    return _finish_pending(session["id"], Payment.StatusChoices.EXPIRED)
+
+
+EVENT_HANDLERS = {
+    "checkout.session.completed": session_completed,
+    "checkout.session.async_payment_succeeded": session_async_payment_succeeded,
+    "checkout.session.async_payment_failed": session_async_payment_failed,
+    "checkout.session.expired": session_expired,
+}
+
+
+def handle_event(event):
+    """
+    Applies a verified Stripe event to the local payments. Returns the
+    number of payments changed; events of other types are ignored.
+    """
+    handler = EVENT_HANDLERS.get(event["type"])
+    if handler is None:
+        return 0
+    return handler(event["data"]["object"])
@@ -6,13 +6,20 @@ load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_TIMEOUT = 10
+
+# One session per process, so the worker keeps the TLS connection to
+# Telegram alive between batches instead of reconnecting for every message.
+session = requests.Session()
 
 
 def send_telegram_notification(message):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": message,
     }
-    response = requests.post(url, json=payload)
+    response = session.post(url, json=payload, timeout=TELEGRAM_TIMEOUT)
     response.raise_for_status()
@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+USER_CACHE_KEY_PREFIX = "user:auth:"
+STATE_FIELDS = ("id", "email", "is_staff", "is_active")
+
+
+class LocalLRU:
+    """
+    Per-process LRU of at most `maxsize` entries, each kept for `ttl`
+    seconds. Entries cannot be invalidated from other processes, so the
+    TTL bounds how long they may lag behind the shared cache.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_users = LocalLRU(settings.USER_CACHE_LOCAL_SIZE, settings.USER_CACHE_LOCAL_TTL)
+
+
+def _cache_key(user_id):
+    return f"{USER_CACHE_KEY_PREFIX}{user_id}"
+
+
+def get_user_state(user_id):
+    """
+    Returns the fields authentication needs for the user, from the local
+    LRU, then the shared cache and only then the database. Returns None
+    for unknown users.
+    """
+    state = local_users.get(user_id)
+    if state is not None:
+        return state
+
+    state = cache.get(_cache_key(user_id))
+    if state is None:
+        fields = list(STATE_FIELDS)
+        if api_settings.CHECK_REVOKE_TOKEN:
+            fields.append("password")
+        state = (
+            get_user_model()
+            .objects.filter(**{api_settings.USER_ID_FIELD: user_id})
+            .values(*fields)
+            .first()
+        )
+        if state is None:
+            return None
+        if "password" in state:
+            state["password"] = get_md5_hash_password(state["password"])
+        cache.set(_cache_key(user_id), state, settings.USER_CACHE_TTL)
+
+    local_users.set(user_id, state)
+    return state
+
+
+def invalidate_user(user_id):
+    local_users.delete(user_id)
+    cache.delete(_cache_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that builds `request.user` from cached user state
+    instead of a SELECT per request. The user has only the cached fields
+    loaded; any other field is read from the database on first access,
+    and `save()` writes back only the loaded fields.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        state = get_user_state(user_id)
+        if state is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not state["is_active"]:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if (
+                validated_token.get(api_settings.REVOKE_TOKEN_CLAIM)
+                != state["password"]
+            ):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        # from_db() expects the values in the model's field order.
+        fields = [
+            field.attname
+            for field in self.user_model._meta.concrete_fields
+            if field.attname in STATE_FIELDS
+        ]
+        return self.user_model.from_db(
+            router.db_for_read(self.user_model),
+            fields,
+            [state[field] for field in fields],
+        )
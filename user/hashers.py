@@ -0,0 +1,112 @@
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.core.cache import cache
+
+SHARED_SLOT_PREFIX = "password-hashing:slot:"
+
+logger = logging.getLogger(__name__)
+_reject_when_busy = ContextVar("reject_when_busy", default=False)
+
+
+class PasswordHashingBusy(Exception):
+    """
+    Raised by a hash started under `reject_when_busy` that finds no free
+    hashing slot.
+    """
+
+
+@contextmanager
+def reject_when_busy():
+    """
+    Makes hashes started in the block raise PasswordHashingBusy when no
+    slot is free, instead of waiting for one. Meant for the endpoints
+    that can answer it with a 503; everything else, such as the admin
+    login or createsuperuser, waits.
+    """
+    token = _reject_when_busy.set(True)
+    try:
+        yield
+    finally:
+        _reject_when_busy.reset(token)
+
+
+class HashingSlots:
+    """
+    Caps how many passwords are hashed at once. A caller must hold one of
+    the `process` slots of its process and, when `shared` is set, one of
+    the `shared` slots kept in the cache for the whole deployment; it then
+    hashes on its own thread. Under `reject_when_busy` a caller that finds
+    no free slot gets PasswordHashingBusy at once, so a login burst ties
+    up at most `process` request threads per process and `shared` CPUs in
+    all. Other callers wait for a process slot and hash without a shared
+    one if none is free. Shared slots are leased for `lease` seconds, so a
+    process that dies while hashing cannot keep one. If the cache cannot
+    be reached, the process slots alone apply.
+    """
+
+    def __init__(self, process, shared=0, lease=30):
+        self.shared = shared
+        self.lease = lease
+        self._slots = threading.BoundedSemaphore(process)
+
+    def _take_shared(self, reject):
+        first = random.randrange(self.shared)
+        try:
+            for offset in range(self.shared):
+                key = f"{SHARED_SLOT_PREFIX}{(first + offset) % self.shared}"
+                if cache.add(key, 1, self.lease):
+                    return key
+        except Exception:
+            logger.warning("Could not take a shared hashing slot", exc_info=True)
+            return None
+        if reject:
+            raise PasswordHashingBusy()
+        return None
+
+    def _release_shared(self, key):
+        try:
+            cache.delete(key)
+        except Exception:
+            logger.warning("Could not release a shared hashing slot", exc_info=True)
+
+    def run(self, func, *args):
+        reject = _reject_when_busy.get()
+        if not self._slots.acquire(blocking=not reject):
+            raise PasswordHashingBusy()
+        try:
+            key = self._take_shared(reject) if self.shared else None
+            try:
+                return func(*args)
+            finally:
+                if key is not None:
+                    self._release_shared(key)
+        finally:
+            self._slots.release()
+
+
+hashing_slots = HashingSlots(
+    settings.PASSWORD_HASH_PROCESS_SLOTS, settings.PASSWORD_HASH_SLOTS
+)
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with the work factor taken from
+    PASSWORD_HASH_ITERATIONS and every hash computed in a hashing slot.
+    It keeps Django's algorithm name, so existing hashes still verify;
+    those made with another iteration count are rehashed on the next
+    successful login.
+    """
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
+
+    def encode(self, password, salt, iterations=None):
+        return hashing_slots.run(super().encode, password, salt, iterations)
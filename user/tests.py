@@ -1,3 +1,544 @@
-from django.test import TestCase
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from unittest import skipUnless
+from unittest.mock import Mock, patch
 
-# Create your tests here.
+import redis
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from library_project_final.throttling import (
+    LocalBuckets,
+    RedisBuckets,
+    TokenBucketThrottle,
+)
+from user.authentication import CachedJWTAuthentication, LocalLRU, local_users
+from user.hashers import (
+    SHARED_SLOT_PREFIX,
+    HashingSlots,
+    PasswordHashingBusy,
+    hashing_slots,
+    reject_when_busy,
+)
+
+BORROWS_URL = reverse("borrows:borrow-list")
+METRICS_URL = reverse("payments:stripe_metrics")
+MANAGE_URL = reverse("user:manage")
+REGISTER_URL = reverse("user:create")
+TOKEN_URL = reverse("user:token_obtain_pair")
+
+
+class CachedJWTAuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        local_users.clear()
+        self.addCleanup(local_users.clear)
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+
+    def _get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        user_queries = [
+            query["sql"] for query in queries if '"user_user"' in query["sql"]
+        ]
+        return response, user_queries
+
+    def test_user_is_loaded_once(self):
+        response, first = self._get(BORROWS_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(first), 1)
+
+        response, second = self._get(BORROWS_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(second, [])
+
+    def test_shared_cache_fills_the_local_lru(self):
+        self._get(BORROWS_URL)
+        local_users.clear()
+
+        _, queries = self._get(BORROWS_URL)
+
+        self.assertEqual(queries, [])
+
+    def test_deactivation_takes_effect_immediately(self):
+        self._get(BORROWS_URL)
+        self.user.is_active = False
+        self.user.save()
+
+        response, _ = self._get(BORROWS_URL)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_staff_change_is_picked_up(self):
+        response, _ = self._get(METRICS_URL)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save(update_fields=["is_staff"])
+
+        response, _ = self._get(METRICS_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_password_change_invalidates(self):
+        self._get(BORROWS_URL)
+        self.user.set_password("new-password")
+        self.user.save()
+
+        _, queries = self._get(BORROWS_URL)
+
+        self.assertEqual(len(queries), 1)
+
+    def test_deleted_user_is_rejected(self):
+        self._get(BORROWS_URL)
+        self.user.delete()
+
+        response, _ = self._get(BORROWS_URL)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def _authenticate(self):
+        token = AccessToken.for_user(self.user)
+        request = APIRequestFactory().get(
+            BORROWS_URL, HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+
+    def test_cached_user_has_the_cached_fields(self):
+        self.user.is_staff = True
+        self.user.save()
+
+        user = self._authenticate()
+
+        self.assertEqual(
+            (user.pk, user.email, user.is_staff, user.is_active),
+            (self.user.pk, "example@mail.com", True, True),
+        )
+        self.assertIn("password", user.get_deferred_fields())
+
+    def test_cached_user_loads_other_fields_lazily(self):
+        self._authenticate()
+        user = self._authenticate()
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(user.first_name, "")
+        self.assertEqual(len(queries), 1)
+
+        user.first_name = "Ann"
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, "Ann")
+        self.assertTrue(self.user.check_password("password"))
+
+    def test_profile_updates_use_the_full_user(self):
+        self._get(BORROWS_URL)
+
+        response = self.client.patch(MANAGE_URL, {"email": "new@mail.com"})
+
+        self.user.refresh_from_db()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.user.email, "new@mail.com")
+        self.assertTrue(self.user.check_password("password"))
+
+
+class LocalLRUTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.lru = LocalLRU(maxsize=2, ttl=5, clock=lambda: self.now)
+
+    def test_least_recently_used_is_evicted(self):
+        self.lru.set(1, "a")
+        self.lru.set(2, "b")
+        self.lru.get(1)
+        self.lru.set(3, "c")
+
+        self.assertEqual(self.lru.get(1), "a")
+        self.assertIsNone(self.lru.get(2))
+        self.assertEqual(self.lru.get(3), "c")
+
+    def test_entries_expire(self):
+        self.lru.set(1, "a")
+        self.now = 4.9
+        self.assertEqual(self.lru.get(1), "a")
+        self.now = 5.0
+        self.assertIsNone(self.lru.get(1))
+
+
+class ThrottleTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        for patcher in (
+            patch(
+                "library_project_final.throttling._buckets",
+                LocalBuckets(clock=lambda: self.now),
+            ),
+            patch.object(
+                TokenBucketThrottle,
+                "THROTTLE_RATES",
+                {"token": "3/min", "register": "1/hour"},
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client = APIClient()
+
+    def _token(self, password="password", ip="10.0.0.1"):
+        return self.client.post(
+            TOKEN_URL,
+            {"email": "example@mail.com", "password": password},
+            REMOTE_ADDR=ip,
+        )
+
+    def test_token_attempts_are_limited_per_ip(self):
+        self.assertEqual(self._token("wrong").status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._token("wrong").status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(self._token().status_code, status.HTTP_200_OK)
+
+        res = self._token()
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(res["Retry-After"], "20")
+
+        self.assertEqual(self._token(ip="10.0.0.2").status_code, status.HTTP_200_OK)
+
+        self.now += 20
+        self.assertEqual(self._token().status_code, status.HTTP_200_OK)
+
+    def test_registration_is_limited_per_ip(self):
+        res = self.client.post(
+            REGISTER_URL, {"email": "first@mail.com", "password": "password"}
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        res = self.client.post(
+            REGISTER_URL, {"email": "second@mail.com", "password": "password"}
+        )
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(res["Retry-After"], "3600")
+        self.assertFalse(
+            get_user_model().objects.filter(email="second@mail.com").exists()
+        )
+
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.buckets = LocalBuckets(max_keys=10, clock=lambda: self.now)
+
+    def test_bucket_refills_at_the_rate(self):
+        for _ in range(2):
+            self.assertEqual(self.buckets.take("key", 2, 0.5), (True, 0.0))
+        self.assertEqual(self.buckets.take("key", 2, 0.5), (False, 2.0))
+
+        self.now = 1.0
+        self.assertEqual(self.buckets.take("key", 2, 0.5), (False, 1.0))
+        self.now = 2.0
+        self.assertEqual(self.buckets.take("key", 2, 0.5), (True, 0.0))
+
+        # A full bucket does not keep filling past its capacity.
+        self.now = 100.0
+        for _ in range(2):
+            self.assertTrue(self.buckets.take("key", 2, 0.5)[0])
+        self.assertFalse(self.buckets.take("key", 2, 0.5)[0])
+
+    def test_oldest_keys_are_evicted(self):
+        for number in range(11):
+            self.buckets.take(number, 1, 1)
+
+        self.assertNotIn(0, self.buckets._buckets)
+        self.assertIn(10, self.buckets._buckets)
+        self.assertEqual(len(self.buckets._buckets), 10)
+
+    def test_unreachable_redis_falls_back_to_local_buckets(self):
+        buckets = RedisBuckets(
+            "redis://127.0.0.1:1/0", self.buckets, clock=lambda: self.now
+        )
+
+        with self.assertLogs("library_project_final.throttling", "WARNING"):
+            self.assertEqual(buckets.take("key", 1, 1), (True, 0.0))
+        self.assertEqual(buckets.take("key", 1, 1), (False, 1.0))
+
+        with patch.object(buckets, "_take") as take:
+            self.now = 4.0
+            buckets.take("key", 1, 1)
+            take.assert_not_called()
+
+            take.return_value = [1, b"0"]
+            self.now = 5.0
+            self.assertEqual(buckets.take("key", 1, 1), (True, 0.0))
+            take.assert_called_once_with(keys=["key"], args=[1, 1])
+
+
+@skipUnless(
+    os.getenv("TEST_REDIS_URL") or shutil.which("redis-server"),
+    "Needs TEST_REDIS_URL or redis-server on the PATH",
+)
+class RedisBucketsTest(TestCase):
+    """
+    Runs the Lua script against a real Redis: the one at TEST_REDIS_URL,
+    or a throwaway redis-server started for the test.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.url = os.getenv("TEST_REDIS_URL")
+        if cls.url:
+            return
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        server = subprocess.Popen(
+            ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL,
+        )
+        cls.addClassCleanup(server.wait)
+        cls.addClassCleanup(server.terminate)
+        cls.url = f"redis://127.0.0.1:{port}/0"
+        client = redis.Redis.from_url(cls.url)
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+
+    def setUp(self):
+        self.key = f"throttle:test:{uuid.uuid4()}"
+        self.addCleanup(redis.Redis.from_url(self.url).delete, self.key)
+
+    def _buckets(self, clock=time.time):
+        fallback = Mock(side_effect=AssertionError("Redis was not used"))
+        return RedisBuckets(self.url, Mock(take=fallback), clock=clock)
+
+    def test_bucket_is_shared_and_refills(self):
+        first, second = self._buckets(), self._buckets()
+
+        self.assertEqual(first.take(self.key, 2, 10), (True, 0.0))
+        self.assertEqual(second.take(self.key, 2, 10), (True, 0.0))
+        allowed, wait = first.take(self.key, 2, 10)
+        self.assertFalse(allowed)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+        time.sleep(0.15)
+        self.assertTrue(second.take(self.key, 2, 10)[0])
+
+    def test_skewed_host_clock_does_not_refill(self):
+        ahead = self._buckets(clock=lambda: time.time() + 3600)
+        behind = self._buckets(clock=lambda: time.time() - 3600)
+
+        self.assertTrue(behind.take(self.key, 1, 0.01)[0])
+        self.assertFalse(ahead.take(self.key, 1, 0.01)[0])
+        self.assertFalse(behind.take(self.key, 1, 0.01)[0])
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class PasswordHashingTest(TestCase):
+    def setUp(self):
+        patcher = patch("library_project_final.throttling._buckets", LocalBuckets())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = get_user_model().objects.create_user(
+            email="example@mail.com", password="password"
+        )
+        self.client = APIClient()
+
+    def _iterations(self):
+        self.user.refresh_from_db()
+        return int(self.user.password.split("$")[1])
+
+    def test_work_factor_comes_from_settings(self):
+        self.assertEqual(self._iterations(), 1000)
+
+    def test_login_rehashes_with_new_work_factor(self):
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000):
+            res = self.client.post(
+                TOKEN_URL, {"email": "example@mail.com", "password": "password"}
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._iterations(), 2000)
+        self.assertTrue(self.user.check_password("password"))
+
+    def test_failed_login_does_not_rehash(self):
+        with override_settings(PASSWORD_HASH_ITERATIONS=2000):
+            self.client.post(
+                TOKEN_URL, {"email": "example@mail.com", "password": "wrong"}
+            )
+
+        self.assertEqual(self._iterations(), 1000)
+
+    def test_default_pbkdf2_hashes_still_verify(self):
+        self.user.password = PBKDF2PasswordHasher().encode("password", "salt" * 6)
+        self.user.save()
+
+        self.assertTrue(self.user.check_password("password"))
+        self.assertEqual(self._iterations(), 1000)
+
+    def test_hashing_runs_in_a_slot(self):
+        with patch.object(hashing_slots, "run", wraps=hashing_slots.run) as run:
+            self.user.check_password("password")
+
+        run.assert_called_once()
+
+    def test_no_free_slot_rejects_registration(self):
+        busy = HashingSlots(process=1)
+        busy._slots.acquire()
+
+        with patch("user.hashers.hashing_slots", busy):
+            res = self.client.post(
+                REGISTER_URL, {"email": "new@mail.com", "password": "password"}
+            )
+
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(res["Retry-After"], "1")
+        self.assertFalse(get_user_model().objects.filter(email="new@mail.com").exists())
+
+
+class HashingSlotsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _hold(self, slots):
+        """
+        Starts a hash that holds its slots until the returned function
+        is called.
+        """
+        release = threading.Event()
+        started = threading.Event()
+
+        def work():
+            started.set()
+            release.wait()
+
+        caller = threading.Thread(target=slots.run, args=(work,))
+        caller.start()
+        self.addCleanup(caller.join)
+        self.addCleanup(release.set)
+        started.wait()
+
+        def finish():
+            release.set()
+            caller.join()
+
+        return finish
+
+    def test_concurrency_is_bounded_by_process_slots(self):
+        slots = HashingSlots(process=2)
+        lock = threading.Lock()
+        running = []
+        peak = []
+        rejected = []
+
+        def work():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+
+        def call():
+            try:
+                with reject_when_busy():
+                    slots.run(work)
+            except PasswordHashingBusy:
+                rejected.append(1)
+
+        callers = [threading.Thread(target=call) for _ in range(6)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(peak) + len(rejected), 6)
+
+    def test_busy_process_rejects_without_waiting(self):
+        slots = HashingSlots(process=1)
+        finish = self._hold(slots)
+
+        started = time.monotonic()
+        with self.assertRaises(PasswordHashingBusy), reject_when_busy():
+            slots.run(len, "password")
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        finish()
+        with reject_when_busy():
+            self.assertEqual(slots.run(len, "password"), 8)
+
+    def test_shared_slots_span_processes(self):
+        # Two processes share the cache, each with room of its own.
+        first = HashingSlots(process=4, shared=1)
+        second = HashingSlots(process=4, shared=1)
+        finish = self._hold(first)
+
+        with self.assertRaises(PasswordHashingBusy), reject_when_busy():
+            second.run(len, "password")
+
+        finish()
+        with reject_when_busy():
+            self.assertEqual(second.run(len, "password"), 8)
+
+    def test_other_callers_wait_for_a_slot(self):
+        slots = HashingSlots(process=1, shared=1)
+        finish = self._hold(slots)
+        results = []
+        caller = threading.Thread(
+            target=lambda: results.append(slots.run(len, "password"))
+        )
+        caller.start()
+
+        caller.join(0.1)
+        self.assertTrue(caller.is_alive())
+        finish()
+        caller.join()
+        self.assertEqual(results, [8])
+
+    def test_unreachable_cache_falls_back_to_process_slots(self):
+        slots = HashingSlots(process=1, shared=1)
+
+        with (
+            patch("user.hashers.cache.add", side_effect=ConnectionError),
+            self.assertLogs("user.hashers", "WARNING"),
+            reject_when_busy(),
+        ):
+            self.assertEqual(slots.run(len, "password"), 8)
+
+    def test_admin_login_is_not_rejected(self):
+        get_user_model().objects.create_superuser(
+            email="admin@mail.com", password="password"
+        )
+        # Another process holds the only shared slot.
+        cache.add(f"{SHARED_SLOT_PREFIX}0", 1)
+
+        with patch("user.hashers.hashing_slots", HashingSlots(process=1, shared=1)):
+            response = Client().post(
+                reverse("admin:login"),
+                {"username": "admin@mail.com", "password": "password"},
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
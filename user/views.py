@@ -1,12 +1,47 @@
 from rest_framework import generics
+from rest_framework.exceptions import APIException
 from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt import views as jwt_views
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
+from library_project_final.throttling import IPTokenBucketThrottle
+from user.hashers import PasswordHashingBusy, reject_when_busy
 from user.serializers import UserSerializer
 
 
-class CreateUserView(generics.CreateAPIView):
+class HashingUnavailable(APIException):
+    status_code = 503
+    default_detail = "Too many sign-ins at the moment, try again shortly."
+    default_code = "password_hashing_busy"
+    # DRF sends this as the Retry-After header.
+    wait = 1
+
+
+class RejectWhenHashingBusyMixin:
+    """
+    Answers 503 with Retry-After when the request finds no free password
+    hashing slot, instead of waiting for one.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with reject_when_busy():
+            return super().dispatch(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, PasswordHashingBusy):
+            exc = HashingUnavailable()
+        return super().handle_exception(exc)
+
+
+class CreateUserView(RejectWhenHashingBusyMixin, generics.CreateAPIView):
     serializer_class = UserSerializer
+    throttle_classes = (IPTokenBucketThrottle,)
+    throttle_scope = "register"
+
+
+class TokenObtainPairView(RejectWhenHashingBusyMixin, jwt_views.TokenObtainPairView):
+    throttle_classes = (IPTokenBucketThrottle,)
+    throttle_scope = "token"
 
 
 class ManageUserView(generics.RetrieveUpdateAPIView):